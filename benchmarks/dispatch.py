@@ -0,0 +1,344 @@
+"""
+Benchmarks for the dispatch, batching and serialization paths of crapc.
+
+Run from the root of the repository::
+
+    python benchmarks/dispatch.py
+    python benchmarks/dispatch.py --json --output results.json
+
+Each scenario reports calls per second, per-call latency percentiles and
+the objects tracked by the garbage collector that each call leaves alive.
+Where the C{tracemalloc} module is available, it also reports the peak
+memory allocated by each call, temporary objects included, so that a call
+which allocates more shows up even if it frees everything again.
+Pass C{--json} for machine-readable output to compare releases.
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import platform
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from crapc import RPC, RPCFromObject, RPCFromClass, __version__
+from crapc._request import Request
+from crapc.jsonrpc import JsonInterface
+from crapc.unit import RPCSystem
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+
+class Service(object):
+
+    def add(self, a, b):
+        return a + b
+
+
+    def echo(self, value):
+        return value
+
+
+
+def _request(method, params, request_id=1):
+    return {
+        'jsonrpc': '2.0',
+        'id': request_id,
+        'method': method,
+        'params': params,
+    }
+
+
+
+def _runDeferred(d):
+    """
+    Get the result of a C{Deferred} that has already fired.
+    """
+    results = []
+    d.addBoth(results.append)
+    return results[0]
+
+
+
+def singleCall():
+    system = RPCSystem()
+    system.addFunction('add', lambda a, b: a + b)
+    interface = JsonInterface(system)
+    payload = json.dumps(_request('add', [1, 2]))
+    return lambda: _runDeferred(interface.run(payload)), 1
+
+
+
+def batch(size):
+    def scenario():
+        system = RPCSystem()
+        system.addFunction('add', lambda a, b: a + b)
+        interface = JsonInterface(system)
+        payload = json.dumps([_request('add', [i, 1], i)
+                              for i in range(size)])
+        return lambda: _runDeferred(interface.run(payload)), size
+    return scenario
+
+
+
+def nestedSystems(depth, compiled=False):
+    def scenario():
+        root = system = RPCSystem()
+        for i in range(depth):
+            child = RPCSystem()
+            system.addSystem('s%d' % (i,), child)
+            system = child
+        system.addFunction('add', lambda a, b: a + b)
+        if compiled:
+            root.compile()
+        method = '.'.join(['s%d' % (i,) for i in range(depth)] + ['add'])
+        return lambda: root.runProcedure(Request(method, [1, 2])), 1
+    return scenario
+
+
+
+def prehookChain(depth):
+    def scenario():
+        class Leaf(object):
+            rpc = RPC()
+
+            @rpc.prehook
+            def hook(self, func, request):
+                return func(request)
+
+            @rpc.route('add')
+            def add(self, request):
+                return sum(request.args())
+
+        class Node(object):
+            rpc = RPC()
+
+            def __init__(self, child):
+                self.child = child
+
+            @rpc.prehook
+            def hook(self, func, request):
+                return func(request)
+
+            @rpc.route('next')
+            def next(self, request):
+                return self.child.rpc
+
+        node = Leaf()
+        for i in range(depth):
+            node = Node(node)
+        method = '.'.join(['next'] * depth + ['add'])
+        rpc = node.rpc
+        return lambda: _runDeferred(
+            rpc.runProcedure(Request(method, [1, 2]))), 1
+    return scenario
+
+
+
+def middlewareChain(depth):
+    def scenario():
+        system = RPCSystem()
+        system.addFunction('add', lambda a, b: a + b)
+        for i in range(depth):
+            system.addMiddleware(lambda next, request: next(request))
+        return lambda: system.runProcedure(Request('add', [1, 2])), 1
+    return scenario
+
+
+
+def fromObject():
+    rpc = RPCFromObject(Service())
+    return lambda: rpc.runProcedure(Request('add', [1, 2])), 1
+
+
+
+def fromClass():
+    rpc = RPCFromClass(Service)()
+    return lambda: rpc.runProcedure(Request('add', [1, 2])), 1
+
+
+
+SCENARIOS = [
+    ('single_call', singleCall),
+    ('batch_1', batch(1)),
+    ('batch_100', batch(100)),
+    ('batch_10000', batch(10000)),
+    ('nested_10', nestedSystems(10)),
+    ('nested_10_compiled', nestedSystems(10, compiled=True)),
+    ('prehook_chain_5', prehookChain(5)),
+    ('middleware_5', middlewareChain(5)),
+    ('rpc_from_object', fromObject),
+    ('rpc_from_class', fromClass),
+]
+
+
+
+def _percentile(ordered, fraction):
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+
+def measure(func, calls_per_run, duration):
+    """
+    Run C{func} repeatedly for about C{duration} seconds.
+
+    @param calls_per_run: The number of RPC calls made by each run of
+        C{func}.
+
+    @return: A dictionary of results.
+    """
+    func()
+    timings = []
+    clock = time.time
+    gc.collect()
+    end = clock() + duration
+    while True:
+        start = clock()
+        func()
+        finished = clock()
+        timings.append(finished - start)
+        if finished > end and len(timings) >= 5:
+            break
+
+    total = sum(timings)
+    calls = len(timings) * calls_per_run
+    per_call = sorted(t / calls_per_run for t in timings)
+    result = {
+        'calls': calls,
+        'calls_per_sec': calls / total if total else None,
+        'latency_p50_us': _percentile(per_call, 0.5) * 1e6,
+        'latency_p90_us': _percentile(per_call, 0.9) * 1e6,
+        'latency_p99_us': _percentile(per_call, 0.99) * 1e6,
+        'peak_bytes_per_call': None,
+    }
+
+    runs = max(1, min(len(timings), 1000))
+    result['gc_objects_retained_per_call'] = (
+        float(_retainedObjects(func, runs)) / (runs * calls_per_run))
+    if tracemalloc is not None:
+        result['peak_bytes_per_call'] = (float(_peakBytes(func, runs))
+                                         / (runs * calls_per_run))
+    return result
+
+
+
+def _peakBytes(func, runs):
+    """
+    Add up the most memory allocated at once during each of C{runs} calls of
+    C{func}.
+
+    Traces are cleared before each call, so only memory allocated by the
+    call counts, including objects that it frees again before returning.
+    """
+    tracemalloc.start()
+    try:
+        total = 0
+        for i in range(runs):
+            tracemalloc.clear_traces()
+            func()
+            total += tracemalloc.get_traced_memory()[1]
+        return total
+    finally:
+        tracemalloc.stop()
+
+
+
+def _retainedObjects(func, runs):
+    """
+    Count the objects tracked by the garbage collector that C{runs} calls of
+    C{func} leave alive.
+
+    The collector counts tracked objects allocated less those deallocated
+    since it last ran, so with it disabled that count grows by exactly the
+    objects that survive.  Objects freed before the calls return aren't
+    counted.  Unlike C{tracemalloc}, this works on Python 2.
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        for i in range(runs):
+            func()
+        return gc.get_count()[0] - before
+    finally:
+        gc.enable()
+
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] [scenario ...]')
+    parser.add_option('--duration', type='float', default=1.0,
+                      help='Seconds to run each scenario for.')
+    parser.add_option('--json', action='store_true', default=False,
+                      help='Write results as JSON.')
+    parser.add_option('--output', default=None,
+                      help='File to write results to instead of stdout.')
+    parser.add_option('--list', action='store_true', default=False,
+                      help='List the scenarios and exit.')
+    options, names = parser.parse_args(argv)
+
+    if options.list:
+        for name, _ in SCENARIOS:
+            sys.stdout.write(name + '\n')
+        return
+
+    unknown = set(names) - set(name for name, _ in SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: %s' % (', '.join(sorted(unknown)),))
+
+    results = {}
+    for name, scenario in SCENARIOS:
+        if names and name not in names:
+            continue
+        func, calls_per_run = scenario()
+        results[name] = measure(func, calls_per_run, options.duration)
+
+    output = sys.stdout
+    if options.output:
+        output = open(options.output, 'w')
+
+    if options.json:
+        json.dump({
+            'crapc_version': __version__,
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'twisted': _twistedVersion(),
+            'results': results,
+        }, output, indent=2, sort_keys=True)
+        output.write('\n')
+    else:
+        output.write('%-22s %14s %10s %10s %10s %10s %10s\n' % (
+            'scenario', 'calls/sec', 'p50 us', 'p90 us', 'p99 us',
+            'kept objs', 'peak bytes'))
+        for name, _ in SCENARIOS:
+            if name not in results:
+                continue
+            r = results[name]
+            peak = r['peak_bytes_per_call']
+            output.write('%-22s %14.0f %10.2f %10.2f %10.2f %10.2f %10s\n' % (
+                name, r['calls_per_sec'], r['latency_p50_us'],
+                r['latency_p90_us'], r['latency_p99_us'],
+                r['gc_objects_retained_per_call'],
+                'n/a' if peak is None else '%.0f' % (peak,)))
+
+    if options.output:
+        output.close()
+
+
+
+def _twistedVersion():
+    import twisted
+    return twisted.__version__
+
+
+
+if __name__ == '__main__':
+    main()
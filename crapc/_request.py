@@ -1,6 +1,12 @@
 
 
 
+import time
+
+from crapc.error import Timeout
+
+
+
 class Request(object):
     """
     This is a single RPC request.
@@ -25,13 +31,57 @@ class Request(object):
         is welcome to pollute and fight over the contents of this dictionary
         as much as it wants.
     @type context: dict
+
+    @ivar segment: The leading segment of C{method}.
+    @type segment: str
+
+    @ivar deadline: When this request must be finished by, or C{None} if it
+        has no deadline.  Set it with L{setDeadline}.
+    @type deadline: float
     """
 
+    __slots__ = ('full_method', 'full_params', 'params', 'context',
+                 'deadline', '_segments', '_cursor', '_method', '_seconds')
+
 
     def __init__(self, method, params=None):
-        self.full_method = self.method = method
+        self.full_method = self._method = method
+        self._segments = tuple(method.split('.'))
+        self._cursor = 0
         self.full_params = self.params = params or ()
         self.context = {}
+        self.deadline = None
+        self._seconds = None
+
+
+    def _getMethod(self):
+        if self._method is None:
+            self._method = '.'.join(self._segments[self._cursor:])
+        return self._method
+
+
+    def _setMethod(self, method):
+        self._segments = (self._segments[:self._cursor] +
+                          tuple(method.split('.')))
+        self._method = method
+
+
+    method = property(_getMethod, _setMethod)
+
+
+    @property
+    def segment(self):
+        try:
+            return self._segments[self._cursor]
+        except IndexError:
+            return ''
+
+
+    def isLeaf(self):
+        """
+        Return C{True} if C{method} has no more than one segment left.
+        """
+        return len(self._segments) - self._cursor <= 1
 
 
     def __repr__(self):
@@ -45,10 +95,66 @@ class Request(object):
 
         @return: self
         """
-        self.method = '.'.join(self.method.split('.')[1:])
+        self._cursor += 1
+        self._method = None
         return self
 
 
+    def setDeadline(self, timeout, seconds=time.time):
+        """
+        Give this request C{timeout} seconds from now to finish.  An earlier
+        deadline is kept.
+
+        @param seconds: A function which returns the current time, such as
+            C{reactor.seconds}.
+        """
+        deadline = seconds() + timeout
+        if self.deadline is None or deadline < self.deadline:
+            self.deadline = deadline
+            self._seconds = seconds
+
+
+    def remaining(self):
+        """
+        Get the number of seconds left until the deadline, or C{None} if
+        there is no deadline.
+        """
+        if self.deadline is None:
+            return None
+        return self.deadline - self._seconds()
+
+
+    def expired(self):
+        """
+        Return C{True} if the deadline has passed.
+        """
+        return self.deadline is not None and self._seconds() >= self.deadline
+
+
+    def checkDeadline(self):
+        """
+        @raise Timeout: If the deadline has passed.
+        """
+        if self.deadline is not None and self._seconds() >= self.deadline:
+            raise Timeout(self.full_method)
+
+
+    def withoutDeadline(self):
+        """
+        Make a copy of this request with no deadline, for running work that
+        is shared with other requests, each enforcing its own deadline.
+
+        @return: A new L{Request} with a copy of C{context}.
+        """
+        request = Request.__new__(Request)
+        for name in self.__slots__:
+            setattr(request, name, getattr(self, name))
+        request.context = dict(self.context)
+        request.deadline = None
+        request._seconds = None
+        return request
+
+
     def stripParams(self, keys):
         """
         Remove the given C{keys} from this Request's C{params} dict.
@@ -58,7 +164,8 @@ class Request(object):
         @return: self
         """
         kwargs = self.kwargs().copy()
-        map(kwargs.pop, keys)
+        for key in keys:
+            kwargs.pop(key)
         self.params = kwargs
         return self
 
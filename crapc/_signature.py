@@ -0,0 +1,84 @@
+import inspect
+
+from crapc.error import InvalidParams
+
+
+try:
+    _getargspec = inspect.getfullargspec
+except AttributeError:
+    _getargspec = inspect.getargspec
+
+
+
+class Signature(object):
+    """
+    The parameters a function accepts, worked out ahead of time so that
+    calls can be checked cheaply before they are made.
+    """
+
+    def __init__(self, names, required, varargs, varkw):
+        """
+        @param names: The names of the positional parameters.
+        @param required: The names of the parameters without defaults.
+        @param varargs: C{True} if extra positional arguments are accepted.
+        @param varkw: C{True} if extra keyword arguments are accepted.
+        """
+        self.names = tuple(names)
+        self.required = tuple(required)
+        self.varargs = varargs
+        self.varkw = varkw
+
+
+    def check(self, args, kwargs):
+        """
+        Check that the function can be called with C{args} and C{kwargs}.
+
+        @raise InvalidParams: If it can't.
+        """
+        nargs = len(args)
+        if nargs > len(self.names) and not self.varargs:
+            raise InvalidParams('too many positional arguments')
+        for name in kwargs:
+            if name in self.names[:nargs]:
+                raise InvalidParams('multiple values for %r' % (name,))
+            if not self.varkw and name not in self.names:
+                raise InvalidParams('unexpected argument %r' % (name,))
+        for name in self.required[nargs:]:
+            if name not in kwargs:
+                raise InvalidParams('missing argument %r' % (name,))
+
+
+
+def signature(func, unbound=False):
+    """
+    Get the L{Signature} of C{func}.
+
+    Methods (bound or not) are described without their first argument.
+
+    @param unbound: C{True} if C{func} was taken from a class and will be
+        called with an instance as its first argument.  On Python 3, such
+        methods are plain functions, so this can't be told from C{func}.
+
+    @return: A L{Signature} or C{None} if C{func} can't be introspected.
+    """
+    func = getattr(func, '__wrapped__', func)
+    skip = 0
+    if inspect.ismethod(func) or (unbound and inspect.isfunction(func)):
+        skip = 1
+    elif not inspect.isfunction(func):
+        call = getattr(func, '__call__', None)
+        if inspect.isclass(func) or not inspect.ismethod(call):
+            return None
+        func = call
+        skip = 1
+    try:
+        spec = _getargspec(func)
+    except TypeError:
+        return None
+    if getattr(spec, 'kwonlyargs', None):
+        # keyword-only parameters aren't checked
+        return None
+    names, varargs, varkw, defaults = spec[:4]
+    names = names[skip:]
+    required = names[:len(names) - len(defaults or ())]
+    return Signature(names, required, varargs is not None, varkw is not None)
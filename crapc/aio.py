@@ -0,0 +1,318 @@
+"""
+JSON-RPC for asyncio programs.
+
+L{AsyncioJsonInterface} runs requests against any L{crapc.interface.ISystem}
+without making Twisted C{Deferred}s.  Procedures may return plain values,
+coroutines or futures, and the requests of a batch run concurrently as
+asyncio tasks.
+
+Requires Python 3.5 or later.
+"""
+
+__all__ = ['AsyncioJsonInterface']
+
+
+import inspect
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+from twisted.internet import defer
+
+from crapc._request import Request
+from crapc.codec import defaultCodec
+from crapc.jsonrpc import ParseError, InvalidRequest, InternalError
+from crapc.jsonrpc import _expectedError
+from crapc import error
+
+
+
+def _isAwaitable(result):
+    return asyncio.isfuture(result) or inspect.isawaitable(result)
+
+
+
+def _chain(future, callback, errback, loop):
+    """
+    Make a future which resolves to C{callback(result)} when C{future}
+    succeeds, or to C{errback(exception)} when it fails.
+    """
+    chained = loop.create_future()
+    def done(future):
+        if chained.cancelled():
+            return
+        if future.cancelled():
+            chained.cancel()
+            return
+        try:
+            exception = future.exception()
+            if exception is None:
+                result = callback(future.result())
+            else:
+                result = errback(exception)
+        except Exception as e:
+            chained.set_exception(e)
+        else:
+            chained.set_result(result)
+    future.add_done_callback(done)
+    return chained
+
+
+
+class AsyncioJsonInterface(object):
+    """
+    Like L{crapc.jsonrpc.JsonInterface}, but for asyncio.
+
+    Systems made with L{crapc.RPC} return C{Deferred}s; those are converted
+    to futures with C{Deferred.asFuture}, which requires the asyncio reactor.
+    L{crapc.unit.RPCSystem} and L{crapc.RPCFromObject} with coroutine
+    procedures need no conversion at all.
+    """
+
+
+    def __init__(self, rpc, serialize=None, deserialize=None,
+                 logError=None, maxBatchSize=None, codec=None, loop=None):
+        """
+        @param serialize: Function to turn responses into strings.  Overrides
+            C{codec}.
+
+        @param deserialize: Function to turn request strings into objects.
+            Overrides C{codec}.
+
+        @param logError: Function that will be called with exceptions when
+            they happen.
+
+        @param maxBatchSize: The largest number of requests allowed in a
+            single batch.  Larger batches are rejected with L{InvalidRequest}.
+
+        @param codec: A codec from L{crapc.codec} to (de)serialize with.
+
+        @param loop: The event loop to run on.  Defaults to the current one.
+        """
+        if asyncio is None:
+            raise RuntimeError('asyncio is not available')
+        codec = codec or defaultCodec
+        self.rpc = rpc
+        self._serialize = serialize or codec.encode
+        self._deserialize = deserialize or codec.decode
+        self._logError = logError or (lambda x:None)
+        self._maxBatchSize = maxBatchSize
+        self._loop = loop
+        self._notifications = set()
+
+
+    def _getLoop(self):
+        return self._loop or asyncio.get_event_loop()
+
+
+    def run(self, json_string):
+        """
+        Run the JSON-RPC request (or batch of requests) in C{json_string}.
+
+        @return: A future which resolves to the serialized response, or to
+            C{None} if only notifications were sent.
+        """
+        loop = self._getLoop()
+        response = self.runSync(json_string, loop)
+        if asyncio.isfuture(response):
+            return response
+        future = loop.create_future()
+        future.set_result(response)
+        return future
+
+
+    def runSync(self, json_string, loop=None):
+        """
+        Like L{run}, but only make a future if a procedure returns an
+        awaitable.
+
+        @return: The serialized response (or C{None}), or a future which
+            resolves to it.
+        """
+        loop = loop or self._getLoop()
+        try:
+            data = self._deserialize(json_string)
+        except Exception:
+            response = self._makeErrorResponse(ParseError())
+        else:
+            response = self._forkBatch(data, loop)
+
+        if asyncio.isfuture(response):
+            return _chain(response, self._serializeResponse, self._raise,
+                          loop)
+        return self._serializeResponse(response)
+
+
+    def _serializeResponse(self, response):
+        if response is None:
+            return None
+        return self._serialize(response)
+
+
+    def _raise(self, exception):
+        raise exception
+
+
+    def _forkBatch(self, data, loop):
+        """
+        Run a single request or a batch.
+
+        @return: The response, a future which resolves to it, or C{None} if
+            there is nothing to respond with.
+        """
+        if isinstance(data, dict):
+            return self._runSingleRequest(data, loop)
+        if isinstance(data, list) and data:
+            if self._maxBatchSize is not None \
+                    and len(data) > self._maxBatchSize:
+                return self._makeErrorResponse(
+                    InvalidRequest('batch too large'))
+            return self._runBatch(data, loop)
+        return self._makeErrorResponse(InvalidRequest('empty request'))
+
+
+    def _runBatch(self, data, loop):
+        responses = []
+        pending = []
+        for item in data:
+            response = self._runSingleRequest(item, loop)
+            if response is None:
+                continue
+            if asyncio.isfuture(response):
+                pending.append((len(responses), response))
+            responses.append(response)
+
+        if not responses:
+            return None
+        if not pending:
+            return responses
+
+        def fill(results):
+            for (index, _), result in zip(pending, results):
+                responses[index] = result
+            return responses
+        gathered = asyncio.gather(*[future for _, future in pending])
+        return _chain(gathered, fill, self._raise, loop)
+
+
+    def _runSingleRequest(self, data, loop):
+        """
+        Run a single request.
+
+        @return: The response or a future which resolves to it.  For a
+            notification, C{None}.
+        """
+        try:
+            self._validate(data)
+        except InvalidRequest as e:
+            request_id = None
+            if isinstance(data, dict):
+                request_id = data.get('id')
+            return self._makeErrorResponse(e, request_id)
+
+        notification = 'id' not in data
+        request_id = data.get('id')
+        try:
+            result = self._runProcedure(data)
+        except Exception as e:
+            if notification:
+                self._logUnexpected(e)
+                return None
+            return self._makeErrorResponse(self._mapError(e), request_id)
+
+        if isinstance(result, defer.Deferred):
+            result = result.asFuture(loop)
+        elif _isAwaitable(result):
+            result = asyncio.ensure_future(result, loop=loop)
+        else:
+            if notification:
+                return None
+            return self._makeSuccess(result, request_id)
+
+        if notification:
+            self._notifications.add(result)
+            result.add_done_callback(self._notificationDone)
+            return None
+        return _chain(result,
+                      lambda r: self._makeSuccess(r, request_id),
+                      lambda e: self._makeErrorResponse(self._mapError(e),
+                                                        request_id),
+                      loop)
+
+
+    def _notificationDone(self, future):
+        self._notifications.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            self._logUnexpected(future.exception())
+
+
+    def _validate(self, data):
+        """
+        Check that C{data} is a JSON-RPC 2.0 request object.
+
+        @raise InvalidRequest: If it isn't.
+        """
+        if not isinstance(data, dict):
+            raise InvalidRequest('request is not an object')
+        if data.get('jsonrpc') != '2.0':
+            raise InvalidRequest('only jsonrpc 2.0 accepted')
+        if not isinstance(data.get('method'), (str, type(u''))):
+            raise InvalidRequest('method not provided')
+
+
+    def _runProcedure(self, data):
+        return self.rpc.runProcedure(Request(data['method'],
+                                             data.get('params')))
+
+
+    def _mapError(self, exception):
+        """
+        Turn an exception raised by a procedure into a L{JsonRPCError},
+        logging it unless it is an expected L{error.RPCError}.
+        """
+        if isinstance(exception, error.RPCError):
+            return _expectedError(exception)
+        self._log(exception)
+        return InternalError
+
+
+    def _logUnexpected(self, exception):
+        """
+        Log C{exception} unless it is an expected L{error.RPCError}.
+        """
+        if not isinstance(exception, error.RPCError):
+            self._log(exception)
+
+
+    def _log(self, exception):
+        """
+        Log C{exception} with C{logError}.
+
+        @return: C{False} if logging failed, otherwise C{True}.
+        """
+        try:
+            self._logError(exception)
+        except Exception:
+            return False
+        return True
+
+
+    def _makeSuccess(self, result, request_id):
+        return {
+            'jsonrpc': '2.0',
+            'id': request_id,
+            'result': result,
+        }
+
+
+    def _makeErrorResponse(self, exception, request_id=None):
+        return {
+            'jsonrpc': '2.0',
+            'id': request_id,
+            'error': {
+                'code': exception.code,
+                'message': exception.public_message,
+            },
+        }
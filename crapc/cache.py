@@ -0,0 +1,232 @@
+__all__ = ['ResultCache', 'SingleFlight', 'SingleFlightSystem',
+           'requestKey']
+
+
+from collections import OrderedDict
+
+from zope.interface import implementer
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from crapc.interface import ISystem
+
+
+
+def _freeze(value):
+    """
+    Turn a JSON-like value into something hashable that only compares equal
+    to the same value.
+    """
+    if isinstance(value, dict):
+        return ('dict', tuple(sorted((k, _freeze(v))
+                                     for k, v in value.items())))
+    elif isinstance(value, (list, tuple)):
+        return ('list', tuple(_freeze(v) for v in value))
+    elif isinstance(value, (str, type(u''))):
+        return value
+    return (type(value), value)
+
+
+
+def requestKey(request, *extra):
+    """
+    Make a cache key from the full method and params of C{request}.
+
+    @param extra: Other things that the result depends on.
+
+    @return: A hashable key, or C{None} if the params can't be made
+        hashable.
+    """
+    try:
+        key = extra + (request.full_method, _freeze(request.params))
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+
+class SingleFlight(object):
+    """
+    Coalesces identical concurrent calls: while a call returns an unfired
+    C{Deferred}, calls with the same key wait for that C{Deferred} instead of
+    running again.  Nothing is kept once the C{Deferred} fires.
+
+    Every caller, including the first, gets its own C{Deferred}, so one
+    caller cancelling doesn't affect the others.  The shared call is only
+    cancelled once every caller has cancelled.
+    """
+
+
+    def __init__(self):
+        self._pending = {}
+
+
+    def call(self, key, func, *args, **kwargs):
+        """
+        Call C{func} with C{args} and C{kwargs} unless a call with C{key} is
+        already in flight.
+
+        @param key: A hashable key, such as one made by L{requestKey}.  If
+            C{None}, C{func} is always called.
+
+        @return: The result of C{func}, or a C{Deferred} which fires with it.
+        """
+        if key is None:
+            return func(*args, **kwargs)
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            return self._wait(key, pending)
+
+        result = func(*args, **kwargs)
+        if not isinstance(result, defer.Deferred):
+            return result
+        pending = self._pending[key] = (result, [])
+        d = self._wait(key, pending)
+        result.addBoth(self._settle, key, pending)
+        return d
+
+
+    def _wait(self, key, pending):
+        """
+        Make a C{Deferred} which fires with the result of the call in
+        C{pending}.
+        """
+        shared, waiting = pending
+        def cancel(d):
+            waiting.remove(d)
+            if not waiting and self._pending.get(key) is pending:
+                del self._pending[key]
+                shared.cancel()
+        d = defer.Deferred(cancel)
+        waiting.append(d)
+        return d
+
+
+    def _settle(self, result, key, pending):
+        if self._pending.get(key) is pending:
+            del self._pending[key]
+        waiting = pending[1]
+        while waiting:
+            d = waiting.pop(0)
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+
+@implementer(ISystem)
+class SingleFlightSystem(object):
+    """
+    An L{ISystem} that wraps another one so that identical concurrent
+    requests (same full method and params) share one call to the wrapped
+    system.  See L{SingleFlight}.
+
+    Requests that wait on another request's call don't reach the wrapped
+    system at all, so only wrap systems whose results don't depend on
+    C{request.context}.  The call is run without a deadline, and each
+    request gives up waiting at its own deadline.
+    """
+
+
+    def __init__(self, system):
+        self.system = system
+        self._flight = SingleFlight()
+
+
+    def runProcedure(self, request):
+        return self._flight.call(requestKey(request), self._runShared, request)
+
+
+    def _runShared(self, request):
+        """
+        Run C{request} on the wrapped system for every request waiting on
+        it, without the deadline of the request that happened to be first.
+        """
+        return self.system.runProcedure(request.withoutDeadline())
+
+
+
+class ResultCache(object):
+    """
+    A cache of procedure results which evicts the least recently used results
+    once it is full, and optionally expires results after a time.
+
+    While a call returns an unfired C{Deferred}, identical calls wait for
+    that C{Deferred} instead of running again.  Failures are never cached.
+
+    Cached results are shared between callers, so they should not be
+    mutated.
+    """
+
+
+    def __init__(self, maxSize=1024, ttl=None, clock=None):
+        """
+        @param maxSize: The most results to keep.
+        @param ttl: How many seconds to keep each result for, or C{None} to
+            keep them until they are evicted.
+        @param clock: An C{IReactorTime} provider used to expire results.
+            Defaults to the reactor.
+        """
+        if clock is None and ttl is not None:
+            from twisted.internet import reactor as clock
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self._clock = clock
+        self._results = OrderedDict()
+        self._flight = SingleFlight()
+
+
+    def call(self, key, func, *args, **kwargs):
+        """
+        Get the result for C{key}, calling C{func} with C{args} and
+        C{kwargs} to make it if it isn't cached.
+
+        @param key: A hashable key, such as one made by L{requestKey}.  If
+            C{None}, C{func} is called without caching.
+
+        @return: The result of C{func}, or a C{Deferred} which fires with it.
+        """
+        if key is None:
+            return func(*args, **kwargs)
+
+        try:
+            result, expires = self._results.pop(key)
+        except KeyError:
+            pass
+        else:
+            if expires is None or expires > self._clock.seconds():
+                self._results[key] = (result, expires)
+                return result
+
+        return self._flight.call(key, self._compute, key, func, args, kwargs)
+
+
+    def _compute(self, key, func, args, kwargs):
+        result = func(*args, **kwargs)
+        if isinstance(result, defer.Deferred):
+            return result.addCallback(self._store, key)
+        return self._store(result, key)
+
+
+    def _store(self, result, key):
+        expires = None
+        if self.ttl is not None:
+            expires = self._clock.seconds() + self.ttl
+        self._results[key] = (result, expires)
+        while len(self._results) > self.maxSize:
+            self._results.popitem(last=False)
+        return result
+
+
+    def invalidate(self, key=None):
+        """
+        Forget the result for C{key}, or every result if C{key} is C{None}.
+        """
+        if key is None:
+            self._results.clear()
+        else:
+            self._results.pop(key, None)
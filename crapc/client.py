@@ -0,0 +1,371 @@
+"""
+A JSON-RPC client for the socket transports in L{crapc.transport}.
+"""
+
+__all__ = ['JsonRpcClient']
+
+
+from itertools import count
+from collections import deque
+
+from twisted.internet import defer, protocol, endpoints
+from twisted.protocols.basic import LineOnlyReceiver, Int32StringReceiver
+
+from crapc.codec import defaultCodec
+from crapc.jsonrpc import JsonRPCError, ParseError, InvalidRequest
+from crapc.jsonrpc import MethodNotFound, InvalidParams, InternalError
+from crapc.jsonrpc import Overloaded, Timeout
+
+
+_errors = {}
+for _cls in (ParseError, InvalidRequest, MethodNotFound, InvalidParams,
+             InternalError, Overloaded, Timeout):
+    _errors[_cls.code] = _cls
+del _cls
+
+
+
+def _makeError(response_error):
+    """
+    Turn the C{error} member of a response into an exception.
+
+    @return: An instance of the matching L{crapc.jsonrpc.JsonRPCError}
+        subclass, or of L{crapc.jsonrpc.JsonRPCError} itself for unknown
+        codes.
+    """
+    code = response_error.get('code')
+    exc = _errors.get(code, JsonRPCError)(response_error.get('message'))
+    exc.code = code
+    exc.data = response_error.get('data')
+    return exc
+
+
+
+class _Connection(object):
+    """
+    One connection of a L{JsonRpcClient}.  Responses are matched to requests
+    by id, so many requests may be waiting on a connection at once.
+
+    Errors about a whole payload (such as a parse error, a batch that is too
+    large or an overloaded server) come with a null id.  The server sends
+    them as soon as it reads the payload, so they answer one of the payloads
+    sent after the last one to get a response.  Every call in those payloads
+    fails with the error, since which one it was can't be told.
+
+    @ivar waiting: A dictionary of request id to the C{Deferred} waiting for
+        its result.
+    @ivar sent: The ids of the calls in each payload that may still be
+        waiting, oldest first.
+    """
+
+    client = None
+
+    def connectionMade(self):
+        self.waiting = {}
+        self.sent = deque()
+
+
+    def sendRequests(self, payload, waiting):
+        """
+        Send serialized requests.
+
+        @param waiting: A dictionary of the ids of the requests in C{payload}
+            to C{Deferred}s to fire with their results.
+        """
+        self.waiting.update(waiting)
+        if waiting:
+            self.sent.append(list(waiting))
+        self.sendPayload(payload)
+
+
+    def payloadReceived(self, payload):
+        responses = self.client._decode(payload)
+        if isinstance(responses, dict):
+            if responses.get('id') is None and 'error' in responses:
+                self._failUnanswered(responses['error'])
+                return
+            responses = [responses]
+        for response in responses:
+            d = self.waiting.pop(response.get('id'), None)
+            if d is None:
+                continue
+            if 'error' in response:
+                d.errback(_makeError(response['error']))
+            else:
+                d.callback(response.get('result'))
+        self._forgetAnswered()
+
+
+    def _forgetAnswered(self):
+        """
+        Forget the oldest payloads, once none of their calls are waiting.
+        """
+        sent = self.sent
+        while sent and not any(i in self.waiting for i in sent[0]):
+            sent.popleft()
+
+
+    def _failUnanswered(self, response_error):
+        """
+        Fail every call in the payloads that a response with a null id may
+        answer: those sent after the last payload to get a response.
+        """
+        unanswered = []
+        for ids in reversed(self.sent):
+            if not all(i in self.waiting for i in ids):
+                break
+            unanswered.append(ids)
+        for ids in unanswered:
+            for request_id in ids:
+                self.waiting.pop(request_id).errback(
+                    _makeError(response_error))
+        self._forgetAnswered()
+
+
+    def connectionLost(self, reason):
+        self.client._connectionLost(self)
+        self.sent = deque()
+        waiting, self.waiting = self.waiting, {}
+        for d in waiting.values():
+            d.errback(reason)
+
+
+
+class _LineConnection(_Connection, LineOnlyReceiver):
+
+    delimiter = b'\n'
+    MAX_LENGTH = 1024 * 1024
+
+    def lineReceived(self, line):
+        self.payloadReceived(line)
+
+
+    def sendPayload(self, payload):
+        self.sendLine(payload)
+
+
+    def connectionLost(self, reason):
+        _Connection.connectionLost(self, reason)
+        LineOnlyReceiver.connectionLost(self, reason)
+
+
+
+class _LengthPrefixedConnection(_Connection, Int32StringReceiver):
+
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    def stringReceived(self, data):
+        self.payloadReceived(data)
+
+
+    def sendPayload(self, payload):
+        self.sendString(payload)
+
+
+    def connectionLost(self, reason):
+        _Connection.connectionLost(self, reason)
+        Int32StringReceiver.connectionLost(self, reason)
+
+
+
+class _ConnectionFactory(protocol.Factory):
+
+    def __init__(self, client, protocol):
+        self.client = client
+        self.protocol = protocol
+
+
+    def buildProtocol(self, addr):
+        p = protocol.Factory.buildProtocol(self, addr)
+        p.client = self.client
+        return p
+
+
+
+_framings = {
+    'line': _LineConnection,
+    'length': _LengthPrefixedConnection,
+}
+
+
+
+class JsonRpcClient(object):
+    """
+    Calls procedures on a server made with L{crapc.transport.serve}.
+
+    Requests are sent over a pool of connections without waiting for earlier
+    responses.  With a C{batchWindow}, calls made within that many seconds of
+    each other are sent together as one JSON-RPC batch.
+
+    Errors from the server fail the C{Deferred} with the matching
+    L{crapc.jsonrpc.JsonRPCError} subclass.  Errors the server can't tie to
+    a call, such as L{crapc.jsonrpc.Overloaded} when it sheds load, fail
+    every call sent on the connection since its last response.
+    """
+
+
+    def __init__(self, endpoint, poolSize=1, batchWindow=None,
+                 maxBatchSize=100, framing='line', codec=None, reactor=None):
+        """
+        @param endpoint: An C{IStreamClientEndpoint}, or a client endpoint
+            description such as C{'tcp:localhost:7080'}.
+        @param poolSize: The most connections to open.  A new connection is
+            only opened when all the others are waiting for responses.
+        @param batchWindow: How many seconds to wait for more calls before
+            sending a batch, or C{None} to send every call right away.
+        @param maxBatchSize: The most requests to put in one batch.
+        @param framing: C{'line'} or C{'length'}, as given to
+            L{crapc.transport.serve}.
+        @param codec: A codec from L{crapc.codec}.
+        @param reactor: The reactor to connect and schedule batches with.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        if not isinstance(endpoint, (str, type(u''))):
+            self._endpoint = endpoint
+        else:
+            self._endpoint = endpoints.clientFromString(reactor, endpoint)
+        if framing not in _framings:
+            raise ValueError('Unknown framing: %r' % (framing,))
+        codec = codec or defaultCodec
+        self._encode = codec.encode
+        self._decode = codec.decode
+        self._factory = _ConnectionFactory(self, _framings[framing])
+        self._reactor = reactor
+        self.poolSize = poolSize
+        self.batchWindow = batchWindow
+        self.maxBatchSize = maxBatchSize
+        self._ids = count(1)
+        self._connections = []
+        self._connecting = 0
+        self._connectionWaiters = []
+        self._queue = []
+        self._flushCall = None
+
+
+    def call(self, method, *args, **kwargs):
+        """
+        Call a remote procedure.
+
+        @return: A C{Deferred} which fires with the result.
+        """
+        request_id = next(self._ids)
+        d = defer.Deferred()
+        self._enqueue(self._makeRequest(method, args or kwargs, request_id),
+                      request_id, d)
+        return d
+
+
+    def notify(self, method, *args, **kwargs):
+        """
+        Call a remote procedure without waiting for it to finish.
+        """
+        self._enqueue(self._makeRequest(method, args or kwargs), None, None)
+
+
+    def close(self):
+        """
+        Send any waiting calls and close every connection.  Calls still
+        waiting for a response fail.
+        """
+        self.flush()
+        for connection in list(self._connections):
+            connection.transport.loseConnection()
+
+
+    def _makeRequest(self, method, params, request_id=None):
+        request = {
+            'jsonrpc': '2.0',
+            'method': method,
+        }
+        if params:
+            request['params'] = params
+        if request_id is not None:
+            request['id'] = request_id
+        return request
+
+
+    def _enqueue(self, request, request_id, d):
+        self._queue.append((request, request_id, d))
+        if self.batchWindow is None or len(self._queue) >= self.maxBatchSize:
+            self.flush()
+        elif self._flushCall is None:
+            self._flushCall = self._reactor.callLater(self.batchWindow,
+                                                      self.flush)
+
+
+    def flush(self):
+        """
+        Send the calls waiting for the batch window to close now.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        if not self._queue:
+            return
+        queue, self._queue = self._queue, []
+
+        waiting = {}
+        requests = []
+        for request, request_id, d in queue:
+            requests.append(request)
+            if d is not None:
+                waiting[request_id] = d
+        if len(requests) == 1:
+            payload = self._encode(requests[0])
+        else:
+            payload = self._encode(requests)
+
+        def send(connection):
+            connection.sendRequests(payload, waiting)
+        def failed(failure):
+            for d in waiting.values():
+                d.errback(failure)
+        self._getConnection().addCallbacks(send, failed)
+
+
+    def _getConnection(self):
+        """
+        Get the connection to send the next requests on: an idle one if
+        there is one, otherwise a new one if the pool isn't full, otherwise
+        the one with the fewest requests waiting.
+
+        @return: A C{Deferred} which fires with the connection.
+        """
+        best = None
+        if self._connections:
+            best = min(self._connections, key=lambda c: len(c.waiting))
+        full = len(self._connections) + self._connecting >= self.poolSize
+        if best is not None and (full or not best.waiting):
+            return defer.succeed(best)
+        if not full:
+            return self._connect()
+        d = defer.Deferred()
+        self._connectionWaiters.append(d)
+        return d
+
+
+    def _connect(self):
+        self._connecting += 1
+        d = self._endpoint.connect(self._factory)
+        d.addBoth(self._connected)
+        return d
+
+
+    def _connected(self, result):
+        self._connecting -= 1
+        if isinstance(result, _Connection):
+            self._connections.append(result)
+        waiters, self._connectionWaiters = self._connectionWaiters, []
+        for d in waiters:
+            if isinstance(result, _Connection):
+                d.callback(result)
+            else:
+                d.errback(result)
+        return result
+
+
+    def _connectionLost(self, connection):
+        if connection in self._connections:
+            self._connections.remove(connection)
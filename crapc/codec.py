@@ -0,0 +1,189 @@
+__all__ = ['JsonCodec', 'MsgpackCodec', 'defaultCodec']
+
+
+import os
+import json
+import mmap
+from functools import partial
+
+
+
+def _majorVersion(module):
+    try:
+        return int(module.__version__.split('.')[0])
+    except (AttributeError, ValueError):
+        return 0
+
+
+
+def _findJsonLibraries():
+    """
+    Find the JSON libraries that can be imported, fastest first.
+
+    @return: A list of C{(name, dumps, loads)} tuples.
+    """
+    found = []
+    try:
+        import orjson
+        found.append(('orjson', orjson.dumps, orjson.loads))
+    except ImportError:
+        pass
+    try:
+        import ujson
+    except ImportError:
+        pass
+    else:
+        # ujson before 2.0 rounds floats to a fixed number of decimals
+        if _majorVersion(ujson) >= 2:
+            found.append(('ujson', ujson.dumps, ujson.loads))
+    # json.dumps makes a new encoder for every call when given options
+    found.append(('json', json.JSONEncoder(separators=(',', ':')).encode,
+                  json.loads))
+    return found
+
+_jsonLibraries = _findJsonLibraries()
+
+# libraries whose loads accepts memoryviews without copying them
+_acceptsBuffers = frozenset(['orjson', 'msgpack'])
+
+_strings = (bytes, type(u''))
+
+
+
+def _encodingToBytes(dumps):
+    """
+    Make C{dumps} return bytes if it doesn't already.
+    """
+    if isinstance(dumps({}), bytes):
+        return dumps
+    return lambda obj: dumps(obj).encode('utf-8')
+
+
+
+def _mapFile(fileobj):
+    """
+    Map the contents of a regular file into memory.
+
+    @return: A read-only C{mmap}, or C{None} if C{fileobj} can't be mapped.
+    """
+    try:
+        fileno = fileobj.fileno()
+        if fileobj.tell() != 0 or os.fstat(fileno).st_size == 0:
+            return None
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (AttributeError, ValueError, EnvironmentError):
+        return None
+
+
+
+def _copy(data):
+    """
+    Copy a buffer into bytes.
+    """
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    if isinstance(data, mmap.mmap):
+        return data[:]
+    return bytes(data)
+
+
+
+def _bufferDecoder(loads, buffers):
+    """
+    Make C{loads} accept C{memoryview}s, C{bytearray}s, C{mmap}s and files as
+    well as strings.
+
+    @param buffers: C{True} if C{loads} accepts a C{memoryview} itself, so
+        buffers are decoded without being copied.  Otherwise they are copied
+        into bytes once.
+    """
+    def decode(data):
+        if isinstance(data, _strings):
+            return loads(data)
+        if hasattr(data, 'getvalue'):
+            # BytesIO
+            if buffers and hasattr(data, 'getbuffer'):
+                return _decodeView(data.getbuffer())
+            return loads(data.getvalue())
+        if hasattr(data, 'read') and not isinstance(data, mmap.mmap):
+            mapped = _mapFile(data)
+            if mapped is None:
+                return loads(data.read())
+            try:
+                return decode(mapped)
+            finally:
+                mapped.close()
+        if buffers:
+            try:
+                view = memoryview(data)
+            except TypeError:
+                pass
+            else:
+                return _decodeView(view)
+        return loads(_copy(data))
+
+    def _decodeView(view):
+        try:
+            return loads(view)
+        finally:
+            if hasattr(view, 'release'):
+                # so the buffer can be closed or resized even if a
+                # traceback keeps this frame alive
+                view.release()
+    return decode
+
+
+
+class JsonCodec(object):
+    """
+    Encodes objects to JSON bytes and decodes them again using the fastest
+    JSON library available (C{orjson}, then C{ujson} 2.0 or later, then the
+    standard library's C{json}).  Older versions of C{ujson} lose precision
+    on floats, so they are never used.
+
+    C{decode} accepts strings, bytes, C{bytearray}s, C{memoryview}s, C{mmap}s
+    and files.  Regular files are mapped into memory rather than read.  With
+    C{orjson}, buffers are decoded without being copied.
+
+    @ivar name: The name of the library being used.
+    """
+
+
+    def __init__(self, library=None):
+        """
+        @param library: The name of the JSON library to use instead of the
+            fastest one available.
+
+        @raise ValueError: If C{library} can't be imported.
+        """
+        for name, dumps, loads in _jsonLibraries:
+            if library is None or name == library:
+                break
+        else:
+            raise ValueError('JSON library not available: %r' % (library,))
+        self.name = name
+        self.encode = _encodingToBytes(dumps)
+        self.decode = _bufferDecoder(loads, name in _acceptsBuffers)
+
+
+
+class MsgpackCodec(object):
+    """
+    Encodes JSON-RPC 2.0 messages with MessagePack instead of JSON.  This is
+    meant for traffic between services that both use crapc.
+
+    Requires the C{msgpack} package.
+    """
+
+    name = 'msgpack'
+
+
+    def __init__(self):
+        import msgpack
+        self.encode = partial(msgpack.packb, use_bin_type=True)
+        self.decode = _bufferDecoder(partial(msgpack.unpackb, raw=False),
+                                     True)
+
+
+
+defaultCodec = JsonCodec()
@@ -5,4 +5,15 @@ class RPCError(Exception):
 
 
 class MethodNotFound(RPCError):
-    pass
\ No newline at end of file
+    pass
+
+class InvalidParams(RPCError):
+    pass
+
+
+class Overloaded(RPCError):
+    pass
+
+
+class Timeout(RPCError):
+    pass
@@ -4,45 +4,125 @@ __all__ = ['RPCFromObject', 'PythonInterface', 'RPCFromClass']
 
 import inspect
 
-from zope.interface import implements
+from zope.interface import implementer
 
 from crapc.error import MethodNotFound
 from crapc.interface import ISystem
 from crapc._request import Request
+from crapc._signature import signature
+from crapc.pool import _defaultThreadPool
 
 
+@implementer(ISystem)
 class _LazyWrappingRPCSystem(object):
     """
     Create an L{ISystem} from the public methods of an object that are looked
     up lazily.
+
+    Looked up methods (and names that aren't public methods) are remembered,
+    so call L{invalidate} if the methods of the wrapped object change.
+
+    @cvar maxMissing: The most names that aren't public methods to remember.
     """
 
-    implements(ISystem)
+    maxMissing = 1024
 
-    def __init__(self, original):
+    def __init__(self, original, pool=None, blocking=False):
         self.original = original
+        self._pool = pool
+        self._blocking = blocking
+        self._resolved = {}
+        self._missing = set()
 
 
     def runProcedure(self, request):
-        if request.method.startswith('_'):
-            raise MethodNotFound(request.method)
+        name = request.method
         try:
-            func = getattr(self.original, request.method)
-            if inspect.ismethod(func) or inspect.isfunction(func):
-                return func(*request.args(), **request.kwargs())
-            else:
-                raise MethodNotFound(request.method)
+            func, sig, pool = self._resolved[name]
+        except KeyError:
+            if name in self._missing:
+                raise MethodNotFound(name)
+            func, sig, pool = self._resolve(name)
+        args = request.args()
+        kwargs = request.kwargs()
+        if sig is not None:
+            sig.check(args, kwargs)
+        if pool is not None:
+            return pool.run(func, *args, **kwargs)
+        try:
+            return func(*args, **kwargs)
         except AttributeError:
-            raise MethodNotFound(request.method)
-
-
-def RPCFromObject(obj):
+            raise MethodNotFound(name)
+
+
+    def _resolve(self, name):
+        """
+        Look up the public method called C{name}.
+
+        @return: A tuple of the method, its signature and the pool to run it
+            in (or C{None}).
+        """
+        func = None
+        if not name.startswith('_'):
+            func = getattr(self.original, name, None)
+            if not (inspect.ismethod(func) or inspect.isfunction(func)):
+                func = None
+        if func is None:
+            if len(self._missing) >= self.maxMissing:
+                self._missing.clear()
+            self._missing.add(name)
+            raise MethodNotFound(name)
+        pool = None
+        if self._blocking or getattr(func, 'blocking', False):
+            pool = self._pool or _defaultThreadPool()
+        resolved = self._resolved[name] = (func, signature(func), pool)
+        return resolved
+
+
+    def invalidate(self, name=None):
+        """
+        Forget what was looked up for C{name}, or for every name if C{name}
+        is C{None}.
+        """
+        if name is None:
+            self._resolved.clear()
+            self._missing.clear()
+        else:
+            self._resolved.pop(name, None)
+            self._missing.discard(name)
+
+
+
+def RPCFromObject(obj, pool=None, blocking=False):
     """
     Create an L{ISystem} from the public methods on this object.
 
+    Methods that block can be run in C{pool} (such as a
+    L{crapc.pool.ThreadPool}) by decorating them with
+    L{crapc.pool.blocking}, or by passing C{blocking=True} to run every
+    method in C{pool}.  Without a C{pool}, they are run in a shared
+    L{crapc.pool.ThreadPool} of 10 threads, never in the reactor thread.
+
+    Methods are looked up the first time they are called and remembered
+    after that.  If you add or replace methods on C{obj} afterwards, call
+    C{invalidate()} on the returned system.
+
     @return: An L{ISystem}-implementing instance.
     """
-    return _LazyWrappingRPCSystem(obj)
+    return _LazyWrappingRPCSystem(obj, pool, blocking)
+
+
+
+def _isInstanceMethod(cls, name):
+    """
+    Whether the attribute C{name} of C{cls} is called with an instance, that
+    is, it isn't a C{staticmethod} or C{classmethod}.
+    """
+    for klass in inspect.getmro(cls):
+        if name in vars(klass):
+            return not isinstance(vars(klass)[name],
+                                  (staticmethod, classmethod))
+    return False
 
 
 
@@ -57,25 +137,35 @@ def RPCFromClass(cls):
     By default, all public methods are turned into RPC-available methods.
     """
     methods = inspect.getmembers(cls)
-    class _RPC(object):
 
-        implements(ISystem)
+    @implementer(ISystem)
+    class _RPC(object):
 
         def __init__(self, *args, **kwargs):
             self.original = cls(*args, **kwargs)
 
         def runProcedure(self, request):
             try:
-                func = self._functions[request.method]
+                func, unbound = self._functions[request.method]
             except KeyError:
                 raise MethodNotFound(request.full_method)
-            return func(self.original, *request.args(), **request.kwargs())
+            args = request.args()
+            kwargs = request.kwargs()
+            sig = self._signatures[request.method]
+            if sig is not None:
+                sig.check(args, kwargs)
+            if unbound:
+                return func(self.original, *args, **kwargs)
+            return func(*args, **kwargs)
 
         _functions = {}
+        _signatures = {}
         for name, func in methods:
             if name.startswith('_'):
                 continue
-            _functions[name] = func
+            unbound = _isInstanceMethod(cls, name)
+            _functions[name] = (func, unbound)
+            _signatures[name] = signature(func, unbound)
 
     return _RPC
 
@@ -1,10 +1,16 @@
 
+import re
 import json
+import time
+import codecs
 
 from twisted.internet import defer
 from twisted.python.failure import Failure
 
 from crapc._request import Request
+from crapc.codec import JsonCodec, defaultCodec, _copy
+from crapc.middleware import chain
+from crapc.unit import _BoundRPC
 from crapc import error
 
 
@@ -32,30 +38,618 @@ class InternalError(JsonRPCError):
     public_message = "Internal error"
     code = -32603
 
+class Overloaded(JsonRPCError):
+    public_message = "Server overloaded"
+    code = -32000
+
+class Timeout(JsonRPCError):
+    public_message = "Request timed out"
+    code = -32001
+
+
+
+# errors raised by systems and the JSON-RPC errors they are reported as
+_mappedErrors = [
+    (error.MethodNotFound, MethodNotFound),
+    (error.InvalidParams, InvalidParams),
+    (error.Overloaded, Overloaded),
+    (error.Timeout, Timeout),
+]
+
+
+
+def _expectedError(exc):
+    """
+    Get the L{JsonRPCError} that an expected L{error.RPCError} is reported
+    as.  Those without a JSON-RPC equivalent are reported as
+    L{InternalError}.
+    """
+    if isinstance(exc, JsonRPCError):
+        return exc
+    for cls, mapped in _mappedErrors:
+        if isinstance(exc, cls):
+            return mapped
+    return InternalError
+
+
+
+class _Response(object):
+    """
+    A response to be serialized by L{_Envelope}, which is cheaper to make
+    than the dictionary it stands for.
+
+    @ivar id: The id of the request.
+    @ivar result: The result, for successful responses.
+    @ivar code: The error code, or C{None} if the request succeeded.
+    @ivar message: The error message.
+    """
+
+    __slots__ = ('id', 'result', 'code', 'message')
+
+    def __init__(self, request_id, result=None, code=None, message=None):
+        self.id = request_id
+        self.result = result
+        self.code = code
+        self.message = message
+
+
+    def asDict(self):
+        if self.code is None:
+            return {'jsonrpc': '2.0', 'id': self.id, 'result': self.result}
+        return {
+            'jsonrpc': '2.0',
+            'id': self.id,
+            'error': {
+                'code': self.code,
+                'message': self.message,
+            },
+        }
+
+
+
+def _errorCode(response):
+    """
+    Get the error code of a response, or C{None} if it succeeded.
+    """
+    if isinstance(response, _Response):
+        return response.code
+    if 'error' in response:
+        return response['error']['code']
+    return None
+
+
+
+class _Envelope(object):
+    """
+    Serializes a single L{_Response} by splicing the pre-encoded parts of the
+    JSON-RPC envelope around its separately encoded id and result, instead of
+    building and encoding a dictionary.  Error bodies for requests without an
+    id are encoded only once.
+
+    Batches are still encoded in one pass, which is cheaper than splicing
+    each response.
+
+    This only works with JSON codecs, whose output can be spliced.
+    """
+
+    _prefix = b'{"jsonrpc":"2.0","id":'
+    _result = b',"result":'
+    _constants = {None: b'null', True: b'true', False: b'false'}
+    maxCached = 256
+
+    def __init__(self, encode):
+        self._encode = encode
+        self._errors = {}
+        self._static = {}
+        for exc in (ParseError, InvalidRequest, MethodNotFound, InvalidParams,
+                    InternalError, Overloaded, Timeout):
+            self.serialize(_Response(None, code=exc.code,
+                                     message=exc.public_message))
+
+
+    def _encodeValue(self, value):
+        # small values are common ids and results, and calling the encoder
+        # costs more than encoding them
+        if type(value) is int:
+            return b'%d' % (value,)
+        if value is None or value is True or value is False:
+            return self._constants[value]
+        return self._encode(value)
+
+
+    def _encodeError(self, response):
+        key = (response.code, response.message)
+        if response.id is None:
+            body = self._static.get(key)
+            if body is not None:
+                return body
+        suffix = self._errors.get(key)
+        if suffix is None:
+            suffix = b''.join((b',"error":',
+                               self._encode({'code': response.code,
+                                             'message': response.message}),
+                               b'}'))
+            if len(self._errors) < self.maxCached:
+                self._errors[key] = suffix
+        body = b''.join((self._prefix, self._encodeValue(response.id),
+                         suffix))
+        if response.id is None and len(self._static) < self.maxCached:
+            self._static[key] = body
+        return body
+
+
+    def serialize(self, response):
+        """
+        Serialize a response or a list of responses.
+        """
+        if isinstance(response, _Response):
+            if response.code is not None:
+                return self._encodeError(response)
+            return b''.join((self._prefix, self._encodeValue(response.id),
+                             self._result, self._encodeValue(response.result),
+                             b'}'))
+        if isinstance(response, list):
+            return self._encode([r.asDict() if isinstance(r, _Response)
+                                 else r for r in response])
+        return self._encode(response)
+
+
+
+class _ArrayWriter(object):
+    """
+    Write serialized elements of a JSON array one at a time.
+    """
+
+    def __init__(self, write, serialize):
+        self._write = write
+        self._serialize = serialize
+        self._opened = False
+
+
+    def writeElement(self, element):
+        if self._opened:
+            self._write(b',')
+        else:
+            self._write(b'[')
+            self._opened = True
+        self._write(self._serialize(element))
+
+
+    def close(self):
+        if self._opened:
+            self._write(b']')
+
+
+
+class _Observation(object):
+    """
+    Timings of one call to L{JsonInterface.runSync} for its observers.
+
+    Each request in the call is reported to the observers as a dictionary
+    with these keys:
+
+        - C{method}: The method requested (or C{None}).
+        - C{id}: The id of the request (or C{None}).
+        - C{batchSize}: The number of requests in the batch (1 if it wasn't a
+          batch).
+        - C{outcome}: C{'result'}, C{'error'} or C{'notification'}.
+        - C{errorCode}: The JSON-RPC error code for errors, otherwise
+          C{None}.
+        - C{parseTime}: Seconds spent parsing the whole body.
+        - C{executeTime}: Seconds from dispatching the request until its
+          response was ready, including routing, prehooks and time spent
+          waiting for concurrency limits.
+        - C{serializeTime}: Seconds spent serializing the whole response, or
+          C{None} for notifications that finished after it was serialized.
+    """
+
+    def __init__(self, observers, timer):
+        self.observers = observers
+        self.timer = timer
+        self.started = timer()
+        self.parseTime = None
+        self.batchSize = 1
+        self.finished = False
+        self.records = []
+
+
+    def parsed(self, data):
+        self.parseTime = self.timer() - self.started
+        if isinstance(data, list):
+            self.batchSize = len(data)
+
+
+    def record(self, data, started, response):
+        """
+        Record the response to a request once it's ready.
+
+        @return: C{response}
+        """
+        record = {'method': None, 'id': None}
+        if isinstance(data, dict):
+            record['method'] = data.get('method')
+            record['id'] = data.get('id')
+        self.records.append(record)
+        if isinstance(response, defer.Deferred):
+            return response.addCallback(self._done, record, started)
+        return self._done(response, record, started)
+
+
+    def _done(self, response, record, started):
+        record['executeTime'] = self.timer() - started
+        if response is None:
+            record['outcome'] = 'notification'
+            record['errorCode'] = None
+        else:
+            code = _errorCode(response)
+            record['outcome'] = 'result' if code is None else 'error'
+            record['errorCode'] = code
+        if self.finished:
+            # a notification that finished after the response was serialized
+            self._emit(record, None)
+        return response
+
+
+    def finish(self, response, serializeTime):
+        """
+        Report every request that is done, now that the response has been
+        serialized.
+        """
+        if not self.records and response is not None:
+            # the body was rejected before any request was run
+            self.record(None, self.timer(), response)
+        self.finished = True
+        for record in self.records:
+            if 'outcome' in record:
+                self._emit(record, serializeTime)
+
+
+    def _emit(self, record, serializeTime):
+        event = dict(record)
+        event['batchSize'] = self.batchSize
+        event['parseTime'] = self.parseTime
+        event['serializeTime'] = serializeTime
+        for observer in self.observers:
+            try:
+                observer(event)
+            except:
+                pass
+
+
+
+class _IncrementalDecoder(object):
+    """
+    Decode the elements of a JSON array as the document arrives in chunks.
+
+    Documents that aren't arrays are decoded all at once by L{close}.
+
+    @ivar isArray: C{True} if the document is an array, C{False} if it isn't
+        and C{None} if that isn't known yet.
+    """
+
+    _whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._text = None
+        if bytes is not str:
+            # json only decodes text on Python 3.  Chunks may end in the
+            # middle of a character, so decode them incrementally.
+            self._text = codecs.getincrementaldecoder('utf-8')()
+        self._expectComma = False
+        self._closed = False
+        self._count = 0
+        self.isArray = None
+
+
+    def feed(self, data):
+        """
+        Add more of the document.
+
+        @return: A list of the array elements completed by C{data}.
+
+        @raise ValueError: If the document is not valid JSON.
+        """
+        if not isinstance(data, (bytes, type(u''))):
+            data = _copy(data)
+        if self._text is not None and isinstance(data, bytes):
+            data = self._text.decode(data)
+        self._buffer += data
+        if self.isArray is None:
+            pos = self._whitespace.match(self._buffer).end()
+            if pos == len(self._buffer):
+                return []
+            self.isArray = self._buffer[pos] == '['
+            if self.isArray:
+                self._buffer = self._buffer[pos + 1:]
+        if not self.isArray:
+            return []
+        return self._decodeElements(False)
+
+
+    def close(self):
+        """
+        Finish the document.
+
+        @return: The remaining elements of the array, or the decoded document
+            if it isn't an array.
+
+        @raise ValueError: If the document is not valid JSON.
+        """
+        if not self.isArray:
+            return self._decoder.decode(self._buffer)
+        elements = self._decodeElements(True)
+        if not self._closed or self._buffer.strip():
+            raise ValueError('Unterminated array')
+        return elements
+
+
+    def _decodeElements(self, final):
+        # track a position and trim the buffer once, so that a large chunk
+        # isn't copied for every element
+        buf = self._buffer
+        start = 0
+        elements = []
+        while not self._closed:
+            pos = self._whitespace.match(buf, start).end()
+            if pos == len(buf):
+                start = pos
+                break
+            char = buf[pos]
+            if char == ']' and (self._expectComma or not self._count):
+                self._closed = True
+                start = pos + 1
+            elif self._expectComma:
+                if char != ',':
+                    raise ValueError('Expecting , delimiter')
+                self._expectComma = False
+                start = pos + 1
+            else:
+                try:
+                    element, end = self._decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if final:
+                        raise
+                    # wait for the rest of the element
+                    break
+                if end == len(buf) and not final:
+                    # a number might not be finished yet
+                    break
+                elements.append(element)
+                self._count += 1
+                self._expectComma = True
+                start = end
+        if start:
+            self._buffer = buf[start:]
+        return elements
+
+
+
+class _ShedRequest(object):
+    """
+    A request body that is ignored and answered with L{Overloaded}, because
+    the interface was too busy when it started.
+
+    See L{JsonInterface.startStreaming}.
+    """
+
+    def __init__(self, write, response):
+        self._write = write
+        self._response = response
+
+
+    def dataReceived(self, data):
+        pass
+
+
+    def finish(self):
+        self._write(self._response)
+        return defer.succeed(None)
+
+
+
+class _StreamingRequest(object):
+    """
+    A JSON-RPC request body being received in chunks.  Requests in a batch
+    are run as soon as they have been parsed.
+
+    See L{JsonInterface.startStreaming}.
+    """
+
+    def __init__(self, interface, write):
+        self._interface = interface
+        self._write = write
+        self._writer = _ArrayWriter(write, interface._serialize)
+        self._decoder = _IncrementalDecoder()
+        self._semaphores = interface._batchSemaphores()
+        self._pending = []
+        self._count = 0
+        self._failed = False
+
+
+    def dataReceived(self, data):
+        """
+        Handle the next chunk of the body.
+        """
+        if self._failed:
+            return
+        try:
+            elements = self._decoder.feed(data)
+        except ValueError:
+            self._failed = True
+            return
+        for element in elements:
+            self._run(element)
+
+
+    def _run(self, data):
+        interface = self._interface
+        self._count += 1
+        maximum = interface._maxBatchSize
+        if maximum is not None and self._count > maximum:
+            response = interface._makeExpectedError(
+                InvalidRequest("batch too large"))
+        else:
+            response = interface._scheduleInBatch(data, self._semaphores)
+        if response is None:
+            return
+        elif isinstance(response, defer.Deferred):
+            self._pending.append(response.addCallback(
+                                 self._writer.writeElement))
+        else:
+            self._writer.writeElement(response)
+
+
+    def finish(self):
+        """
+        Handle the end of the body.
+
+        If the body turns out not to be valid JSON after some requests in a
+        batch have already been run, a L{ParseError} response is added to the
+        batch's responses.
+
+        @return: A C{Deferred} which fires with C{None} once the whole
+            response has been written.
+        """
+        interface = self._interface
+        if not self._failed:
+            try:
+                remaining = self._decoder.close()
+            except ValueError:
+                self._failed = True
+
+        if not self._decoder.isArray:
+            if self._failed:
+                response = interface._makeExpectedError(ParseError())
+            else:
+                response = interface._forkBatch(remaining)
+            d = defer.maybeDeferred(lambda: response)
+            d.addCallback(interface._serialize)
+            d.addCallback(self._write)
+            d.addCallback(lambda _: None)
+            return d
+
+        if self._failed:
+            self._writer.writeElement(
+                interface._makeExpectedError(ParseError()))
+        else:
+            for element in remaining:
+                self._run(element)
+            if not self._count:
+                self._write(interface._serialize(interface._forkBatch([])))
+
+        d = defer.gatherResults(self._pending)
+        d.addCallback(lambda _: self._writer.close())
+        return d
+
 
 
 class JsonInterface(object):
 
 
     def __init__(self, rpc, serialize=None, deserialize=None,
-                 logError=None):
+                 logError=None, maxBatchSize=None, batchConcurrency=None,
+                 concurrency=None, methodConcurrency=None, codec=None,
+                 observers=(), maxInFlight=None, maxQueueTime=None,
+                 timeout=None, clock=None, middleware=()):
         """
+        @param serialize: Function to turn responses into strings.  Overrides
+            C{codec}.
+
+        @param deserialize: Function to turn request strings into objects.
+            Overrides C{codec}.
+
         @param logError: Function that will be called with Failure instances
             when they happen.
+
+        @param maxBatchSize: The largest number of requests allowed in a
+            single batch.  Larger batches are rejected with L{InvalidRequest}.
+
+        @param batchConcurrency: The most requests from a single batch that
+            may run at once.  The rest wait their turn, so that a large batch
+            doesn't crowd out other requests waiting on C{concurrency}.
+
+        @param concurrency: The most requests that may run at once across all
+            calls to L{run}.
+
+        @param methodConcurrency: A dictionary of method name to the most
+            calls to that method that may run at once.
+
+        @param codec: A codec from L{crapc.codec} to (de)serialize with.
+            Defaults to L{crapc.codec.defaultCodec}, which uses the fastest
+            JSON library available.  L{runStreaming} and L{startStreaming}
+            only work with JSON codecs.
+
+        @param observers: Functions to call with the timings of each request
+            run by L{run} or L{runSync}.  See L{addObserver}.
+
+        @param maxInFlight: The most requests that may be running at once,
+            counting each request of a batch.  Requests beyond that are
+            answered with L{Overloaded}.  While it is reached, calls to
+            L{run}, L{runSync}, L{runStreaming}, L{startStreaming} and
+            L{runFile} are answered with L{Overloaded} right away, without
+            even parsing the request.
+
+        @param maxQueueTime: The most seconds a request may wait for
+            C{concurrency}, C{methodConcurrency} or C{batchConcurrency}.
+            Requests that waited longer are answered with L{Overloaded}
+            instead of being run.
+
+        @param timeout: The most seconds a request may run for.  When a
+            request's deadline passes, the C{Deferred} its procedure returned
+            is cancelled and it is answered with L{Timeout}.  A request may
+            ask for a shorter deadline with a C{"timeout"} member (in
+            seconds).
+
+        @param clock: An C{IReactorTime} provider used to time
+            C{maxQueueTime} and deadlines.  Defaults to the reactor.
+
+        @param middleware: Functions to run every request through, outermost
+            first.  See L{addMiddleware}.
         """
+        codec = codec or defaultCodec
         self.rpc = rpc
-        self._serialize = serialize or json.dumps
-        self._deserialize_fn = deserialize or json.loads
+        self._envelope = None
+        if serialize is None and isinstance(codec, JsonCodec):
+            self._envelope = _Envelope(codec.encode)
+            serialize = self._envelope.serialize
+        self._serialize = serialize or codec.encode
+        self._deserialize_fn = deserialize or codec.decode
         self._logError = logError or (lambda x:None)
+        self._observers = list(observers)
+        self._maxBatchSize = maxBatchSize
+        self._batchConcurrency = batchConcurrency
+        self._semaphore = None
+        if concurrency:
+            self._semaphore = defer.DeferredSemaphore(concurrency)
+        self._methodSemaphores = {}
+        for method, limit in (methodConcurrency or {}).items():
+            self._methodSemaphores[method] = defer.DeferredSemaphore(limit)
+        self._maxInFlight = maxInFlight
+        self._inFlight = 0
+        self._maxQueueTime = maxQueueTime
+        self._timeout = timeout
+        self._clock = clock
+        self._overloaded = None
+        if maxInFlight is not None:
+            self._overloaded = self._serialize(self._makeOverloaded(None))
+        self._middleware = []
+        self._chain = None
+        for func in middleware:
+            self.addMiddleware(func)
 
 
-    def _deserialize(self, json_string):
-        d = defer.maybeDeferred(self._deserialize_fn, json_string)
-        d.addErrback(lambda _: Failure(ParseError()))
-        return d
+    def _getClock(self):
+        if self._clock is None:
+            from twisted.internet import reactor
+            self._clock = reactor
+        return self._clock
 
 
     def _makeSuccess(self, result, request_id):
+        if self._envelope is not None:
+            return _Response(request_id, result)
         return {
             'jsonrpc': '2.0',
             'id': request_id,
@@ -63,88 +657,560 @@ class JsonInterface(object):
         }
 
 
-    def _makeErrorResponse(self, failure, request_id=None):
-        logging_message = ''
-        try:
-            self._logError(failure)
-        except:
-            logging_message = ' (Logging failed)'
-        exc = failure.value
-        code = getattr(exc, 'code', InternalError.code)
+    def _makeError(self, code, message, request_id):
+        if self._envelope is not None:
+            return _Response(request_id, code=code, message=message)
         return {
             'jsonrpc': '2.0',
             'id': request_id,
             'error': {
                 'code': code,
-                'message': '%s%s' % (exc.public_message, logging_message),
+                'message': message,
             },
         }
 
 
+    timer = time.time
+
+
+    def addObserver(self, observer):
+        """
+        Call C{observer} with a dictionary describing each request run by
+        L{run} or L{runSync}: its method, id, batch size, outcome and how long
+        parsing, executing and serializing took.  See L{_Observation} for the
+        keys.
+
+        Observers are called after the response has been serialized.
+        Exceptions raised by observers are ignored.  Timing is skipped
+        entirely while there are no observers.
+        """
+        self._observers.append(observer)
+
+
+    def removeObserver(self, observer):
+        """
+        Stop calling an observer added with L{addObserver}.
+        """
+        self._observers.remove(observer)
+
+
+    def addMiddleware(self, middleware):
+        """
+        Run every request through C{middleware} before it reaches C{rpc}.
+        See L{crapc.middleware}.
+
+        Middleware is called with the L{crapc._request.Request} after the
+        JSON-RPC envelope has been validated and its deadline set, in the
+        order it is added, the first added being outermost.
+
+        @param middleware: A function taking C{(next, request)}.
+        """
+        self._middleware.append(middleware)
+        self._chain = chain(self._middleware, self._callSystem)
+
+
+    def _callSystem(self, request):
+        if isinstance(self.rpc, _BoundRPC):
+            # run it without an extra Deferred, so that expected errors are
+            # raised rather than wrapped in a Failure
+            return self.rpc._runProcedure(request)
+        return self.rpc.runProcedure(request)
+
+
+    def _log(self, failure):
+        """
+        Log C{failure} with C{logError}.
+
+        @return: C{False} if logging failed, otherwise C{True}.
+        """
+        try:
+            self._logError(failure)
+        except:
+            return False
+        return True
+
+
+    def _makeErrorResponse(self, failure, request_id=None):
+        """
+        Make the response to a failure.  Unexpected failures (anything but an
+        L{error.RPCError}) are logged and reported as L{InternalError},
+        whatever attributes the exception has.
+        """
+        exc = failure.value
+        if isinstance(exc, error.RPCError):
+            return self._makeExpectedError(exc, request_id)
+        logging_message = ''
+        if not self._log(failure):
+            logging_message = ' (Logging failed)'
+        return self._makeError(InternalError.code, '%s%s' % (
+            InternalError.public_message, logging_message), request_id)
+
+
+    def _makeExpectedError(self, exc, request_id=None):
+        """
+        Make the response to an expected L{error.RPCError}, without wrapping
+        it in a C{Failure} or logging it.
+        """
+        exc = _expectedError(exc)
+        return self._makeError(exc.code, exc.public_message, request_id)
+
+
     def run(self, json_string):
-        d = self._deserialize(json_string)
-        d.addCallback(self._forkBatch)
-        d.addErrback(self._makeErrorResponse)
-        d.addCallback(self._serialize)
+        """
+        Run the JSON-RPC request (or batch of requests) in C{json_string}.
+
+        Notifications (requests without an C{id}) are run without waiting for
+        them to finish, and get no response.
+
+        Unless a custom C{deserialize} was given, C{json_string} may also be
+        a C{bytearray}, C{memoryview}, C{mmap} or file, which are decoded
+        without first being read into a string.
+
+        @return: A C{Deferred} which fires with the serialized response, or
+            with C{None} if there is nothing to respond with because only
+            notifications were sent.
+        """
+        return defer.maybeDeferred(self.runSync, json_string)
+
+
+    def runSync(self, json_string):
+        """
+        Like L{run}, but without going through C{Deferred}s unless a
+        procedure returns one.
+
+        @return: The serialized response (or C{None}) if every procedure
+            returned a plain value, otherwise a C{Deferred} which fires with
+            the serialized response (or C{None}).
+        """
+        if self._isFull():
+            return self._overloaded
+        return self._runSync(json_string)
+
+
+    def _isFull(self):
+        """
+        Return C{True} if C{maxInFlight} requests are already running.
+        """
+        return (self._maxInFlight is not None
+                and self._inFlight >= self._maxInFlight)
+
+
+    def _landed(self, result):
+        self._inFlight -= 1
+        return result
+
+
+    def _makeOverloaded(self, request_id):
+        """
+        Make the response to a request that was shed because of load.
+        """
+        return self._makeError(Overloaded.code, Overloaded.public_message,
+                               request_id)
+
+
+    def _runSync(self, json_string):
+        observation = None
+        if self._observers:
+            observation = _Observation(list(self._observers), self.timer)
+
+        try:
+            data = self._deserialize_fn(json_string)
+        except:
+            response = self._makeExpectedError(ParseError())
+        else:
+            if isinstance(data, defer.Deferred):
+                # asynchronous deserializer
+                response = data.addCallbacks(self._forkBatch,
+                                             self._parseFailed,
+                                             callbackArgs=(observation,))
+            else:
+                if observation is not None:
+                    observation.parsed(data)
+                response = self._forkBatch(data, observation)
+
+        if isinstance(response, defer.Deferred):
+            return response.addCallback(self._serializeResponse, observation)
+        return self._serializeResponse(response, observation)
+
+
+    def _serializeResponse(self, response, observation=None):
+        if observation is not None:
+            started = observation.timer()
+        serialized = None
+        if response is not None:
+            serialized = self._serialize(response)
+        if observation is not None:
+            observation.finish(response, observation.timer() - started)
+        return serialized
+
+
+    def runStreaming(self, json_string, write):
+        """
+        Like L{run}, but write the response with C{write} as it is produced.
+
+        The responses to a batch are written as the elements of a JSON array
+        in the order the requests finish, so a slow request doesn't hold up
+        the others and finished responses don't need to be kept around.
+
+        @param write: A function that will be called with each piece of the
+            serialized response, such as C{transport.write} or the C{extend}
+            method of a C{bytearray}.
+
+        @return: A C{Deferred} which fires with C{None} once the whole
+            response has been written.
+        """
+        if self._isFull():
+            write(self._overloaded)
+            return defer.succeed(None)
+        return self._runStreaming(json_string, write)
+
+
+    def _runStreaming(self, json_string, write):
+        try:
+            data = self._deserialize_fn(json_string)
+        except:
+            response = self._makeExpectedError(ParseError())
+        else:
+            if isinstance(data, defer.Deferred):
+                response = data.addCallbacks(self._forkBatch,
+                                             self._parseFailed)
+            elif self._isBatch(data):
+                return self._writeBatch(self._startBatch(data), write)
+            else:
+                response = self._forkBatch(data)
+
+        d = defer.maybeDeferred(lambda: response)
+        d.addCallback(self._writeResponse, write)
         return d
 
 
-    def _runSingleRequest(self, request):
+    def _writeResponse(self, response, write):
+        if response is not None:
+            write(self._serialize(response))
+
+
+    def startStreaming(self, write):
+        """
+        Start receiving a request body in chunks.  Requests in a batch are
+        run as soon as they have been parsed instead of after the whole body
+        has arrived, and responses are written as in L{runStreaming}.
+
+        The body is always parsed with the standard library's C{json} module,
+        whatever C{deserialize} function this interface was made with.
+
+        @param write: A function that will be called with each piece of the
+            serialized response.
+
+        @return: An object with a C{dataReceived} method to call with each
+            chunk of the body and a C{finish} method to call at the end of
+            the body.  C{finish} returns a C{Deferred} which fires with
+            C{None} once the whole response has been written.
+        """
+        if self._isFull():
+            return _ShedRequest(write, self._overloaded)
+        return _StreamingRequest(self, write)
+
+
+    def runFile(self, fileobj, write, chunkSize=65536):
+        """
+        Run the request body read in chunks from C{fileobj}.
+
+        See L{startStreaming}.
+
+        @return: A C{Deferred} which fires with C{None} once the whole
+            response has been written.
+        """
+        stream = self.startStreaming(write)
+        while True:
+            chunk = fileobj.read(chunkSize)
+            if not chunk:
+                break
+            stream.dataReceived(chunk)
+        return stream.finish()
+
+
+    def _writeBatch(self, responses, write):
         """
-        Run a single request.
+        Write each response in C{responses} as soon as it's available.
         """
-        d = defer.maybeDeferred(self._runDeserialized, request)
-        d.addErrback(self._makeErrorResponse)
+        writer = _ArrayWriter(write, self._serialize)
+        dlist = []
+        for response in responses:
+            if response is None:
+                continue
+            elif isinstance(response, defer.Deferred):
+                dlist.append(response.addCallback(writer.writeElement))
+            else:
+                writer.writeElement(response)
+        d = defer.gatherResults(dlist)
+        d.addCallback(lambda _: writer.close())
         return d
 
 
-    def _forkBatch(self, data):
+    def _isBatch(self, data):
+        """
+        Return C{True} if C{data} is a batch that should be run.
+        """
+        return bool(data and isinstance(data, list) and (
+            self._maxBatchSize is None or len(data) <= self._maxBatchSize))
+
+
+    def _parseFailed(self, failure):
+        return self._makeExpectedError(ParseError())
+
+
+    def _forkBatch(self, data, observation=None):
         """
         If data is a list, make several calls.  If it's a dict, just make one.
+
+        @return: The response (or list of responses, or C{None} if there
+            are only notifications) or a C{Deferred} which fires with it.
         """
         if isinstance(data, dict):
             # single
-            return self._runSingleRequest(data)
+            response = self._schedule(data, (), observation)
+            if isinstance(response, defer.Deferred) and self._isNotification(
+                    data):
+                return None
+            return response
         elif data and isinstance(data, list):
             # multiple
-            dlist = []
-            for item in data:
-                dlist.append(self._runSingleRequest(item))
-            return defer.gatherResults(dlist)
+            if (self._maxBatchSize is not None
+                    and len(data) > self._maxBatchSize):
+                return self._makeExpectedError(
+                    InvalidRequest("batch too large"))
+            responses = [x for x in self._startBatch(data, observation)
+                         if x is not None]
+            if not responses:
+                return None
+            for response in responses:
+                if isinstance(response, defer.Deferred):
+                    return defer.gatherResults([
+                        defer.succeed(x) if not isinstance(x, defer.Deferred)
+                        else x for x in responses])
+            return responses
         else:
             # no requests
-            raise InvalidRequest("empty request")
+            return self._makeExpectedError(InvalidRequest("empty request"))
 
 
-    def _runDeserialized(self, data):
+    def _startBatch(self, data, observation=None):
+        """
+        Schedule every request in a batch.
+
+        @return: A list of responses or C{Deferred}s which fire with them,
+            with C{None} in place of notifications.
+        """
+        semaphores = self._batchSemaphores()
+        return [self._scheduleInBatch(item, semaphores, observation)
+                for item in data]
+
+
+    def _scheduleInBatch(self, data, semaphores, observation=None):
+        """
+        Schedule a request in a batch without waiting for notifications.
+        """
+        response = self._schedule(data, semaphores, observation)
+        if isinstance(response, defer.Deferred) and self._isNotification(
+                data):
+            return None
+        return response
+
+
+    def _isNotification(self, data):
+        return isinstance(data, dict) and 'id' not in data
+
+
+    def _batchSemaphores(self):
+        """
+        Make the semaphores limiting the requests of a single batch.
+        """
+        if self._batchConcurrency:
+            return [defer.DeferredSemaphore(self._batchConcurrency)]
+        return []
+
+
+    def _schedule(self, data, semaphores=(), observation=None):
+        """
+        Run a single request as soon as the concurrency limits allow.
+
+        @param semaphores: C{DeferredSemaphore}s to acquire in addition to
+            the method-specific and global ones.
+
+        @param observation: The L{_Observation} to record the request in, if
+            there are observers.
+
+        @return: The response or a C{Deferred} which fires with the response.
+            For a notification, C{None} or a C{Deferred} which fires with
+            C{None} when it is done.
+        """
+        if observation is not None:
+            started = observation.timer()
+            return observation.record(data, started,
+                                      self._schedule(data, semaphores))
+
+        try:
+            self._validate(data)
+        except InvalidRequest as e:
+            request_id = None
+            if isinstance(data, dict):
+                request_id = data.get('id')
+            return self._makeExpectedError(e, request_id)
+
+        semaphores = list(semaphores)
+        if self._methodSemaphores:
+            try:
+                semaphore = self._methodSemaphores.get(data['method'])
+            except TypeError:
+                semaphore = None
+            if semaphore is not None:
+                semaphores.append(semaphore)
+        if self._semaphore is not None:
+            semaphores.append(self._semaphore)
+        queued = None
+        if semaphores and self._maxQueueTime is not None:
+            queued = self._getClock().seconds()
+        if self._maxInFlight is None:
+            return self._acquireAndRun(data, semaphores, queued)
+
+        if self._inFlight >= self._maxInFlight:
+            if 'id' not in data:
+                return None
+            return self._makeOverloaded(data['id'])
+        self._inFlight += 1
+        response = self._acquireAndRun(data, semaphores, queued)
+        if isinstance(response, defer.Deferred):
+            return response.addBoth(self._landed)
+        self._inFlight -= 1
+        return response
+
+
+    def _acquireAndRun(self, data, semaphores, queued=None):
+        """
+        Acquire each of C{semaphores} in order, then run the request.
+
+        @param queued: When the request started waiting, if it is subject to
+            C{maxQueueTime}.
+        """
+        if semaphores:
+            return semaphores[0].run(self._acquireAndRun, data,
+                                     semaphores[1:], queued)
+        if queued is not None \
+                and self._clock.seconds() - queued > self._maxQueueTime:
+            if 'id' not in data:
+                return None
+            return self._makeOverloaded(data['id'])
+        return self._runSingleRequest(data)
+
+
+    def _validate(self, data):
+        """
+        Check that C{data} is a JSON-RPC 2.0 request object.
+
+        @raise InvalidRequest: If it isn't.
+        """
+        if not isinstance(data, dict):
+            raise InvalidRequest('request is not an object')
+        if data.get('jsonrpc') != '2.0':
+            raise InvalidRequest('only jsonrpc 2.0 accepted')
+        if not isinstance(data.get('method'), (str, type(u''))):
+            raise InvalidRequest('method not provided')
+        timeout = data.get('timeout')
+        if timeout is not None and (isinstance(timeout, bool) or
+                                    not isinstance(timeout, (int, float))):
+            raise InvalidRequest('timeout must be a number')
+
+
+    def _runSingleRequest(self, data):
+        """
+        Run a single request that has been validated.
+
+        @return: The response or a C{Deferred} which fires with the response.
+            For a notification, C{None} or a C{Deferred} which fires with
+            C{None} when it is done.
+        """
+        if 'id' not in data:
+            return self._runNotification(data)
+
         request_id = data['id']
+        try:
+            result = self._runProcedure(data)
+        except error.RPCError as e:
+            return self._makeExpectedError(e, request_id)
+        except:
+            return self._makeErrorResponse(Failure(), request_id)
 
-        d = defer.maybeDeferred(self._runWithRequestID, data, request_id)
-        d.addCallback(self._makeSuccess, request_id)
-        d.addErrback(self._makeErrorResponse, request_id)
-        return d
+        if isinstance(result, defer.Deferred):
+            return result.addCallbacks(self._makeSuccess,
+                                       self._makeErrorResponse,
+                                       callbackArgs=(request_id,),
+                                       errbackArgs=(request_id,))
+        return self._makeSuccess(result, request_id)
 
 
-    def _runWithRequestID(self, data, request_id):
+    def _runNotification(self, data):
+        """
+        Run a notification.  Unexpected failures are logged but no response
+        is made.
+
+        @return: C{None} or a C{Deferred} which fires with C{None} when the
+            notification is done.
+        """
         try:
-            if data['jsonrpc'] != '2.0':
-                raise InvalidRequest('only jsonrpc 2.0 accepted')
+            result = self._runProcedure(data)
+        except error.RPCError:
+            return None
         except:
-            raise InvalidRequest('jsonrpc version not provided')
+            self._log(Failure())
+            return None
 
-        if 'method' not in data:
-            raise InvalidRequest('method not provided')
+        if isinstance(result, defer.Deferred):
+            return result.addCallbacks(lambda _: None, self._logUnexpected)
+        return None
 
-        req = Request(data['method'], data.get('params'))
 
-        d = defer.maybeDeferred(self.rpc.runProcedure, req)
-        d.addErrback(self._mapErrors)
+    def _logUnexpected(self, failure):
+        """
+        Log C{failure} unless it is an expected L{error.RPCError}.
+        """
+        if not failure.check(error.RPCError):
+            self._log(failure)
 
-        return d
 
+    def _runProcedure(self, data):
+        req = Request(data['method'], data.get('params'))
+        timeout = self._timeout
+        requested = data.get('timeout')
+        if requested is not None and (timeout is None or requested < timeout):
+            timeout = requested
+        if timeout is not None:
+            req.setDeadline(timeout, self._getClock().seconds)
 
-    def _mapErrors(self, failure):
-        if failure.check(error.MethodNotFound):
-            raise MethodNotFound()
-        raise InternalError(failure.value)
+        if self._chain is None:
+            result = self._callSystem(req)
+        else:
+            result = self._chain(req)
+        if isinstance(result, defer.Deferred) and req.deadline is not None:
+            self._cancelAtDeadline(result, req)
+        return result
+
+
+    def _cancelAtDeadline(self, d, request):
+        """
+        Cancel C{d} if it hasn't fired by the deadline of C{request}, and
+        make it fail with L{error.Timeout} if so.
+        """
+        expired = []
+        def expire():
+            expired.append(True)
+            d.cancel()
+        call = self._getClock().callLater(max(0, request.remaining()), expire)
+        def settle(result):
+            if call.active():
+                call.cancel()
+            if expired and isinstance(result, Failure) \
+                    and result.check(defer.CancelledError):
+                return Failure(error.Timeout(request.full_method))
+            return result
+        d.addBoth(settle)
 
@@ -0,0 +1,49 @@
+"""
+Middleware: functions which wrap the running of every request, for things
+like authentication, logging, rate limiting and metrics.
+
+A middleware is called with two arguments C{(next, request)}.  C{next} runs
+the rest of the chain (the remaining middleware, then the procedure) and
+returns its result, which is either a plain value or a C{Deferred}.  A
+middleware returns the result, possibly changed, or raises to refuse the
+request::
+
+    def requireUser(next, request):
+        if 'user' not in request.context:
+            raise error.MethodNotFound(request.full_method)
+        return next(request)
+
+Middleware which needs the final value of the result should use
+C{defer.maybeDeferred(next, request)}; middleware which doesn't should pass
+the result through untouched so that synchronous procedures stay
+synchronous.
+
+Middleware can be added to L{crapc.unit.RPCSystem.addMiddleware},
+L{crapc.unit.RPC.middleware} and L{crapc.jsonrpc.JsonInterface}.
+"""
+
+__all__ = ['chain']
+
+
+from functools import partial
+
+
+
+def chain(middleware, handler):
+    """
+    Compile a list of middleware into a single function.
+
+    The first middleware is outermost: it is called first and its C{next}
+    calls the second, and so on.  The last one's C{next} is C{handler}.
+    Calling the chain makes one function call per middleware and no
+    C{Deferred}s of its own.
+
+    @param middleware: A list of middleware functions.
+    @param handler: The function, taking a request, that runs the procedure.
+
+    @return: A function taking a request.  If C{middleware} is empty, this
+        is C{handler} itself.
+    """
+    for func in reversed(middleware):
+        handler = partial(func, handler)
+    return handler
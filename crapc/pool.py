@@ -0,0 +1,304 @@
+__all__ = ['ProcessPool', 'ThreadPool', 'blocking']
+
+
+import sys
+import signal
+import multiprocessing
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from twisted.internet import defer
+from twisted.python import threadpool
+from twisted.python.failure import Failure
+
+from crapc.error import Overloaded, Timeout
+
+
+# Python 2's Pool.apply_async has no error_callback
+_hasErrorCallback = sys.version_info >= (3,)
+
+
+
+def blocking(func):
+    """
+    Mark a method as blocking, so that L{crapc.helper.RPCFromObject} runs it
+    in its thread pool (or in a shared L{ThreadPool} of 10 threads if it
+    wasn't given one).
+    """
+    func.blocking = True
+    return func
+
+
+
+def _initWorker():
+    """
+    Set up a worker process.  Workers forked from a process running a
+    reactor inherit its SIGTERM handler, so restore the default to let the
+    pool terminate them.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+
+def _invoke(payload):
+    """
+    Run a pickled call in a worker process.
+
+    @param payload: A pickled C{(func, args, kwargs)} tuple.
+
+    @return: A pickled C{(True, result)} or C{(False, exception)} tuple.
+    """
+    try:
+        func, args, kwargs = pickle.loads(payload)
+        outcome = (True, func(*args, **kwargs))
+    except BaseException as e:
+        # including SystemExit, which would otherwise lose the call
+        outcome = (False, e)
+    try:
+        return pickle.dumps(outcome, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        return pickle.dumps((False, RuntimeError(
+            'Could not pickle the outcome of %r: %s' % (func, e))),
+            pickle.HIGHEST_PROTOCOL)
+
+
+
+class ProcessPool(object):
+    """
+    Runs functions in a pool of worker processes, so that CPU-bound
+    procedures don't block the reactor.
+
+    Functions, arguments and results are pickled once each, so they must be
+    picklable and functions must be importable by the workers (for instance,
+    defined at the top level of a module).
+
+    The pool is started when it is first used and stopped when the reactor
+    shuts down.
+
+    A call whose worker process dies never gets a result, so give a
+    C{timeout} (or cancel the C{Deferred}, as request deadlines do) unless
+    the functions can be trusted not to kill their worker.
+
+    Pass it as C{pool} to L{crapc.unit.RPCSystem.addFunction}.
+    """
+
+
+    def __init__(self, size=None, reactor=None, timeout=None):
+        """
+        @param size: The number of worker processes.  Defaults to the number
+            of CPUs.
+        @param reactor: The reactor to deliver results with.
+        @param timeout: Seconds after which calls that haven't finished fail
+            with L{crapc.error.Timeout}, or C{None} to wait for ever.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.size = size
+        self.timeout = timeout
+        self._reactor = reactor
+        self._pool = None
+        self._trigger = None
+        self._abandoned = False
+
+
+    def start(self):
+        """
+        Start the worker processes if they aren't running.
+        """
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.size, _initWorker)
+            self._trigger = self._reactor.addSystemEventTrigger(
+                'during', 'shutdown', self.stop)
+
+
+    def stop(self):
+        """
+        Stop the worker processes after they finish the calls already made.
+
+        If a call has timed out, its worker may be gone and the call would
+        never finish, so the workers are terminated instead.
+        """
+        if self._pool is None:
+            return
+        pool, self._pool = self._pool, None
+        try:
+            self._reactor.removeSystemEventTrigger(self._trigger)
+        except (KeyError, ValueError, TypeError):
+            # already shutting down
+            pass
+        if self._abandoned:
+            self._abandoned = False
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+
+
+    def run(self, func, *args, **kwargs):
+        """
+        Call C{func} with C{args} and C{kwargs} in a worker process.
+
+        @return: A C{Deferred} which fires with the result of C{func}, or
+            fails with the exception it raised, or with
+            L{crapc.error.Timeout} after C{timeout} seconds.
+        """
+        try:
+            payload = pickle.dumps((func, args, kwargs),
+                                   pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return defer.fail()
+        self.start()
+        d = defer.Deferred()
+        def done(outcome):
+            self._reactor.callFromThread(self._finished, d, outcome)
+        extra = {}
+        if _hasErrorCallback:
+            def failed(exception):
+                self._reactor.callFromThread(self._failed, d, exception)
+            extra['error_callback'] = failed
+        self._pool.apply_async(_invoke, (payload,), callback=done, **extra)
+        if self.timeout is not None:
+            call = self._reactor.callLater(self.timeout, self._timedOut, d)
+            def settle(result):
+                if call.active():
+                    call.cancel()
+                return result
+            d.addBoth(settle)
+        return d
+
+
+    def _finished(self, d, outcome):
+        if d.called:
+            # cancelled or timed out
+            return
+        try:
+            ok, value = pickle.loads(outcome)
+        except Exception:
+            d.errback()
+            return
+        if ok:
+            d.callback(value)
+        else:
+            d.errback(Failure(value))
+
+
+    def _failed(self, d, exception):
+        if not d.called:
+            d.errback(Failure(exception))
+
+
+    def _timedOut(self, d):
+        self._abandoned = True
+        d.errback(Timeout('process pool call took too long'))
+
+
+
+class ThreadPool(object):
+    """
+    Runs blocking functions in a bounded pool of threads, so that they don't
+    block the reactor.
+
+    The pool is started when it is first used and stopped when the reactor
+    shuts down.
+
+    Pass it as C{pool} to L{crapc.unit.RPCSystem.addFunction} or
+    L{crapc.helper.RPCFromObject}.
+    """
+
+
+    def __init__(self, maxThreads=10, maxQueued=None, name=None,
+                 reactor=None):
+        """
+        @param maxThreads: The most threads to run at once.
+        @param maxQueued: The most calls allowed to wait for a free thread.
+            Calls beyond that fail with L{crapc.error.Overloaded}.  C{None}
+            means there is no limit.
+        @param name: A name for the threads, to help debugging.
+        @param reactor: The reactor to deliver results with.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.maxThreads = maxThreads
+        self.maxQueued = maxQueued
+        self.name = name
+        self._reactor = reactor
+        self._pool = None
+        self._trigger = None
+        self._pending = 0
+
+
+    def start(self):
+        """
+        Start the thread pool if it isn't running.
+        """
+        if self._pool is None:
+            self._pool = threadpool.ThreadPool(0, self.maxThreads, self.name)
+            self._pool.start()
+            self._trigger = self._reactor.addSystemEventTrigger(
+                'during', 'shutdown', self.stop)
+
+
+    def stop(self):
+        """
+        Stop the threads after they finish the calls already made.
+        """
+        if self._pool is None:
+            return
+        pool, self._pool = self._pool, None
+        try:
+            self._reactor.removeSystemEventTrigger(self._trigger)
+        except (KeyError, ValueError, TypeError):
+            # already shutting down
+            pass
+        pool.stop()
+
+
+    def run(self, func, *args, **kwargs):
+        """
+        Call C{func} with C{args} and C{kwargs} in a thread.
+
+        @return: A C{Deferred} which fires with the result of C{func}, or
+            fails with the exception it raised.  If too many calls are
+            already waiting for a thread, it fails with
+            L{crapc.error.Overloaded}.  Cancelling it doesn't stop the
+            thread, and the call counts against C{maxQueued} until the
+            thread is done.
+        """
+        if (self.maxQueued is not None
+                and self._pending >= self.maxThreads + self.maxQueued):
+            return defer.fail(Overloaded('thread pool queue is full'))
+        self.start()
+        self._pending += 1
+        d = defer.Deferred()
+        def done(success, result):
+            self._reactor.callFromThread(self._finished, d, success, result)
+        self._pool.callInThreadWithCallback(done, func, *args, **kwargs)
+        return d
+
+
+    def _finished(self, d, success, result):
+        self._pending -= 1
+        if d.called:
+            # cancelled
+            return
+        if success:
+            d.callback(result)
+        else:
+            d.errback(result)
+
+
+
+_default = None
+
+def _defaultThreadPool():
+    """
+    Get the L{ThreadPool} that blocking methods are run in when no pool is
+    given, making it the first time.
+    """
+    global _default
+    if _default is None:
+        _default = ThreadPool(name='crapc')
+    return _default
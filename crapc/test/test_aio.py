@@ -0,0 +1,146 @@
+from twisted.trial.unittest import TestCase
+
+import json
+
+from crapc.unit import RPCSystem
+from crapc.jsonrpc import MethodNotFound, InternalError, ParseError, Timeout
+from crapc import error
+from crapc.test.test_jsonrpc import mkRequest, mkNotification
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+else:
+    from crapc.aio import AsyncioJsonInterface
+
+
+
+class AsyncioJsonInterfaceTest(TestCase):
+
+    if asyncio is None:
+        skip = 'asyncio is not available'
+
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.rpc = RPCSystem()
+        self.rpc.addFunction('add', lambda a, b: a + b)
+        self.rpc.addFunction('later', self.later)
+        self.logged = []
+        self.interface = AsyncioJsonInterface(self.rpc,
+                                              logError=self.logged.append,
+                                              loop=self.loop)
+
+
+    def later(self, value, delay=0):
+        """
+        Return a future which resolves to C{value} after C{delay}
+        seconds.
+        """
+        future = self.loop.create_future()
+        self.loop.call_later(delay, future.set_result, value)
+        return future
+
+
+    def respond(self, data):
+        result = self.loop.run_until_complete(
+            self.interface.run(json.dumps(data)))
+        if result is not None:
+            result = json.loads(result.decode('utf-8'))
+        return result
+
+
+    def test_plain(self):
+        """
+        Procedures that return plain values are answered without making a
+        future.
+        """
+        result = self.interface.runSync(json.dumps(mkRequest('add', [1, 2],
+                                                             id=1)))
+        self.assertEqual(json.loads(result.decode('utf-8'))['result'], 3)
+
+
+    def test_awaitable(self):
+        """
+        Procedures may return awaitables.
+        """
+        response = self.respond(mkRequest('later', ['hi'], id=1))
+        self.assertEqual(response, {'jsonrpc': '2.0', 'id': 1,
+                                    'result': 'hi'})
+
+
+    def test_batch(self):
+        """
+        The requests of a batch run concurrently and their responses are in
+        the order of the requests.
+        """
+        response = self.respond([
+            mkRequest('later', ['slow', 0.05], id=1),
+            mkRequest('later', ['fast'], id=2),
+            mkRequest('add', [1, 2], id=3),
+            mkNotification('later', ['note']),
+        ])
+        self.assertEqual([r['result'] for r in response],
+                         ['slow', 'fast', 3])
+
+
+    def test_notifications(self):
+        """
+        Notifications get no response.
+        """
+        self.assertEqual(self.respond(mkNotification('later', ['x'])), None)
+
+
+    def test_errors(self):
+        """
+        Errors are mapped to JSON-RPC errors, and unexpected ones are logged.
+        """
+        def fail():
+            future = self.loop.create_future()
+            future.set_exception(ValueError('oops'))
+            return future
+        self.rpc.addFunction('fail', fail)
+        response = self.respond([
+            mkRequest('fail', id=1),
+            mkRequest('missing', id=2),
+        ])
+        self.assertEqual([r['error']['code'] for r in response],
+                         [InternalError.code, MethodNotFound.code])
+        self.assertEqual(len(self.logged), 1)
+        self.assertIsInstance(self.logged[0], ValueError)
+
+
+    def test_expectedErrors(self):
+        """
+        Expected errors are reported like L{crapc.jsonrpc.JsonInterface}
+        does, without being logged, including from notifications.
+        """
+        def rpcError():
+            raise error.RPCError()
+        def timeout():
+            future = self.loop.create_future()
+            future.set_exception(error.Timeout('slow'))
+            return future
+        self.rpc.addFunction('rpcError', rpcError)
+        self.rpc.addFunction('timeout', timeout)
+        response = self.respond([
+            mkRequest('rpcError', id=1),
+            mkRequest('timeout', id=2),
+            mkNotification('missing'),
+            mkNotification('timeout'),
+        ])
+        self.assertEqual([r['error']['code'] for r in response],
+                         [InternalError.code, Timeout.code])
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(self.logged, [])
+
+
+    def test_ParseError(self):
+        """
+        Requests that can't be parsed get a ParseError.
+        """
+        result = self.loop.run_until_complete(self.interface.run('{'))
+        response = json.loads(result.decode('utf-8'))
+        self.assertEqual(response['error']['code'], ParseError.code)
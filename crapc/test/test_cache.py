@@ -0,0 +1,296 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, task
+
+from zope.interface.verify import verifyObject
+
+from crapc.cache import ResultCache, SingleFlight, SingleFlightSystem
+from crapc.cache import requestKey
+from crapc.interface import ISystem
+from crapc._request import Request
+from crapc.unit import RPCSystem
+
+
+
+class RequestKeyTest(TestCase):
+
+
+    def test_equal(self):
+        """
+        Requests for the same method and params have the same key, whatever
+        the order of the keyword params.
+        """
+        a = Request('foo.bar', {'a': 1, 'b': [1, {'c': 2}]})
+        b = Request('foo.bar', {'b': [1, {'c': 2}], 'a': 1})
+        self.assertEqual(requestKey(a), requestKey(b))
+        a.child()
+        self.assertEqual(requestKey(a), requestKey(b), "Should use the full "
+                         "method")
+
+
+    def test_different(self):
+        """
+        Different methods or params have different keys.
+        """
+        keys = [
+            requestKey(Request('foo', [1])),
+            requestKey(Request('bar', [1])),
+            requestKey(Request('foo', [True])),
+            requestKey(Request('foo', [1.0])),
+            requestKey(Request('foo', ['1'])),
+            requestKey(Request('foo', [['a', 1]])),
+            requestKey(Request('foo', {'a': 1})),
+            requestKey(Request('foo', [1]), 'extra'),
+        ]
+        self.assertEqual(len(set(keys)), len(keys))
+
+
+
+class SingleFlightTest(TestCase):
+
+
+    def setUp(self):
+        self.calls = []
+        self.flight = SingleFlight()
+
+
+    def func(self, value):
+        self.calls.append(value)
+        return value
+
+
+    def test_deferred(self):
+        """
+        Calls made while one with the same key is in flight share its result.
+        """
+        pending = defer.Deferred()
+        d1 = self.flight.call('a', self.func, pending)
+        d2 = self.flight.call('a', self.func, 'not called')
+        other = self.flight.call('b', self.func, 'other')
+        self.assertEqual(self.calls, [pending, 'other'])
+        self.assertEqual(other, 'other')
+
+        pending.callback('result')
+        self.assertEqual(self.successResultOf(d1), 'result')
+        self.assertEqual(self.successResultOf(d2), 'result')
+
+
+    def test_notCached(self):
+        """
+        Nothing is kept once the call is done.
+        """
+        self.flight.call('a', self.func, 1)
+        self.flight.call('a', self.func, 2)
+        pending = defer.succeed('done')
+        self.flight.call('a', self.func, pending)
+        self.flight.call('a', self.func, 3)
+        self.assertEqual(self.calls, [1, 2, pending, 3])
+
+
+    def test_failure(self):
+        """
+        Failures are passed to every waiting call.
+        """
+        pending = defer.Deferred()
+        d1 = self.flight.call('a', self.func, pending)
+        d2 = self.flight.call('a', self.func, pending)
+        pending.errback(ValueError())
+        self.failureResultOf(d1, ValueError)
+        self.failureResultOf(d2, ValueError)
+
+
+    def test_cancel(self):
+        """
+        Cancelling one call doesn't affect the others sharing its result.
+        The shared call is only cancelled once every call has been.
+        """
+        cancelled = []
+        pending = defer.Deferred(cancelled.append)
+        d1 = self.flight.call('a', self.func, pending)
+        d2 = self.flight.call('a', self.func, pending)
+        d3 = self.flight.call('a', self.func, pending)
+        d1.cancel()
+        self.failureResultOf(d1, defer.CancelledError)
+        d3.cancel()
+        self.failureResultOf(d3, defer.CancelledError)
+        self.assertEqual(cancelled, [])
+        self.assertNoResult(d2)
+
+        d2.cancel()
+        self.assertEqual(cancelled, [pending])
+        self.failureResultOf(d2, defer.CancelledError)
+        self.flight.call('a', self.func, 'again')
+        self.assertEqual(self.calls, [pending, 'again'])
+
+
+    def test_cancelWhileSettling(self):
+        """
+        A call may be cancelled by another call's callbacks while the result
+        is being passed out.
+        """
+        pending = defer.Deferred()
+        d1 = self.flight.call('a', self.func, pending)
+        d2 = self.flight.call('a', self.func, pending)
+        d1.addCallback(lambda _: d2.cancel())
+        pending.callback('result')
+        self.successResultOf(d1)
+        self.failureResultOf(d2, defer.CancelledError)
+
+
+
+class SingleFlightSystemTest(TestCase):
+
+
+    def test_ISystem(self):
+        verifyObject(ISystem, SingleFlightSystem(RPCSystem()))
+
+
+    def test_coalesce(self):
+        """
+        Identical concurrent requests share one call to the wrapped system.
+        """
+        pending = []
+        def slow(x):
+            pending.append(defer.Deferred())
+            return pending[-1]
+        system = RPCSystem()
+        system.addFunction('slow', slow)
+        wrapped = SingleFlightSystem(system)
+
+        d1 = wrapped.runProcedure(Request('slow', [1]))
+        d2 = wrapped.runProcedure(Request('slow', [1]))
+        d3 = wrapped.runProcedure(Request('slow', [2]))
+        self.assertEqual(len(pending), 2)
+
+        pending[0].callback('one')
+        pending[1].callback('two')
+        self.assertEqual(self.successResultOf(d1), 'one')
+        self.assertEqual(self.successResultOf(d2), 'one')
+        self.assertEqual(self.successResultOf(d3), 'two')
+
+        wrapped.runProcedure(Request('slow', [1]))
+        self.assertEqual(len(pending), 3, "Should not keep results")
+
+
+
+class ResultCacheTest(TestCase):
+
+
+    def setUp(self):
+        self.calls = []
+
+
+    def func(self, value):
+        self.calls.append(value)
+        return value
+
+
+    def test_cached(self):
+        """
+        Results are only computed once per key.
+        """
+        cache = ResultCache()
+        self.assertEqual(cache.call('a', self.func, 1), 1)
+        self.assertEqual(cache.call('a', self.func, 2), 1)
+        self.assertEqual(cache.call('b', self.func, 3), 3)
+        self.assertEqual(self.calls, [1, 3])
+
+
+    def test_noKey(self):
+        """
+        A key of None isn't cached.
+        """
+        cache = ResultCache()
+        cache.call(None, self.func, 1)
+        cache.call(None, self.func, 1)
+        self.assertEqual(self.calls, [1, 1])
+
+
+    def test_lru(self):
+        """
+        The least recently used results are evicted once full.
+        """
+        cache = ResultCache(maxSize=2)
+        cache.call('a', self.func, 'a')
+        cache.call('b', self.func, 'b')
+        cache.call('a', self.func, 'a')
+        cache.call('c', self.func, 'c')
+        cache.call('a', self.func, 'a')
+        cache.call('b', self.func, 'b')
+        self.assertEqual(self.calls, ['a', 'b', 'c', 'b'])
+
+
+    def test_ttl(self):
+        """
+        Results expire after ttl seconds.
+        """
+        clock = task.Clock()
+        cache = ResultCache(ttl=10, clock=clock)
+        cache.call('a', self.func, 1)
+        clock.advance(9)
+        cache.call('a', self.func, 1)
+        clock.advance(1)
+        cache.call('a', self.func, 1)
+        self.assertEqual(self.calls, [1, 1])
+
+
+    def test_errors(self):
+        """
+        Exceptions aren't cached.
+        """
+        cache = ResultCache()
+        def fail():
+            self.calls.append('fail')
+            raise ValueError()
+        self.assertRaises(ValueError, cache.call, 'a', fail)
+        self.assertRaises(ValueError, cache.call, 'a', fail)
+        self.assertEqual(self.calls, ['fail', 'fail'])
+
+
+    def test_deferred(self):
+        """
+        Calls made while a Deferred result is pending wait for it instead of
+        calling the function again, and the result is cached.
+        """
+        cache = ResultCache()
+        pending = defer.Deferred()
+        d1 = cache.call('a', self.func, pending)
+        d2 = cache.call('a', self.func, pending)
+        self.assertEqual(len(self.calls), 1)
+        self.assertNoResult(d1)
+        self.assertNoResult(d2)
+
+        pending.callback('result')
+        self.assertEqual(self.successResultOf(d1), 'result')
+        self.assertEqual(self.successResultOf(d2), 'result')
+        self.assertEqual(cache.call('a', self.func, None), 'result')
+        self.assertEqual(len(self.calls), 1)
+
+
+    def test_deferredFailure(self):
+        """
+        Failures are passed to every waiting call but not cached.
+        """
+        cache = ResultCache()
+        pending = defer.Deferred()
+        d1 = cache.call('a', self.func, pending)
+        d2 = cache.call('a', self.func, pending)
+        pending.errback(ValueError())
+        self.failureResultOf(d1, ValueError)
+        self.failureResultOf(d2, ValueError)
+        cache.call('a', self.func, 'again')
+        self.assertEqual(self.calls[1:], ['again'])
+
+
+    def test_invalidate(self):
+        """
+        You can forget one or all results.
+        """
+        cache = ResultCache()
+        cache.call('a', self.func, 1)
+        cache.call('b', self.func, 2)
+        cache.invalidate('a')
+        cache.call('a', self.func, 1)
+        cache.call('b', self.func, 2)
+        cache.invalidate()
+        cache.call('b', self.func, 2)
+        self.assertEqual(self.calls, [1, 2, 1, 2])
@@ -0,0 +1,304 @@
+from twisted.trial.unittest import TestCase
+from twisted.test.proto_helpers import StringTransport
+from twisted.internet import defer, task
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+
+import json
+
+from crapc.client import JsonRpcClient
+from crapc.jsonrpc import JsonInterface, MethodNotFound, JsonRPCError
+from crapc.jsonrpc import InvalidRequest, Overloaded
+from crapc.transport import serve
+from crapc.unit import RPCSystem
+
+
+
+class FakeEndpoint(object):
+    """
+    An endpoint that connects protocols to L{StringTransport}s.
+    """
+
+    def __init__(self):
+        self.connections = []
+        self.pending = None
+
+
+    def connect(self, factory):
+        proto = factory.buildProtocol(None)
+        transport = StringTransport()
+        self.connections.append((proto, transport))
+        if self.pending is not None:
+            d = self.pending = defer.Deferred()
+            def connected(_):
+                proto.makeConnection(transport)
+                return proto
+            return d.addCallback(connected)
+        proto.makeConnection(transport)
+        return defer.succeed(proto)
+
+
+
+def sent(transport):
+    """
+    Get the requests written to a transport and clear it.
+    """
+    lines = transport.value().splitlines()
+    transport.clear()
+    return [json.loads(line.decode('utf-8')) for line in lines]
+
+
+
+def respond(proto, response):
+    proto.dataReceived(json.dumps(response).encode('utf-8') + b'\n')
+
+
+
+class JsonRpcClientTest(TestCase):
+
+
+    def setUp(self):
+        self.endpoint = FakeEndpoint()
+        self.clock = task.Clock()
+
+
+    def test_call(self):
+        """
+        Calls are sent as requests and fire with the result of the matching
+        response.
+        """
+        client = JsonRpcClient(self.endpoint, reactor=self.clock)
+        d = client.call('add', 1, 2)
+        proto, transport = self.endpoint.connections[0]
+        request, = sent(transport)
+        self.assertEqual(request['method'], 'add')
+        self.assertEqual(request['params'], [1, 2])
+        self.assertNoResult(d)
+        respond(proto, {'jsonrpc': '2.0', 'id': request['id'], 'result': 3})
+        self.assertEqual(self.successResultOf(d), 3)
+
+
+    def test_pipelined(self):
+        """
+        Calls are sent without waiting for earlier responses, and responses
+        are matched by id.
+        """
+        client = JsonRpcClient(self.endpoint, reactor=self.clock)
+        d1 = client.call('echo', 'a')
+        d2 = client.call('echo', kwarg='b')
+        proto, transport = self.endpoint.connections[0]
+        r1, r2 = sent(transport)
+        self.assertEqual(r2['params'], {'kwarg': 'b'})
+        respond(proto, {'jsonrpc': '2.0', 'id': r2['id'], 'result': 'b'})
+        self.assertNoResult(d1)
+        self.assertEqual(self.successResultOf(d2), 'b')
+        respond(proto, {'jsonrpc': '2.0', 'id': r1['id'], 'result': 'a'})
+        self.assertEqual(self.successResultOf(d1), 'a')
+
+
+    def test_errors(self):
+        """
+        Error responses fail the call with the matching exception.
+        """
+        client = JsonRpcClient(self.endpoint, reactor=self.clock)
+        d1 = client.call('missing')
+        d2 = client.call('custom')
+        proto, transport = self.endpoint.connections[0]
+        r1, r2 = sent(transport)
+        respond(proto, [
+            {'jsonrpc': '2.0', 'id': r1['id'],
+             'error': {'code': -32601, 'message': 'Method not found'}},
+            {'jsonrpc': '2.0', 'id': r2['id'],
+             'error': {'code': 12, 'message': 'Custom', 'data': 'x'}},
+        ])
+        self.failureResultOf(d1, MethodNotFound)
+        exc = self.failureResultOf(d2, JsonRPCError).value
+        self.assertEqual((exc.code, exc.data), (12, 'x'))
+
+
+    def test_nullId(self):
+        """
+        An error with a null id fails every call in the payloads sent since
+        the last one to get a response.
+        """
+        client = JsonRpcClient(self.endpoint, batchWindow=0.01,
+                               reactor=self.clock)
+        first = client.call('echo', 'a')
+        self.clock.advance(0.01)
+        second = [client.call('echo', 'b'), client.call('echo', 'c')]
+        self.clock.advance(0.01)
+        third = client.call('echo', 'd')
+        self.clock.advance(0.01)
+        proto, transport = self.endpoint.connections[0]
+        r1, batch, r3 = sent(transport)
+
+        respond(proto, {'jsonrpc': '2.0', 'id': r1['id'], 'result': 'a'})
+        respond(proto, {'jsonrpc': '2.0', 'id': None,
+                        'error': {'code': -32600, 'message': 'Invalid'}})
+        self.assertEqual(self.successResultOf(first), 'a')
+        for d in second + [third]:
+            self.failureResultOf(d, InvalidRequest)
+        self.assertEqual(proto.waiting, {})
+        self.assertEqual(len(proto.sent), 0)
+
+
+    def test_notify(self):
+        """
+        Notifications are sent without an id.
+        """
+        client = JsonRpcClient(self.endpoint, reactor=self.clock)
+        client.notify('log', 'hi')
+        request, = sent(self.endpoint.connections[0][1])
+        self.assertNotIn('id', request)
+
+
+    def test_batchWindow(self):
+        """
+        Calls made within the batch window are sent as one batch.
+        """
+        client = JsonRpcClient(self.endpoint, batchWindow=0.01,
+                               reactor=self.clock)
+        d1 = client.call('echo', 'a')
+        d2 = client.call('echo', 'b')
+        self.assertEqual(self.endpoint.connections, [])
+        self.clock.advance(0.01)
+        proto, transport = self.endpoint.connections[0]
+        batch, = sent(transport)
+        self.assertEqual([r['params'] for r in batch], [['a'], ['b']])
+        respond(proto, [
+            {'jsonrpc': '2.0', 'id': r['id'], 'result': r['params'][0]}
+            for r in batch])
+        self.assertEqual(self.successResultOf(d1), 'a')
+        self.assertEqual(self.successResultOf(d2), 'b')
+
+
+    def test_maxBatchSize(self):
+        """
+        A full batch is sent right away.
+        """
+        client = JsonRpcClient(self.endpoint, batchWindow=10,
+                               maxBatchSize=2, reactor=self.clock)
+        client.call('echo', 'a')
+        client.call('echo', 'b')
+        batch, = sent(self.endpoint.connections[0][1])
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_pool(self):
+        """
+        New connections are opened while the others are busy, up to the size
+        of the pool.
+        """
+        client = JsonRpcClient(self.endpoint, poolSize=2, reactor=self.clock)
+        client.call('echo', 'a')
+        client.call('echo', 'b')
+        client.call('echo', 'c')
+        self.assertEqual(len(self.endpoint.connections), 2)
+        self.assertEqual([len(sent(t)) for p, t in self.endpoint.connections],
+                         [2, 1])
+
+
+    def test_poolIdle(self):
+        """
+        Idle connections are reused.
+        """
+        client = JsonRpcClient(self.endpoint, poolSize=2, reactor=self.clock)
+        client.call('echo', 'a')
+        proto, transport = self.endpoint.connections[0]
+        request, = sent(transport)
+        respond(proto, {'jsonrpc': '2.0', 'id': request['id'], 'result': 1})
+        client.call('echo', 'b')
+        self.assertEqual(len(self.endpoint.connections), 1)
+
+
+    def test_waitForConnection(self):
+        """
+        Calls made while the pool is full of connections still being made
+        wait for one of them.
+        """
+        self.endpoint.pending = True
+        client = JsonRpcClient(self.endpoint, reactor=self.clock)
+        client.call('echo', 'a')
+        client.call('echo', 'b')
+        self.assertEqual(len(self.endpoint.connections), 1)
+        self.endpoint.pending.callback(None)
+        self.assertEqual(len(sent(self.endpoint.connections[0][1])), 2)
+
+
+    def test_connectionLost(self):
+        """
+        Calls waiting on a connection that is lost fail, and the connection
+        isn't used again.
+        """
+        client = JsonRpcClient(self.endpoint, reactor=self.clock)
+        d = client.call('echo', 'a')
+        proto, transport = self.endpoint.connections[0]
+        proto.connectionLost(Failure(ConnectionDone()))
+        self.failureResultOf(d, ConnectionDone)
+        client.call('echo', 'b')
+        self.assertEqual(len(self.endpoint.connections), 2)
+
+
+
+class ServerTest(TestCase):
+
+
+    @defer.inlineCallbacks
+    def test_roundTrip(self):
+        """
+        The client works with a server made by L{serve}.
+        """
+        rpc = RPCSystem()
+        rpc.addFunction('add', lambda a, b: a + b)
+        for framing in ['line', 'length']:
+            port = yield serve(JsonInterface(rpc),
+                               'tcp:0:interface=127.0.0.1', framing)
+            self.addCleanup(port.stopListening)
+            client = JsonRpcClient('tcp:127.0.0.1:%d' % (port.getHost().port,),
+                                   batchWindow=0, framing=framing)
+            self.addCleanup(client.close)
+            results = yield defer.gatherResults([client.call('add', i, 1)
+                                                 for i in range(5)])
+            self.assertEqual(results, [1, 2, 3, 4, 5])
+            yield self.assertFailure(client.call('missing'), MethodNotFound)
+
+
+    @defer.inlineCallbacks
+    def test_batchTooLarge(self):
+        """
+        Calls in a batch larger than the server allows fail instead of
+        waiting forever.
+        """
+        rpc = RPCSystem()
+        rpc.addFunction('add', lambda a, b: a + b)
+        port = yield serve(JsonInterface(rpc, maxBatchSize=2),
+                           'tcp:0:interface=127.0.0.1')
+        self.addCleanup(port.stopListening)
+        client = JsonRpcClient('tcp:127.0.0.1:%d' % (port.getHost().port,),
+                               batchWindow=0)
+        self.addCleanup(client.close)
+        calls = [self.assertFailure(client.call('add', i, 1), InvalidRequest)
+                 for i in range(3)]
+        yield defer.gatherResults(calls)
+
+
+    @defer.inlineCallbacks
+    def test_overloaded(self):
+        """
+        Calls shed by an overloaded server fail with Overloaded.
+        """
+        waiting = defer.Deferred()
+        rpc = RPCSystem()
+        rpc.addFunction('wait', lambda: waiting)
+        port = yield serve(JsonInterface(rpc, maxInFlight=1),
+                           'tcp:0:interface=127.0.0.1')
+        self.addCleanup(port.stopListening)
+        client = JsonRpcClient('tcp:127.0.0.1:%d' % (port.getHost().port,),
+                               poolSize=2)
+        self.addCleanup(client.close)
+        first = client.call('wait')
+        yield self.assertFailure(client.call('wait'), Overloaded)
+        waiting.callback('done')
+        result = yield first
+        self.assertEqual(result, 'done')
@@ -0,0 +1,126 @@
+from twisted.trial.unittest import TestCase
+
+import sys
+import types
+import mmap
+from io import BytesIO
+
+from crapc.codec import JsonCodec, MsgpackCodec, defaultCodec, _jsonLibraries
+from crapc.codec import _findJsonLibraries
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+
+class JsonCodecTest(TestCase):
+
+
+    def test_default(self):
+        """
+        The default codec uses the fastest library available.
+        """
+        self.assertEqual(defaultCodec.name, _jsonLibraries[0][0])
+
+
+    def test_roundTrip(self):
+        """
+        Every available library encodes to bytes and decodes again.
+        """
+        for name, _, _ in _jsonLibraries:
+            codec = JsonCodec(name)
+            self.assertEqual(codec.name, name)
+            data = {'jsonrpc': '2.0', 'id': 1, 'result': [1, 'a', None]}
+            encoded = codec.encode(data)
+            self.assertTrue(isinstance(encoded, bytes))
+            self.assertEqual(codec.decode(encoded), data)
+
+
+    def test_roundTrip_floats(self):
+        """
+        Every available library keeps floats exactly.
+        """
+        floats = [3.141592653589793, 1e-12, 1.0000000000000002, 1e300,
+                  -2.5e-308]
+        for name, _, _ in _jsonLibraries:
+            codec = JsonCodec(name)
+            self.assertEqual(codec.decode(codec.encode(floats)), floats,
+                             'Floats changed by %s' % (name,))
+
+
+    def test_oldUjson(self):
+        """
+        ujson before 2.0 rounds floats, so it isn't used.
+        """
+        ujson = types.ModuleType('ujson')
+        ujson.__version__ = '1.35'
+        ujson.dumps = ujson.loads = None
+        original = sys.modules.get('ujson')
+        def restore():
+            if original is None:
+                del sys.modules['ujson']
+            else:
+                sys.modules['ujson'] = original
+        self.addCleanup(restore)
+        sys.modules['ujson'] = ujson
+        self.assertNotIn('ujson', [name for name, _, _
+                                   in _findJsonLibraries()])
+
+        ujson.__version__ = '5.1.0'
+        self.assertIn('ujson', [name for name, _, _ in _findJsonLibraries()])
+
+
+    def test_buffers(self):
+        """
+        Every available library decodes bytearrays, memoryviews, mmaps and
+        files.
+        """
+        encoded = b'{"jsonrpc":"2.0","id":1,"result":[1,"a",null]}'
+        expected = {'jsonrpc': '2.0', 'id': 1, 'result': [1, 'a', None]}
+        path = self.mktemp()
+        with open(path, 'wb') as f:
+            f.write(encoded)
+
+        for name, _, _ in _jsonLibraries:
+            codec = JsonCodec(name)
+            self.assertEqual(codec.decode(bytearray(encoded)), expected)
+            self.assertEqual(codec.decode(memoryview(encoded)), expected)
+            self.assertEqual(codec.decode(BytesIO(encoded)), expected)
+            with open(path, 'rb') as f:
+                self.assertEqual(codec.decode(f), expected)
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.addCleanup(mapped.close)
+                self.assertEqual(codec.decode(mapped), expected)
+
+
+    def test_emptyFile(self):
+        """
+        Empty files can't be mapped into memory, so they are read instead.
+        """
+        path = self.mktemp()
+        open(path, 'wb').close()
+        with open(path, 'rb') as f:
+            self.assertRaises(ValueError, defaultCodec.decode, f)
+
+
+    def test_notAvailable(self):
+        """
+        Asking for a library that isn't available is an error.
+        """
+        self.assertRaises(ValueError, JsonCodec, 'notarealjsonlibrary')
+
+
+
+class MsgpackCodecTest(TestCase):
+
+    if msgpack is None:
+        skip = 'msgpack is not installed'
+
+
+    def test_roundTrip(self):
+        codec = MsgpackCodec()
+        data = {'jsonrpc': '2.0', 'id': 1, 'result': [1, 'a', None]}
+        self.assertEqual(codec.decode(codec.encode(data)), data)
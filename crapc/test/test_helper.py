@@ -5,7 +5,7 @@ from zope.interface.verify import verifyObject
 from crapc.helper import RPCFromObject, PythonInterface, RPCFromClass
 from crapc.interface import ISystem
 from crapc._request import Request
-from crapc.error import MethodNotFound
+from crapc.error import MethodNotFound, InvalidParams
 
 
 class Something(object):
@@ -16,6 +16,14 @@ class Something(object):
     def proc2(self, ho):
         return 'bananas'
 
+    @staticmethod
+    def add(a, b):
+        return a + b
+
+    @classmethod
+    def name(cls, suffix):
+        return cls.__name__ + suffix
+
     def _private(self, arg):
         return 'private'
 
@@ -48,6 +56,66 @@ class RPCFromObjectTest(TestCase):
         self.assertRaises(MethodNotFound, rpc.runProcedure, Request('attr1'))
 
 
+    def test_InvalidParams(self):
+        """
+        Params that don't fit the method's signature raise InvalidParams.
+        """
+        rpc = RPCFromObject(Something())
+        self.assertRaises(InvalidParams, rpc.runProcedure,
+                          Request('proc1', ['a', 'b']))
+
+
+    def test_staticAndClassMethods(self):
+        """
+        Static and class methods are called with just the params.
+        """
+        rpc = RPCFromObject(Something())
+        self.assertEqual(rpc.runProcedure(Request('add', [1, 2])), 3)
+        self.assertEqual(rpc.runProcedure(Request('name', ['!'])),
+                         'Something!')
+        self.assertRaises(InvalidParams, rpc.runProcedure,
+                          Request('add', [1]))
+
+
+    def test_cache(self):
+        """
+        Methods are only looked up once.
+        """
+        class Foo(object):
+            def proc(self):
+                return 'original'
+
+        foo = Foo()
+        rpc = RPCFromObject(foo)
+        self.assertEqual(rpc.runProcedure(Request('proc')), 'original')
+        self.assertRaises(MethodNotFound, rpc.runProcedure, Request('new'))
+
+        foo.proc = lambda: 'replaced'
+        foo.new = lambda: 'new'
+        self.assertEqual(rpc.runProcedure(Request('proc')), 'original')
+        self.assertRaises(MethodNotFound, rpc.runProcedure, Request('new'))
+
+        rpc.invalidate('proc')
+        self.assertEqual(rpc.runProcedure(Request('proc')), 'replaced')
+        self.assertRaises(MethodNotFound, rpc.runProcedure, Request('new'))
+
+        rpc.invalidate()
+        self.assertEqual(rpc.runProcedure(Request('new')), 'new')
+
+
+    def test_cache_missingBounded(self):
+        """
+        Only a limited number of missing names are remembered.
+        """
+        rpc = RPCFromObject(Something())
+        rpc.maxMissing = 3
+        for i in range(10):
+            self.assertRaises(MethodNotFound, rpc.runProcedure,
+                              Request('missing%d' % (i,)))
+        self.assertTrue(len(rpc._missing) <= 3)
+
+
+
 class RPCFromClassTest(TestCase):
 
 
@@ -89,6 +157,30 @@ class RPCFromClassTest(TestCase):
 
 
 
+    def test_InvalidParams(self):
+        """
+        Params that don't fit the method's signature raise InvalidParams.
+        """
+        rpc = RPCFromClass(Something)()
+        self.assertRaises(InvalidParams, rpc.runProcedure,
+                          Request('proc1', ['a', 'b']))
+        self.assertRaises(InvalidParams, rpc.runProcedure,
+                          Request('proc1', {'ho': 'a'}))
+
+
+    def test_staticAndClassMethods(self):
+        """
+        Static and class methods are called without the instance.
+        """
+        rpc = RPCFromClass(Something)()
+        self.assertEqual(rpc.runProcedure(Request('add', [1, 2])), 3)
+        self.assertEqual(rpc.runProcedure(Request('name', ['!'])),
+                         'Something!')
+        self.assertRaises(InvalidParams, rpc.runProcedure,
+                          Request('add', [1, 2, 3]))
+
+
+
 class PythonInterfaceTest(TestCase):
 
 
@@ -1,14 +1,18 @@
 from twisted.trial.unittest import TestCase
 from twisted.python.failure import Failure
+from twisted.internet import defer, task
 
 import json
+from io import BytesIO
 from mock import MagicMock
 
-from crapc.unit import RPCSystem
+from crapc.unit import RPCSystem, RPC
+from crapc.cache import ResultCache, SingleFlightSystem
 from crapc.test.test_unit import _StaticValueSystem
-from crapc.jsonrpc import JsonInterface
+from crapc.jsonrpc import JsonInterface, JsonRPCError, _IncrementalDecoder
 from crapc.jsonrpc import ParseError, InvalidRequest, InvalidParams
-from crapc.jsonrpc import MethodNotFound, InternalError
+from crapc.jsonrpc import MethodNotFound, InternalError, Overloaded, Timeout
+from crapc import error
 
 
 
@@ -35,6 +39,14 @@ class ErrorsTest(TestCase):
         self.assertEqual(InternalError.code, -32603)
 
 
+    def test_Overloaded(self):
+        self.assertEqual(Overloaded.code, -32000)
+
+
+    def test_Timeout(self):
+        self.assertEqual(Timeout.code, -32001)
+
+
 def mkRequest(method, params=None, id=None):
     """
     Make a request object.
@@ -49,6 +61,15 @@ def mkRequest(method, params=None, id=None):
     return request
 
 
+def mkNotification(method, params=None):
+    """
+    Make a notification object.
+    """
+    request = mkRequest(method, params)
+    del request['id']
+    return request
+
+
 def run(interface, method, params=None):
     """
     Run a method on an interface
@@ -64,7 +85,7 @@ class JsonInterfaceTest(TestCase):
 
     def test_serialization_default(self):
         """
-        json.dumps and json.loads are the default (de)serializers.
+        JSON is the default serialization.
         """
         rpc = _StaticValueSystem('b')
 
@@ -110,12 +131,44 @@ class JsonInterfaceTest(TestCase):
                          "Should have used the default serializer")
 
 
+    def test_codec(self):
+        """
+        You can give a codec to do the (de)serializing.
+        """
+        codec = MagicMock()
+        codec.decode.return_value = mkRequest('something', id=14)
+        codec.encode.return_value = 'serialized'
+
+        i = JsonInterface(_StaticValueSystem('b'), codec=codec)
+        result = i.run('input string')
+
+        codec.decode.assert_called_once_with('input string')
+        codec.encode.assert_called_once_with({
+            'jsonrpc': '2.0',
+            'result': 'b',
+            'id': 14,
+        })
+        self.assertEqual(self.successResultOf(result), 'serialized')
+
+
+    def test_deserialize_deferred(self):
+        """
+        A custom deserializer may return a C{Deferred}.
+        """
+        rpc = _StaticValueSystem('b')
+        i = JsonInterface(rpc, deserialize=lambda x: defer.succeed(
+                          json.loads(x)))
+        result = i.run(json.dumps(mkRequest('something', id=12)))
+        data = json.loads(self.successResultOf(result))
+        self.assertEqual(data['result'], 'b')
+
+
     def test_makeErrorResponse(self):
         """
         You can turn a failure into the correct JSON-RPC 2.0 response dict.
         """
-        i = JsonInterface(None)
-        exc = Exception()
+        i = JsonInterface(None, serialize=json.dumps)
+        exc = JsonRPCError()
         exc.code = 12344
         exc.public_message = 'Some message'
 
@@ -131,7 +184,7 @@ class JsonInterfaceTest(TestCase):
         """
         If no ID is given, use None
         """
-        i = JsonInterface(None)
+        i = JsonInterface(None, serialize=json.dumps)
         exc = Exception()
         exc.code = 12344
         exc.public_message = 'Some message'
@@ -140,18 +193,83 @@ class JsonInterfaceTest(TestCase):
         self.assertEqual(result['id'], None)
 
 
-    def test_makeErrorResponse_noCode(self):
+    def test_makeErrorResponse_unexpected(self):
         """
-        If no code is given, use InternalError.code
+        Exceptions which aren't L{JsonRPCError}s are reported as
+        L{InternalError}, even if they have a code or public_message.
         """
-        i = JsonInterface(None)
+        errors = []
+        i = JsonInterface(None, serialize=json.dumps,
+                          logError=errors.append)
         exc = Exception()
+        exc.code = 404
         exc.public_message = 'Some message'
 
         result = i._makeErrorResponse(Failure(exc), None)
         self.assertEqual(result['id'], None)
         self.assertEqual(result['error']['code'], InternalError.code)
-        self.assertEqual(result['error']['message'], 'Some message')
+        self.assertEqual(result['error']['message'],
+                         InternalError.public_message)
+        self.assertEqual(len(errors), 1)
+
+
+    def test_envelope(self):
+        """
+        With a JSON codec, responses are serialized by splicing the id and
+        result into a pre-encoded envelope.
+        """
+        i = JsonInterface(None)
+        for request_id in [1, 'abc', None, 2.5]:
+            response = json.loads(i._serialize(i._makeSuccess([1, 'a'],
+                                                              request_id)))
+            self.assertEqual(response, {
+                'jsonrpc': '2.0',
+                'id': request_id,
+                'result': [1, 'a'],
+            })
+
+
+    def test_envelope_error(self):
+        """
+        Errors are spliced into a pre-encoded envelope too, and the ones for
+        requests without an id are only encoded once.
+        """
+        i = JsonInterface(None)
+        exc = JsonRPCError()
+        exc.code = 12344
+        exc.public_message = 'Some message'
+
+        response = json.loads(i._serialize(i._makeErrorResponse(Failure(exc),
+                                                                13)))
+        self.assertEqual(response, {
+            'jsonrpc': '2.0',
+            'id': 13,
+            'error': {'code': 12344, 'message': 'Some message'},
+        })
+        first = i._serialize(i._makeErrorResponse(Failure(MethodNotFound())))
+        second = i._serialize(i._makeErrorResponse(Failure(MethodNotFound())))
+        self.assertIdentical(first, second)
+        self.assertEqual(json.loads(first)['error']['code'],
+                         MethodNotFound.code)
+
+
+    def test_envelope_batch(self):
+        """
+        Batches of spliced responses are serialized as a JSON array.
+        """
+        rpc = RPCSystem()
+        rpc.addFunction('echo', lambda x: x)
+        i = JsonInterface(rpc)
+        response = json.loads(self.successResultOf(i.run(json.dumps([
+            mkRequest('echo', [u'\N{SNOWMAN}'], id=1),
+            mkRequest('missing', id=2),
+        ]))))
+        self.assertEqual(response, [
+            {'jsonrpc': '2.0', 'id': 1, 'result': u'\N{SNOWMAN}'},
+            {'jsonrpc': '2.0', 'id': 2,
+             'error': {'code': MethodNotFound.code,
+                       'message': MethodNotFound.public_message}},
+        ])
 
 
     def test_run_MethodNotFound(self):
@@ -271,6 +389,131 @@ class JsonInterfaceTest(TestCase):
                       "Should indicate something about logging failing")
 
 
+    def test_expectedErrorsNotLogged(self):
+        """
+        Expected errors (L{error.RPCError}s), whether raised or returned as
+        failed C{Deferred}s, are responded to without being logged.
+        """
+        def invalid():
+            raise error.InvalidParams('bad')
+        rpc = RPCSystem()
+        rpc.addFunction('invalid', invalid)
+        rpc.addFunction('later', lambda: defer.fail(error.Timeout('slow')))
+
+        errors = []
+        i = JsonInterface(rpc, logError=errors.append)
+        response = self.successResultOf(run(i, 'invalid'))
+        self.assertEqual(response['error']['code'], InvalidParams.code)
+        response = self.successResultOf(run(i, 'later'))
+        self.assertEqual(response['error']['code'], Timeout.code)
+        response = self.successResultOf(run(i, 'missing'))
+        self.assertEqual(response['error']['code'], MethodNotFound.code)
+        self.assertEqual(errors, [])
+
+
+    def test_expectedErrorsNotLogged_RPC(self):
+        """
+        Expected errors from an L{RPC} system are responded to synchronously
+        too, with or without middleware.
+        """
+        class Thing(object):
+            rpc = RPC()
+
+            @rpc.route('foo')
+            def foo(self, request):
+                return 'foo'
+
+        errors = []
+        i = JsonInterface(Thing().rpc, logError=errors.append)
+        request = json.dumps(mkRequest('missing', id=1))
+        response = json.loads(i.runSync(request))
+        self.assertEqual(response['error']['code'], MethodNotFound.code)
+        self.assertEqual(json.loads(i.runSync(json.dumps(mkRequest('foo'))))[
+                         'result'], 'foo')
+
+        i.addMiddleware(lambda next, request: next(request))
+        response = json.loads(i.runSync(request))
+        self.assertEqual(response['error']['code'], MethodNotFound.code)
+        self.assertEqual(errors, [])
+
+
+    def test_unexpectedErrorAttributes(self):
+        """
+        A procedure raising an exception with a code, even one which can't
+        be serialized, gets an L{InternalError} response.
+        """
+        def fail(code):
+            exc = Exception()
+            exc.code = code
+            raise exc
+        rpc = RPCSystem()
+        rpc.addFunction('fail', lambda: fail(404))
+        rpc.addFunction('bytes', lambda: fail(b'404'))
+
+        errors = []
+        i = JsonInterface(rpc, logError=errors.append)
+        for method in ['fail', 'bytes']:
+            response = self.successResultOf(run(i, method))
+            self.assertEqual(response['error'], {
+                'code': InternalError.code,
+                'message': InternalError.public_message,
+            })
+        self.assertEqual(len(errors), 2)
+
+
+    def test_logError_deferred(self):
+        """
+        An unexpected failure from a C{Deferred} is logged as it was
+        raised, and responded to with L{InternalError}.
+        """
+        rpc = RPCSystem()
+        rpc.addFunction('foo', lambda: defer.fail(ValueError('the error')))
+
+        errors = []
+        i = JsonInterface(rpc, logError=errors.append)
+        response = self.successResultOf(run(i, 'foo'))
+        self.assertEqual(response['error']['code'], InternalError.code)
+        self.assertNotIn('the error', response['error']['message'])
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].check(ValueError))
+
+
+    def test_middleware(self):
+        """
+        Middleware given to the interface sees every request before the
+        system does, and can refuse it with an L{error.RPCError}.
+        """
+        seen = []
+        def auth(next, request):
+            seen.append(request.full_method)
+            if request.method == 'secret':
+                raise error.MethodNotFound(request.method)
+            return next(request)
+        rpc = RPCSystem()
+        rpc.addFunction('echo', lambda x: x)
+        rpc.addFunction('secret', lambda: 'secret')
+
+        i = JsonInterface(rpc, middleware=[auth])
+        response = self.successResultOf(run(i, 'echo', ['hi']))
+        self.assertEqual(response['result'], 'hi')
+        response = self.successResultOf(run(i, 'secret'))
+        self.assertEqual(response['error']['code'], MethodNotFound.code)
+        self.assertEqual(seen, ['echo', 'secret'])
+
+
+    def test_addMiddleware(self):
+        """
+        Middleware can be added to an interface after it is made.
+        """
+        rpc = RPCSystem()
+        rpc.addFunction('echo', lambda x: x)
+        i = JsonInterface(rpc)
+        i.addMiddleware(lambda next, request: next(request) * 2)
+
+        response = self.successResultOf(run(i, 'echo', ['hi']))
+        self.assertEqual(response['result'], 'hihi')
+
+
     def test_run_params(self):
         """
         The parameters should be sent along too.
@@ -283,6 +526,47 @@ class JsonInterfaceTest(TestCase):
         self.assertEqual(response['result'], 3)
 
 
+    def test_run_InvalidParams(self):
+        """
+        If the params don't fit the procedure, return InvalidParams.
+        """
+        rpc = RPCSystem()
+        rpc.addFunction('sum', lambda a,b: a+b)
+
+        i = JsonInterface(rpc)
+        response = self.successResultOf(run(i, 'sum', [1, 2, 3]))
+        self.assertEqual(response['error']['code'], InvalidParams.code)
+
+
+    def test_run_Overloaded(self):
+        """
+        If the server is overloaded, say so.
+        """
+        def overloaded():
+            raise error.Overloaded('busy')
+        rpc = RPCSystem()
+        rpc.addFunction('busy', overloaded)
+
+        i = JsonInterface(rpc)
+        response = self.successResultOf(run(i, 'busy'))
+        self.assertEqual(response['error']['code'], Overloaded.code)
+        self.assertEqual(response['error']['message'], 'Server overloaded')
+
+
+    def test_run_buffer(self):
+        """
+        Requests can be given as buffers and files as well as strings.
+        """
+        rpc = RPCSystem()
+        rpc.addFunction('sum', lambda a,b: a+b)
+        i = JsonInterface(rpc)
+        payload = json.dumps(mkRequest('sum', [1, 2], id=1)).encode('utf-8')
+        for data in [bytearray(payload), memoryview(payload),
+                     BytesIO(payload)]:
+            response = json.loads(self.successResultOf(i.run(data)))
+            self.assertEqual(response['result'], 3)
+
+
     def test_run_batch(self):
         """
         You can submit multiple requests at once.
@@ -353,3 +637,1021 @@ class JsonInterfaceTest(TestCase):
             "as per the spec: %r" % (result,))
 
 
+
+
+    def test_runSync(self):
+        """
+        runSync returns the serialized response directly when the procedures
+        return plain values.
+        """
+        rpc = RPCSystem()
+        rpc.addFunction('sum', lambda a,b: a+b)
+        i = JsonInterface(rpc)
+
+        result = i.runSync(json.dumps(mkRequest('sum', [1, 2], id=5)))
+        self.assertEqual(json.loads(result), {
+            'jsonrpc': '2.0',
+            'id': 5,
+            'result': 3,
+        })
+
+        result = i.runSync(json.dumps([
+            mkRequest('sum', [1, 2], id=1),
+            mkRequest('sum', [3, 4], id=2),
+        ]))
+        result = json.loads(result)
+        self.assertEqual([x['result'] for x in result], [3, 7])
+
+
+    def test_runSync_errors(self):
+        """
+        Errors are returned synchronously, too.
+        """
+        def fail():
+            raise Exception('the error')
+        rpc = RPCSystem()
+        rpc.addFunction('err', fail)
+        i = JsonInterface(rpc)
+
+        response = json.loads(i.runSync(json.dumps(mkRequest('err'))))
+        self.assertEqual(response['error']['code'], InternalError.code)
+
+        response = json.loads(i.runSync(json.dumps(mkRequest('missing'))))
+        self.assertEqual(response['error']['code'], MethodNotFound.code)
+
+        response = json.loads(i.runSync('not json'))
+        self.assertEqual(response['error']['code'], ParseError.code)
+
+
+    def test_runSync_deferred(self):
+        """
+        If a procedure returns a C{Deferred}, runSync returns a C{Deferred}.
+        """
+        later = defer.Deferred()
+        rpc = RPCSystem()
+        rpc.addFunction('later', lambda: later)
+        rpc.addFunction('now', lambda: 'now')
+        i = JsonInterface(rpc)
+
+        result = i.runSync(json.dumps([
+            mkRequest('now', id=1),
+            mkRequest('later', id=2),
+        ]))
+        self.assertTrue(isinstance(result, defer.Deferred))
+        self.assertNoResult(result)
+
+        later.callback('later')
+        response = json.loads(self.successResultOf(result))
+        self.assertEqual([x['result'] for x in response], ['now', 'later'])
+
+
+    def test_runSync_deferredError(self):
+        """
+        Errors from a C{Deferred} returned by a procedure are mapped.
+        """
+        rpc = RPCSystem()
+        rpc.addFunction('later', lambda: defer.fail(Exception('foo')))
+        i = JsonInterface(rpc)
+
+        result = i.runSync(json.dumps(mkRequest('later')))
+        response = json.loads(self.successResultOf(result))
+        self.assertEqual(response['error']['code'], InternalError.code)
+
+
+
+class ConcurrencyTest(TestCase):
+
+
+    def setUp(self):
+        self.running = []
+        self.rpc = RPCSystem()
+        self.rpc.addFunction('wait', self.wait)
+        self.rpc.addFunction('other', self.wait)
+
+
+    def wait(self):
+        d = defer.Deferred()
+        self.running.append(d)
+        return d
+
+
+    def finishAll(self):
+        while self.running:
+            self.running.pop(0).callback('done')
+
+
+    def test_maxBatchSize(self):
+        """
+        Batches larger than maxBatchSize are rejected with InvalidRequest.
+        """
+        i = JsonInterface(self.rpc, maxBatchSize=2)
+        payload = json.dumps([mkRequest('wait', id=x) for x in range(3)])
+        response = json.loads(self.successResultOf(i.run(payload)))
+        self.assertEqual(response['error']['code'], InvalidRequest.code)
+        self.assertEqual(self.running, [])
+
+
+    def test_batchConcurrency(self):
+        """
+        Only batchConcurrency requests from a single batch run at once.
+        """
+        i = JsonInterface(self.rpc, batchConcurrency=2)
+        payload = json.dumps([mkRequest('wait', id=x) for x in range(5)])
+        d1 = i.run(payload)
+        d2 = i.run(payload)
+        self.assertEqual(len(self.running), 4, "Each batch should have "
+                         "started two requests")
+
+        self.running.pop(0).callback('done')
+        self.assertEqual(len(self.running), 4, "Finishing one should start "
+                         "the next one")
+
+        self.finishAll()
+        self.assertEqual(len(json.loads(self.successResultOf(d1))), 5)
+        self.assertEqual(len(json.loads(self.successResultOf(d2))), 5)
+
+
+    def test_concurrency(self):
+        """
+        Only concurrency requests run at once across all calls to run.
+        """
+        i = JsonInterface(self.rpc, concurrency=3)
+        d1 = i.run(json.dumps([mkRequest('wait', id=x) for x in range(2)]))
+        d2 = i.run(json.dumps(mkRequest('wait')))
+        d3 = i.run(json.dumps(mkRequest('wait')))
+        self.assertEqual(len(self.running), 3)
+
+        self.finishAll()
+        self.successResultOf(d1)
+        self.successResultOf(d2)
+        self.successResultOf(d3)
+
+
+    def test_concurrency_fairness(self):
+        """
+        With a per-batch limit, a large batch doesn't make later requests
+        wait for the whole batch.
+        """
+        i = JsonInterface(self.rpc, concurrency=2, batchConcurrency=1)
+        big = i.run(json.dumps([mkRequest('wait', id=x) for x in range(10)]))
+        single = i.run(json.dumps(mkRequest('wait')))
+        self.assertEqual(len(self.running), 2, "The single request should "
+                         "not be queued behind the rest of the batch")
+
+        self.running.pop(1).callback('done')
+        self.successResultOf(single)
+        self.assertNoResult(big)
+
+        self.finishAll()
+        self.assertEqual(len(json.loads(self.successResultOf(big))), 10)
+
+
+    def test_methodConcurrency(self):
+        """
+        You can limit how many calls of a particular method run at once.
+        """
+        i = JsonInterface(self.rpc, methodConcurrency={'wait': 1})
+        d = i.run(json.dumps([
+            mkRequest('wait', id=1),
+            mkRequest('wait', id=2),
+            mkRequest('other', id=3),
+        ]))
+        self.assertEqual(len(self.running), 2, "Should only run one 'wait' "
+                         "and the 'other'")
+        self.finishAll()
+        self.assertEqual(len(json.loads(self.successResultOf(d))), 3)
+
+
+
+    def test_maxInFlight(self):
+        """
+        Calls beyond maxInFlight are answered with Overloaded without being
+        parsed.
+        """
+        deserialize = MagicMock(side_effect=json.loads)
+        i = JsonInterface(self.rpc, maxInFlight=2, deserialize=deserialize)
+        d1 = i.run(json.dumps(mkRequest('wait', id=1)))
+        d2 = i.run(json.dumps(mkRequest('wait', id=2)))
+        response = json.loads(self.successResultOf(i.run('not even json')))
+        self.assertEqual(response['error']['code'], Overloaded.code)
+        self.assertEqual(response['id'], None)
+        self.assertEqual(deserialize.call_count, 2)
+
+        self.running.pop(0).callback('done')
+        self.successResultOf(d1)
+        d3 = i.run(json.dumps(mkRequest('wait', id=3)))
+        self.assertEqual(len(self.running), 2)
+        self.finishAll()
+        self.successResultOf(d2)
+        self.successResultOf(d3)
+
+
+    def test_maxInFlight_runStreaming(self):
+        """
+        runStreaming is subject to maxInFlight too.
+        """
+        i = JsonInterface(self.rpc, maxInFlight=1)
+        i.runStreaming(json.dumps(mkRequest('wait', id=1)), lambda x: None)
+        written = []
+        d = i.runStreaming(json.dumps(mkRequest('wait', id=2)),
+                           written.append)
+        self.successResultOf(d)
+        response = json.loads(b''.join(written))
+        self.assertEqual(response['error']['code'], Overloaded.code)
+        self.assertEqual(len(self.running), 1)
+
+
+    def test_maxInFlight_batch(self):
+        """
+        Each request of a batch counts against maxInFlight; those beyond it
+        are answered with Overloaded under their own id.
+        """
+        i = JsonInterface(self.rpc, maxInFlight=2)
+        d = i.run(json.dumps([
+            mkRequest('wait', id=1),
+            mkRequest('wait', id=2),
+            mkRequest('wait', id=3),
+            mkNotification('wait'),
+        ]))
+        self.assertEqual(len(self.running), 2)
+        response = json.loads(self.successResultOf(i.run('not even json')))
+        self.assertEqual(response['error']['code'], Overloaded.code)
+
+        self.finishAll()
+        responses = json.loads(self.successResultOf(d))
+        self.assertEqual(len(responses), 3)
+        self.assertEqual([x['id'] for x in responses], [1, 2, 3])
+        self.assertEqual(responses[2]['error']['code'], Overloaded.code)
+
+        d = i.run(json.dumps(mkRequest('wait', id=4)))
+        self.assertEqual(len(self.running), 1, "Finished requests should "
+                         "no longer count")
+        self.finishAll()
+        self.successResultOf(d)
+
+
+    def test_maxInFlight_startStreaming(self):
+        """
+        startStreaming, and so runFile, is subject to maxInFlight too: the
+        body is ignored and answered with Overloaded.
+        """
+        i = JsonInterface(self.rpc, maxInFlight=1)
+        i.runSync(json.dumps(mkRequest('wait', id=1)))
+        written = []
+        request = i.startStreaming(written.append)
+        request.dataReceived(json.dumps(mkRequest('wait', id=2)))
+        self.successResultOf(request.finish())
+        response = json.loads(b''.join(written))
+        self.assertEqual(response['error']['code'], Overloaded.code)
+        self.assertEqual(len(self.running), 1)
+
+
+    def test_maxInFlight_startStreaming_items(self):
+        """
+        Each request of a streamed batch counts against maxInFlight.
+        """
+        i = JsonInterface(self.rpc, maxInFlight=1)
+        written = []
+        request = i.startStreaming(written.append)
+        request.dataReceived(json.dumps([
+            mkRequest('wait', id=1),
+            mkRequest('wait', id=2),
+        ]))
+        d = request.finish()
+        self.assertEqual(len(self.running), 1)
+        self.finishAll()
+        self.successResultOf(d)
+        responses = sorted(json.loads(b''.join(written)),
+                           key=lambda x: x['id'])
+        self.assertEqual(responses[0]['result'], 'done')
+        self.assertEqual(responses[1]['error']['code'], Overloaded.code)
+
+
+    def test_maxQueueTime(self):
+        """
+        Requests that waited for a concurrency limit for longer than
+        maxQueueTime are answered with Overloaded instead of being run.
+        """
+        clock = task.Clock()
+        i = JsonInterface(self.rpc, concurrency=1, maxQueueTime=5,
+                          clock=clock)
+        d1 = i.run(json.dumps(mkRequest('wait', id=1)))
+        clock.advance(2)
+        d2 = i.run(json.dumps(mkRequest('wait', id=2)))
+        d3 = i.run(json.dumps(mkRequest('wait', id=3)))
+        clock.advance(4)
+        self.running.pop(0).callback('done')
+        self.assertEqual(json.loads(self.successResultOf(d1))['result'],
+                         'done')
+        self.assertEqual(len(self.running), 1, "2 waited 4 seconds, so it "
+                         "should run")
+
+        clock.advance(2)
+        self.running.pop(0).callback('done')
+        self.successResultOf(d2)
+        response = json.loads(self.successResultOf(d3))
+        self.assertEqual(response['error']['code'], Overloaded.code)
+        self.assertEqual(response['id'], 3)
+        self.assertEqual(self.running, [])
+
+
+
+class RunStreamingTest(TestCase):
+
+
+    def test_single(self):
+        """
+        A single request's response is written in one piece.
+        """
+        rpc = RPCSystem()
+        rpc.addFunction('sum', lambda a,b: a+b)
+        i = JsonInterface(rpc)
+
+        written = []
+        d = i.runStreaming(json.dumps(mkRequest('sum', [1, 2], id=4)),
+                           written.append)
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(len(written), 1)
+        self.assertEqual(json.loads(written[0])['result'], 3)
+
+
+    def test_bytearray(self):
+        """
+        The response can be written into a bytearray.
+        """
+        rpc = RPCSystem()
+        rpc.addFunction('sum', lambda a,b: a+b)
+        i = JsonInterface(rpc)
+
+        buf = bytearray()
+        d = i.runStreaming(json.dumps([mkRequest('sum', [1, 2], id=1),
+                                       mkRequest('sum', [3, 4], id=2)]),
+                           buf.extend)
+        self.assertEqual(self.successResultOf(d), None)
+        response = json.loads(bytes(buf))
+        self.assertEqual([r['result'] for r in response], [3, 7])
+
+
+    def test_parseError(self):
+        """
+        Parse errors are written as a single error.
+        """
+        i = JsonInterface(RPCSystem())
+        written = []
+        self.successResultOf(i.runStreaming('not json', written.append))
+        response = json.loads(b''.join(written))
+        self.assertEqual(response['error']['code'], ParseError.code)
+
+
+    def test_batch(self):
+        """
+        Responses to batch requests are written as each one finishes.
+        """
+        later = defer.Deferred()
+        rpc = RPCSystem()
+        rpc.addFunction('later', lambda: later)
+        rpc.addFunction('now', lambda: 'now')
+        i = JsonInterface(rpc)
+
+        written = []
+        d = i.runStreaming(json.dumps([
+            mkRequest('later', id=1),
+            mkRequest('now', id=2),
+        ]), written.append)
+
+        self.assertNoResult(d)
+        self.assertEqual(json.loads(written[1])['result'], 'now',
+                         "Should have written the finished response already")
+
+        later.callback('later')
+        self.successResultOf(d)
+        response = json.loads(b''.join(written))
+        self.assertEqual([x['id'] for x in response], [2, 1])
+        self.assertEqual(response[1]['result'], 'later')
+
+
+    def test_batch_empty(self):
+        """
+        An empty batch gets a single error.
+        """
+        i = JsonInterface(RPCSystem())
+        written = []
+        self.successResultOf(i.runStreaming('[]', written.append))
+        response = json.loads(b''.join(written))
+        self.assertEqual(response['error']['code'], InvalidRequest.code)
+
+
+
+class IncrementalDecoderTest(TestCase):
+
+
+    def feedAll(self, chunks):
+        decoder = _IncrementalDecoder()
+        elements = []
+        for chunk in chunks:
+            elements.append(decoder.feed(chunk))
+        elements.append(decoder.close())
+        return elements
+
+
+    def test_array(self):
+        """
+        Elements are returned as soon as they are complete.
+        """
+        result = self.feedAll([' [ {"a": 1', '}, {"b"', ': [2]} ,', '3', ']  '])
+        self.assertEqual(result, [[], [{'a': 1}], [{'b': [2]}], [], [3],
+                                  []])
+
+
+    def test_numbers(self):
+        """
+        A number at the end of a chunk isn't returned until it's known to be
+        finished.
+        """
+        result = self.feedAll(['[12', '34,5', '6]'])
+        self.assertEqual(result, [[], [1234], [56], []])
+
+
+    def test_strings(self):
+        """
+        Delimiters inside strings aren't mistaken for the end of elements.
+        """
+        result = self.feedAll(['["a,]', '", "b"]'])
+        self.assertEqual(result, [[], ['a,]', 'b'], []])
+
+
+    def test_oneLargeChunk(self):
+        """
+        Many elements in a single chunk are all returned, and only the
+        unfinished element is kept for the next chunk.
+        """
+        decoder = _IncrementalDecoder()
+        elements = decoder.feed('[' + ', '.join(['{"a": %d}' % (i,)
+                                                 for i in range(5000)])
+                                + ', {"b"')
+        self.assertEqual(elements, [{'a': i} for i in range(5000)])
+        self.assertEqual(decoder._buffer.strip(), '{"b"')
+        self.assertEqual(decoder.feed(': 1}]'), [{'b': 1}])
+        self.assertEqual(decoder.close(), [])
+
+
+    def test_empty(self):
+        self.assertEqual(self.feedAll(['[', ' ]']), [[], [], []])
+
+
+    def test_notArray(self):
+        """
+        Other documents are decoded all at once when closed.
+        """
+        result = self.feedAll(['{"a"', ': 1}'])
+        self.assertEqual(result, [[], [], {'a': 1}])
+
+
+    def test_invalid(self):
+        """
+        Invalid documents raise ValueError.
+        """
+        self.assertRaises(ValueError, self.feedAll, ['[1 2]'])
+        self.assertRaises(ValueError, self.feedAll, ['[1,', ']'])
+        self.assertRaises(ValueError, self.feedAll, ['[1, {"a"'])
+        self.assertRaises(ValueError, self.feedAll, ['[1] 2'])
+        self.assertRaises(ValueError, self.feedAll, ['{"a"'])
+        self.assertRaises(ValueError, self.feedAll, [''])
+
+
+
+class StartStreamingTest(TestCase):
+
+
+    def setUp(self):
+        self.later = defer.Deferred()
+        rpc = RPCSystem()
+        rpc.addFunction('later', lambda: self.later)
+        rpc.addFunction('sum', lambda a,b: a+b)
+        self.written = []
+        self.interface = JsonInterface(rpc)
+        self.stream = self.interface.startStreaming(self.written.append)
+
+
+    def test_dispatchEarly(self):
+        """
+        Requests in a batch are run as soon as they have been parsed.
+        """
+        payload = json.dumps([
+            mkRequest('later', id=1),
+            mkRequest('sum', [1, 2], id=2),
+        ])
+        middle = payload.index('"sum"')
+        self.stream.dataReceived(payload[:middle])
+        self.assertEqual(b''.join(self.written), b'', "Nothing finished yet")
+
+        self.stream.dataReceived(payload[middle:])
+        self.assertEqual(json.loads(b''.join(self.written) + b']'),
+                         [{'jsonrpc': '2.0', 'id': 2, 'result': 3}])
+
+        d = self.stream.finish()
+        self.assertNoResult(d)
+        self.later.callback('later')
+        self.successResultOf(d)
+        response = json.loads(b''.join(self.written))
+        self.assertEqual([x['id'] for x in response], [2, 1])
+
+
+    def test_single(self):
+        """
+        A single request is run when the body is finished.
+        """
+        self.stream.dataReceived(json.dumps(mkRequest('sum', [1, 2], id=2)))
+        self.successResultOf(self.stream.finish())
+        response = json.loads(b''.join(self.written))
+        self.assertEqual(response['result'], 3)
+
+
+    def test_parseError(self):
+        """
+        An invalid body gets a ParseError.
+        """
+        self.stream.dataReceived('{"foo')
+        self.successResultOf(self.stream.finish())
+        response = json.loads(b''.join(self.written))
+        self.assertEqual(response['error']['code'], ParseError.code)
+
+
+    def test_parseError_batch(self):
+        """
+        If the body of a batch turns out to be invalid after some requests
+        have been run, a ParseError is added to the responses.
+        """
+        self.stream.dataReceived('[' + json.dumps(mkRequest('sum', [1, 2])))
+        self.stream.dataReceived(', garbage]')
+        self.successResultOf(self.stream.finish())
+        response = json.loads(b''.join(self.written))
+        self.assertEqual(response[0]['result'], 3)
+        self.assertEqual(response[1]['error']['code'], ParseError.code)
+
+
+    def test_emptyBatch(self):
+        """
+        An empty batch gets a single InvalidRequest error.
+        """
+        self.stream.dataReceived('[]')
+        self.successResultOf(self.stream.finish())
+        response = json.loads(b''.join(self.written))
+        self.assertEqual(response['error']['code'], InvalidRequest.code)
+
+
+    def test_maxBatchSize(self):
+        """
+        Requests beyond maxBatchSize get InvalidRequest errors instead of
+        being run.
+        """
+        self.interface._maxBatchSize = 1
+        stream = self.interface.startStreaming(self.written.append)
+        stream.dataReceived(json.dumps([
+            mkRequest('sum', [1, 2], id=1),
+            mkRequest('sum', [1, 2], id=2),
+        ]))
+        self.successResultOf(stream.finish())
+        response = json.loads(b''.join(self.written))
+        self.assertEqual(response[0]['result'], 3)
+        self.assertEqual(response[1]['error']['code'], InvalidRequest.code)
+
+
+    def test_runFile(self):
+        """
+        You can run a request body read from a file.
+        """
+        payload = json.dumps([
+            mkRequest('sum', [1, 2], id=1),
+            mkRequest('sum', [3, 4], id=2),
+        ])
+        d = self.interface.runFile(BytesIO(payload.encode('utf-8')),
+                                   self.written.append,
+                                   chunkSize=7)
+        self.successResultOf(d)
+        response = json.loads(b''.join(self.written))
+        self.assertEqual([x['result'] for x in response], [3, 7])
+
+
+    def test_buffers(self):
+        """
+        The body may arrive in C{memoryview} and C{bytearray} chunks.
+        """
+        payload = json.dumps([
+            mkRequest('sum', [1, 2], id=1),
+            mkRequest('sum', [3, 4], id=2),
+        ]).encode('utf-8')
+        middle = len(payload) // 2
+        self.stream.dataReceived(memoryview(payload[:middle]))
+        self.stream.dataReceived(bytearray(payload[middle:]))
+        self.successResultOf(self.stream.finish())
+        response = json.loads(b''.join(self.written))
+        self.assertEqual([x['result'] for x in response], [3, 7])
+
+
+
+class NotificationTest(TestCase):
+
+
+    def setUp(self):
+        self.called = []
+        self.later = defer.Deferred()
+        self.errors = []
+        rpc = RPCSystem()
+        rpc.addFunction('note', self.called.append)
+        rpc.addFunction('later', lambda: self.later)
+        rpc.addFunction('fail', lambda: 1/0)
+        rpc.addFunction('sum', lambda a,b: a+b)
+        self.interface = JsonInterface(rpc, logError=self.errors.append)
+
+
+    def test_single(self):
+        """
+        A notification is run but gets no response.
+        """
+        result = self.interface.run(json.dumps(mkNotification('note',
+                                                              ['hi'])))
+        self.assertEqual(self.successResultOf(result), None)
+        self.assertEqual(self.called, ['hi'])
+
+
+    def test_expectedErrorNotLogged(self):
+        """
+        A notification of a missing method is not logged, but one which
+        fails unexpectedly is.
+        """
+        self.interface.run(json.dumps(mkNotification('missing')))
+        self.assertEqual(self.errors, [])
+        self.interface.run(json.dumps(mkNotification('fail')))
+        self.assertEqual(len(self.errors), 1)
+        self.assertTrue(self.errors[0].check(ZeroDivisionError))
+
+
+    def test_fireAndForget(self):
+        """
+        The response doesn't wait for notifications to finish.
+        """
+        result = self.interface.run(json.dumps(mkNotification('later')))
+        self.assertEqual(self.successResultOf(result), None)
+
+        result = self.interface.run(json.dumps([
+            mkNotification('later'),
+            mkRequest('sum', [1, 2], id=1),
+        ]))
+        response = json.loads(self.successResultOf(result))
+        self.assertEqual(response, [{'jsonrpc': '2.0', 'id': 1, 'result': 3}])
+        self.later.callback('done')
+
+
+    def test_batchOfNotifications(self):
+        """
+        A batch of only notifications gets no response at all.
+        """
+        result = self.interface.run(json.dumps([
+            mkNotification('note', ['a']),
+            mkNotification('note', ['b']),
+        ]))
+        self.assertEqual(self.successResultOf(result), None)
+        self.assertEqual(self.called, ['a', 'b'])
+
+
+    def test_errors(self):
+        """
+        Notifications that fail are logged but get no response.
+        """
+        result = self.interface.run(json.dumps(mkNotification('fail')))
+        self.assertEqual(self.successResultOf(result), None)
+        self.assertEqual(len(self.errors), 1)
+
+        result = self.interface.run(json.dumps(mkNotification('missing')))
+        self.assertEqual(self.successResultOf(result), None)
+
+
+    def test_invalid(self):
+        """
+        Invalid requests without an id still get an error response.
+        """
+        result = self.interface.run(json.dumps({'jsonrpc': '2.0'}))
+        response = json.loads(self.successResultOf(result))
+        self.assertEqual(response['id'], None)
+        self.assertEqual(response['error']['code'], InvalidRequest.code)
+
+        result = self.interface.run(json.dumps([1, 2]))
+        response = json.loads(self.successResultOf(result))
+        self.assertEqual([x['error']['code'] for x in response],
+                         [InvalidRequest.code] * 2)
+
+
+    def test_concurrency(self):
+        """
+        Notifications still count towards the concurrency limits.
+        """
+        running = []
+        def wait():
+            running.append(defer.Deferred())
+            return running[-1]
+        rpc = RPCSystem()
+        rpc.addFunction('wait', wait)
+        i = JsonInterface(rpc, concurrency=1)
+
+        result = i.run(json.dumps(mkNotification('wait')))
+        self.assertEqual(self.successResultOf(result), None)
+        result = i.run(json.dumps(mkRequest('wait')))
+        self.assertEqual(len(running), 1)
+
+        running[0].callback(None)
+        self.assertEqual(len(running), 2)
+        running[1].callback('done')
+        self.assertEqual(json.loads(self.successResultOf(result))['result'],
+                         'done')
+
+
+    def test_streaming(self):
+        """
+        Streamed batches leave out notifications.
+        """
+        written = []
+        d = self.interface.runStreaming(json.dumps([
+            mkNotification('note', ['a']),
+            mkRequest('sum', [1, 2], id=1),
+        ]), written.append)
+        self.successResultOf(d)
+        self.assertEqual(json.loads(b''.join(written)),
+                         [{'jsonrpc': '2.0', 'id': 1, 'result': 3}])
+
+        written = []
+        stream = self.interface.startStreaming(written.append)
+        stream.dataReceived(json.dumps([mkNotification('note', ['b'])]))
+        self.successResultOf(stream.finish())
+        self.assertEqual(written, [])
+
+
+
+class ObserverTest(TestCase):
+
+
+    def setUp(self):
+        self.now = 0
+        self.later = defer.Deferred()
+        rpc = RPCSystem()
+        rpc.addFunction('sum', self.sum)
+        rpc.addFunction('later', lambda: self.later)
+        self.events = []
+        self.interface = JsonInterface(rpc, serialize=self.serialize,
+                                       observers=[self.events.append])
+        self.interface.timer = self.timer
+
+
+    def timer(self):
+        return self.now
+
+
+    def sum(self, a, b):
+        self.now += 2
+        return a + b
+
+
+    def serialize(self, response):
+        self.now += 3
+        return json.dumps(response)
+
+
+    def test_single(self):
+        """
+        Observers get the timings and outcome of each request.
+        """
+        self.interface.run(json.dumps(mkRequest('sum', [1, 2], id=7)))
+        self.assertEqual(self.events, [{
+            'method': 'sum',
+            'id': 7,
+            'batchSize': 1,
+            'outcome': 'result',
+            'errorCode': None,
+            'parseTime': 0,
+            'executeTime': 2,
+            'serializeTime': 3,
+        }])
+
+
+    def test_batch(self):
+        """
+        Each request in a batch is reported once the batch is serialized.
+        """
+        d = self.interface.run(json.dumps([
+            mkRequest('later', id=1),
+            mkRequest('missing', id=2),
+        ]))
+        self.assertEqual(self.events, [])
+        self.later.callback('done')
+        self.successResultOf(d)
+
+        self.assertEqual(len(self.events), 2)
+        later, missing = self.events
+        self.assertEqual(later['outcome'], 'result')
+        self.assertEqual(later['batchSize'], 2)
+        self.assertEqual(missing['method'], 'missing')
+        self.assertEqual(missing['outcome'], 'error')
+        self.assertEqual(missing['errorCode'], MethodNotFound.code)
+
+
+    def test_parseError(self):
+        """
+        Bodies that can't be run are reported as one error.
+        """
+        self.interface.run('garbage')
+        self.assertEqual(len(self.events), 1)
+        self.assertEqual(self.events[0]['errorCode'], ParseError.code)
+        self.assertEqual(self.events[0]['method'], None)
+
+
+    def test_notification(self):
+        """
+        Notifications that finish after the response is serialized are
+        reported when they finish.
+        """
+        request = mkRequest('later')
+        del request['id']
+        self.interface.run(json.dumps(request))
+        self.assertEqual(self.events, [])
+        self.later.callback('done')
+        self.assertEqual(self.events[0]['outcome'], 'notification')
+        self.assertEqual(self.events[0]['serializeTime'], None)
+
+
+    def test_removeObserver(self):
+        """
+        Removed observers aren't called.
+        """
+        self.interface.removeObserver(self.events.append)
+        self.interface.run(json.dumps(mkRequest('sum', [1, 2])))
+        self.assertEqual(self.events, [])
+
+
+    def test_observerFails(self):
+        """
+        Failing observers don't break the response or other observers.
+        """
+        def fail(event):
+            raise Exception('foo')
+        i = JsonInterface(_StaticValueSystem('b'))
+        events = []
+        i.addObserver(fail)
+        i.addObserver(events.append)
+        response = self.successResultOf(run(i, 'foo'))
+        self.assertEqual(response['result'], 'b')
+        self.assertEqual(len(events), 1)
+
+
+
+class DeadlineTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cancelled = []
+        self.requests = []
+        self.rpc = RPCSystem()
+        self.rpc.addFunction('wait', self.wait)
+
+
+    def wait(self):
+        d = defer.Deferred(self.cancelled.append)
+        self.requests.append(d)
+        return d
+
+
+    def test_timeout(self):
+        """
+        Procedures that don't finish by the deadline are cancelled and the
+        request is answered with Timeout.
+        """
+        i = JsonInterface(self.rpc, timeout=5, clock=self.clock)
+        d = i.run(json.dumps(mkRequest('wait', id=1)))
+        self.clock.advance(4)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.assertEqual(len(self.cancelled), 1)
+        response = json.loads(self.successResultOf(d))
+        self.assertEqual(response['error']['code'], Timeout.code)
+        self.assertEqual(response['id'], 1)
+
+
+    def test_finishedInTime(self):
+        """
+        Procedures that finish in time aren't cancelled.
+        """
+        i = JsonInterface(self.rpc, timeout=5, clock=self.clock)
+        d = i.run(json.dumps(mkRequest('wait', id=1)))
+        self.requests[0].callback('done')
+        self.assertEqual(json.loads(self.successResultOf(d))['result'],
+                         'done')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_envelope(self):
+        """
+        A request can ask for a deadline with a timeout member, but not a
+        later one than the interface allows.
+        """
+        i = JsonInterface(self.rpc, timeout=5, clock=self.clock)
+        short = mkRequest('wait', id=1)
+        short['timeout'] = 1
+        long = mkRequest('wait', id=2)
+        long['timeout'] = 10
+        d = i.run(json.dumps([short, long]))
+        self.clock.advance(1)
+        self.assertEqual(len(self.cancelled), 1)
+        self.clock.advance(4)
+        self.assertEqual(len(self.cancelled), 2)
+        response = json.loads(self.successResultOf(d))
+        self.assertEqual([r['error']['code'] for r in response],
+                         [Timeout.code, Timeout.code])
+
+
+    def assertSharedDeadline(self, system):
+        """
+        When C{system} shares one call between identical requests, the
+        deadline of one request doesn't cut the others short.
+        """
+        i = JsonInterface(system, clock=self.clock)
+        short = mkRequest('wait', id=1)
+        short['timeout'] = 1
+        d1 = i.run(json.dumps(short))
+        d2 = i.run(json.dumps(mkRequest('wait', id=2)))
+        self.clock.advance(1)
+        response = json.loads(self.successResultOf(d1))
+        self.assertEqual(response['error']['code'], Timeout.code)
+        self.assertEqual(self.cancelled, [])
+        self.assertNoResult(d2)
+
+        self.requests[0].callback('done')
+        response = json.loads(self.successResultOf(d2))
+        self.assertEqual(response['result'], 'done')
+        self.assertEqual(self.flushLoggedErrors(), [])
+
+
+    def test_singleFlight(self):
+        """
+        Requests coalesced by a SingleFlightSystem each have their own
+        deadline.
+        """
+        self.assertSharedDeadline(SingleFlightSystem(self.rpc))
+
+
+    def test_singleFlight_system(self):
+        """
+        The call shared by a SingleFlightSystem doesn't time out at the
+        deadline of the first request, even when it resolves to a system
+        which checks the deadline again.
+        """
+        class Inner(object):
+            rpc = RPC()
+
+            @rpc.route('wait')
+            def wait(self, request):
+                return 'done'
+
+        pending = []
+        class Outer(object):
+            rpc = RPC()
+
+            @rpc.route('inner')
+            def inner(self, request):
+                pending.append(defer.Deferred())
+                return pending[-1]
+
+        i = JsonInterface(SingleFlightSystem(Outer().rpc), clock=self.clock)
+        short = mkRequest('inner.wait', id=1)
+        short['timeout'] = 1
+        d1 = i.run(json.dumps(short))
+        d2 = i.run(json.dumps(mkRequest('inner.wait', id=2)))
+        self.clock.advance(1)
+        response = json.loads(self.successResultOf(d1))
+        self.assertEqual(response['error']['code'], Timeout.code)
+
+        pending[0].callback(Inner().rpc)
+        response = json.loads(self.successResultOf(d2))
+        self.assertEqual(response['result'], 'done')
+
+
+    def test_resultCache(self):
+        """
+        Requests waiting on the same ResultCache call each have their own
+        deadline.
+        """
+        rpc = RPCSystem()
+        rpc.addFunction('wait', self.wait, cache=ResultCache())
+        self.assertSharedDeadline(rpc)
+
+
+    def test_envelope_invalid(self):
+        """
+        A timeout member that isn't a number makes the request invalid.
+        """
+        i = JsonInterface(self.rpc, clock=self.clock)
+        request = mkRequest('wait', id=1)
+        request['timeout'] = 'soon'
+        response = json.loads(self.successResultOf(
+            i.run(json.dumps(request))))
+        self.assertEqual(response['error']['code'], InvalidRequest.code)
+        self.assertEqual(self.requests, [])
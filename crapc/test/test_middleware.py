@@ -0,0 +1,46 @@
+from twisted.trial.unittest import TestCase
+
+from crapc.middleware import chain
+
+
+
+class ChainTest(TestCase):
+
+
+    def test_empty(self):
+        """
+        With no middleware, the chain is the handler itself.
+        """
+        handler = lambda request: request
+        self.assertIdentical(chain([], handler), handler)
+
+
+    def test_order(self):
+        """
+        The first middleware is outermost and the handler is called last.
+        """
+        called = []
+        def middleware(name):
+            def func(next, request):
+                called.append(name)
+                return next(request + [name])
+            return func
+        def handler(request):
+            called.append('handler')
+            return request
+
+        run = chain([middleware('a'), middleware('b')], handler)
+        self.assertEqual(run([]), ['a', 'b'])
+        self.assertEqual(called, ['a', 'b', 'handler'])
+
+
+    def test_shortCircuit(self):
+        """
+        Middleware that doesn't call C{next} stops the rest of the chain.
+        """
+        called = []
+        run = chain([lambda next, request: 'stopped',
+                     lambda next, request: called.append(request)],
+                    called.append)
+        self.assertEqual(run('request'), 'stopped')
+        self.assertEqual(called, [])
@@ -0,0 +1,277 @@
+import os
+import sys
+import threading
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, reactor, task
+
+from crapc.pool import ProcessPool, ThreadPool, blocking, _defaultThreadPool
+from crapc.unit import RPCSystem
+from crapc.helper import RPCFromObject
+from crapc.error import Overloaded, Timeout
+from crapc._request import Request
+
+
+
+def square(x):
+    return x * x
+
+
+def pid():
+    return os.getpid()
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+def unpicklableResult():
+    return lambda: None
+
+
+def exitWorker():
+    sys.exit(3)
+
+
+def die():
+    os._exit(3)
+
+
+
+class TwoArgError(Exception):
+    """
+    An exception which pickles but can't be unpickled, because its C{args}
+    don't match its constructor.
+    """
+
+    def __init__(self, a, b):
+        Exception.__init__(self, '%s %s' % (a, b))
+
+
+def raiseTwoArgError():
+    raise TwoArgError('a', 'b')
+
+
+
+class ProcessPoolTest(TestCase):
+
+    timeout = 30
+
+
+    def setUp(self):
+        self.pool = ProcessPool(1)
+        self.addCleanup(self.pool.stop)
+
+
+    @defer.inlineCallbacks
+    def test_run(self):
+        """
+        Functions are run in another process.
+        """
+        result = yield self.pool.run(square, 4)
+        self.assertEqual(result, 16)
+        worker = yield self.pool.run(pid)
+        self.assertNotEqual(worker, os.getpid())
+
+
+    def test_exception(self):
+        """
+        Exceptions raised by the function fail the Deferred.
+        """
+        d = self.pool.run(fail, 'the message')
+        d = self.assertFailure(d, ValueError)
+        d.addCallback(lambda e: self.assertEqual(str(e), 'the message'))
+        return d
+
+
+    def test_unpicklableArguments(self):
+        """
+        Arguments that can't be pickled fail right away.
+        """
+        self.failureResultOf(self.pool.run(square, lambda: None))
+
+
+    def test_unpicklableResult(self):
+        """
+        Results that can't be pickled fail the Deferred.
+        """
+        return self.assertFailure(self.pool.run(unpicklableResult),
+                                  RuntimeError)
+
+
+    def test_ununpicklableResult(self):
+        """
+        Outcomes that can't be unpickled fail the Deferred.
+        """
+        return self.assertFailure(self.pool.run(raiseTwoArgError), TypeError)
+
+
+    def test_ununpicklableArguments(self):
+        """
+        Arguments that the worker can't unpickle fail the Deferred.
+        """
+        return self.assertFailure(self.pool.run(square, TwoArgError('a', 'b')),
+                                  TypeError)
+
+
+    def test_exit(self):
+        """
+        A function calling C{sys.exit} fails the Deferred with SystemExit
+        instead of losing the call.
+        """
+        return self.assertFailure(self.pool.run(exitWorker), SystemExit)
+
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        """
+        Calls whose worker process dies fail with Timeout after C{timeout}
+        seconds, and the pool can still be stopped.
+        """
+        self.pool.timeout = 0.5
+        yield self.assertFailure(self.pool.run(die), Timeout)
+        result = yield self.pool.run(square, 3)
+        self.assertEqual(result, 9)
+
+
+    def test_cancel(self):
+        """
+        A call can be cancelled, and its result is then dropped.
+        """
+        d = self.pool.run(square, 3)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        return self.pool.run(square, 4)
+
+
+    @defer.inlineCallbacks
+    def test_addFunction(self):
+        """
+        Functions added to an RPCSystem with a pool run in the pool.
+        """
+        system = RPCSystem()
+        system.addFunction('square', square, pool=self.pool)
+        result = yield system.runProcedure(Request('square', {'x': 3}))
+        self.assertEqual(result, 9)
+
+
+
+class Blocking(object):
+
+    @blocking
+    def slow(self):
+        return threading.current_thread().ident
+
+    def fast(self):
+        return threading.current_thread().ident
+
+
+
+class ThreadPoolTest(TestCase):
+
+    timeout = 30
+
+
+    def setUp(self):
+        self.pool = ThreadPool(1)
+        self.addCleanup(self.pool.stop)
+
+
+    @defer.inlineCallbacks
+    def test_run(self):
+        """
+        Functions are run in another thread.
+        """
+        result = yield self.pool.run(square, 4)
+        self.assertEqual(result, 16)
+        ident = yield self.pool.run(lambda: threading.current_thread().ident)
+        self.assertNotEqual(ident, threading.current_thread().ident)
+
+
+    def test_exception(self):
+        """
+        Exceptions raised by the function fail the Deferred.
+        """
+        return self.assertFailure(self.pool.run(fail, 'the message'),
+                                  ValueError)
+
+
+    @defer.inlineCallbacks
+    def test_maxQueued(self):
+        """
+        Calls beyond the running threads and C{maxQueued} waiting ones fail
+        with Overloaded.
+        """
+        self.pool.maxQueued = 1
+        event = threading.Event()
+        running = self.pool.run(event.wait)
+        waiting = self.pool.run(square, 2)
+        self.failureResultOf(self.pool.run(square, 3), Overloaded)
+        event.set()
+        yield running
+        result = yield waiting
+        self.assertEqual(result, 4)
+        result = yield self.pool.run(square, 3)
+        self.assertEqual(result, 9)
+
+
+    @defer.inlineCallbacks
+    def test_maxQueued_cancelled(self):
+        """
+        A cancelled call counts against the limits until its thread is done.
+        """
+        self.pool.maxQueued = 0
+        event = threading.Event()
+        self.addCleanup(event.set)
+        running = self.pool.run(event.wait)
+        running.cancel()
+        self.failureResultOf(running, defer.CancelledError)
+        self.failureResultOf(self.pool.run(square, 3), Overloaded)
+
+        event.set()
+        while self.pool._pending:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        result = yield self.pool.run(square, 3)
+        self.assertEqual(result, 9)
+
+
+    @defer.inlineCallbacks
+    def test_blocking(self):
+        """
+        Only methods marked as blocking are run in the pool of an
+        RPCFromObject.
+        """
+        rpc = RPCFromObject(Blocking(), pool=self.pool)
+        me = threading.current_thread().ident
+        self.assertEqual(rpc.runProcedure(Request('fast')), me)
+        ident = yield rpc.runProcedure(Request('slow'))
+        self.assertNotEqual(ident, me)
+
+
+    @defer.inlineCallbacks
+    def test_blockingObject(self):
+        """
+        Every method of an RPCFromObject made with C{blocking=True} is run in
+        the pool.
+        """
+        rpc = RPCFromObject(Blocking(), pool=self.pool, blocking=True)
+        ident = yield rpc.runProcedure(Request('fast'))
+        self.assertNotEqual(ident, threading.current_thread().ident)
+
+
+    @defer.inlineCallbacks
+    def test_blockingWithoutPool(self):
+        """
+        Blocking methods of an RPCFromObject given no pool are run in the
+        default thread pool rather than the reactor thread.
+        """
+        self.addCleanup(_defaultThreadPool().stop)
+        me = threading.current_thread().ident
+        rpc = RPCFromObject(Blocking())
+        self.assertEqual(rpc.runProcedure(Request('fast')), me)
+        ident = yield rpc.runProcedure(Request('slow'))
+        self.assertNotEqual(ident, me)
+
+        rpc = RPCFromObject(Blocking(), blocking=True)
+        ident = yield rpc.runProcedure(Request('fast'))
+        self.assertNotEqual(ident, me)
@@ -1,7 +1,9 @@
 from twisted.trial.unittest import TestCase
+from twisted.internet import task
 
 
 from crapc._request import Request
+from crapc.error import Timeout
 
 
 class RequestTest(TestCase):
@@ -89,6 +91,107 @@ class RequestTest(TestCase):
         self.assertEqual(r.method, '')
 
 
+    def test_child_deep(self):
+        """
+        Each call to L{child} removes one more segment, leaving C{full_method}
+        alone.
+        """
+        r = Request('a.b.c.d')
+        self.assertEqual(r.segment, 'a')
+        self.assertFalse(r.isLeaf())
+        r.child().child()
+        self.assertEqual(r.method, 'c.d')
+        self.assertEqual(r.segment, 'c')
+        self.assertFalse(r.isLeaf())
+        r.child()
+        self.assertEqual(r.method, 'd')
+        self.assertTrue(r.isLeaf())
+        r.child()
+        self.assertEqual(r.method, '')
+        self.assertEqual(r.segment, '')
+        self.assertTrue(r.isLeaf())
+        self.assertEqual(r.full_method, 'a.b.c.d')
+
+
+    def test_setMethod(self):
+        """
+        You can replace the remaining part of the method.
+        """
+        r = Request('a.b.c')
+        r.child()
+        r.method = 'x.y'
+        self.assertEqual(r.method, 'x.y')
+        self.assertEqual(r.segment, 'x')
+        r.child()
+        self.assertEqual(r.method, 'y')
+        self.assertEqual(r.full_method, 'a.b.c')
+
+
+    def test_slots(self):
+        """
+        Requests don't carry a per-instance C{__dict__}.
+        """
+        r = Request('foo')
+        self.assertRaises(AttributeError, setattr, r, 'foo', 'bar')
+
+
+    def test_deadline(self):
+        """
+        A request can be given a deadline.
+        """
+        clock = task.Clock()
+        r = Request('foo')
+        self.assertEqual(r.deadline, None)
+        self.assertEqual(r.remaining(), None)
+        self.assertFalse(r.expired())
+        r.checkDeadline()
+
+        r.setDeadline(5, clock.seconds)
+        self.assertEqual(r.deadline, 5)
+        clock.advance(2)
+        self.assertEqual(r.remaining(), 3)
+        self.assertFalse(r.expired())
+        clock.advance(3)
+        self.assertTrue(r.expired())
+        self.assertRaises(Timeout, r.checkDeadline)
+
+
+    def test_deadline_earliest(self):
+        """
+        Setting a later deadline keeps the earlier one.
+        """
+        clock = task.Clock()
+        r = Request('foo')
+        r.setDeadline(5, clock.seconds)
+        r.setDeadline(10, clock.seconds)
+        self.assertEqual(r.deadline, 5)
+        r.setDeadline(1, clock.seconds)
+        self.assertEqual(r.deadline, 1)
+
+
+    def test_withoutDeadline(self):
+        """
+        You can copy a request without its deadline.
+        """
+        clock = task.Clock()
+        r = Request('foo.bar', [1])
+        r.child()
+        r.context['a'] = 1
+        r.setDeadline(5, clock.seconds)
+        copy = r.withoutDeadline()
+        self.assertEqual(copy.deadline, None)
+        self.assertEqual(copy.remaining(), None)
+        self.assertEqual(copy.method, 'bar')
+        self.assertEqual(copy.full_method, 'foo.bar')
+        self.assertEqual(copy.params, [1])
+        self.assertEqual(copy.context, {'a': 1})
+        copy.context['b'] = 2
+        copy.child()
+        self.assertEqual(r.context, {'a': 1})
+        self.assertEqual(r.method, 'bar')
+        self.assertEqual(r.deadline, 5)
+
+
     def test_stripParams(self):
         """
         You can make a new request object that is missing a named parameter.
@@ -0,0 +1,94 @@
+from twisted.trial.unittest import TestCase
+
+from crapc._signature import signature
+from crapc.error import InvalidParams
+
+
+
+class SignatureTest(TestCase):
+
+
+    def assertAccepts(self, func, *args, **kwargs):
+        signature(func).check(args, kwargs)
+
+
+    def assertRejects(self, func, *args, **kwargs):
+        self.assertRaises(InvalidParams, signature(func).check, args, kwargs)
+
+
+    def test_positional(self):
+        def f(a, b, c=3):
+            pass
+        self.assertAccepts(f, 1, 2)
+        self.assertAccepts(f, 1, 2, 3)
+        self.assertAccepts(f, 1, b=2)
+        self.assertAccepts(f, a=1, b=2, c=3)
+        self.assertRejects(f, 1)
+        self.assertRejects(f, 1, 2, 3, 4)
+        self.assertRejects(f, 1, 2, d=4)
+        self.assertRejects(f, 1, 2, a=1)
+        self.assertRejects(f, c=1)
+
+
+    def test_varargs(self):
+        def f(a, *args, **kwargs):
+            pass
+        self.assertAccepts(f, 1, 2, 3, 4)
+        self.assertAccepts(f, 1, foo=2)
+        self.assertRejects(f)
+
+
+    def test_methods(self):
+        """
+        Methods, bound or not, are described without C{self}.
+        """
+        class Foo(object):
+            def method(self, a):
+                pass
+            def __call__(self, b):
+                pass
+        signature(Foo.method, unbound=True).check((1,), {})
+        self.assertAccepts(Foo().method, 1)
+        self.assertRejects(Foo().method, 1, 2)
+        self.assertAccepts(Foo(), b=1)
+        self.assertRejects(Foo(), a=1)
+
+
+    def test_staticAndClassMethods(self):
+        """
+        Static methods are described like functions, and class methods
+        without C{cls}.
+        """
+        class Foo(object):
+            @staticmethod
+            def static(a, b):
+                pass
+            @classmethod
+            def klass(cls, a):
+                pass
+        self.assertAccepts(Foo.static, 1, 2)
+        self.assertAccepts(Foo().static, 1, 2)
+        self.assertRejects(Foo.static, 1)
+        self.assertAccepts(Foo.klass, 1)
+        self.assertRejects(Foo.klass, 1, 2)
+
+
+    def test_wrapped(self):
+        """
+        Functions with a C{__wrapped__} attribute are described by the
+        wrapped function.
+        """
+        def f(a):
+            pass
+        def wrapper(*args, **kwargs):
+            pass
+        wrapper.__wrapped__ = f
+        self.assertRejects(wrapper, 1, 2)
+
+
+    def test_unknown(self):
+        """
+        Things that can't be introspected have no signature.
+        """
+        self.assertEqual(signature(len), None)
+        self.assertEqual(signature(object), None)
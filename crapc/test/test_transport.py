@@ -0,0 +1,244 @@
+from twisted.trial.unittest import TestCase
+from twisted.test.proto_helpers import StringTransport
+from twisted.web.test.requesthelper import DummyRequest
+from twisted.web.server import NOT_DONE_YET
+from twisted.internet import defer, reactor, endpoints
+from twisted.protocols.basic import LineOnlyReceiver
+
+import json
+import struct
+from io import BytesIO
+
+from crapc.unit import RPCSystem
+from crapc.jsonrpc import JsonInterface, InternalError
+from crapc.transport import JsonRpcFactory, JsonRpcLineProtocol
+from crapc.transport import JsonRpcLengthPrefixedProtocol, JsonRpcResource
+from crapc.transport import serve
+from crapc.test.test_jsonrpc import mkRequest, mkNotification
+
+
+
+def encode(request):
+    """
+    Serialize a request object made by L{mkRequest} or L{mkNotification}.
+    """
+    return json.dumps(request).encode('utf-8')
+
+
+
+class _TransportTestMixin(object):
+
+    def setUp(self):
+        self.pending = {}
+        rpc = RPCSystem()
+        rpc.addFunction('add', lambda a, b: a + b)
+        rpc.addFunction('wait', self.wait)
+        rpc.addFunction('unserializable', object)
+        self.errors = []
+        self.interface = JsonInterface(rpc, logError=self.errors.append)
+
+
+    def wait(self, name):
+        d = self.pending[name] = defer.Deferred()
+        return d
+
+
+    def connect(self, protocol_class, **kwargs):
+        factory = JsonRpcFactory(self.interface, protocol_class, **kwargs)
+        proto = factory.buildProtocol(None)
+        transport = StringTransport()
+        proto.makeConnection(transport)
+        return proto, transport
+
+
+
+class LineProtocolTest(_TransportTestMixin, TestCase):
+
+
+    def test_request(self):
+        """
+        Each line is a request, and each response is written as a line.
+        """
+        proto, transport = self.connect(JsonRpcLineProtocol)
+        proto.dataReceived(encode(mkRequest('add', [1, 2], id=1)) + b'\n')
+        response = json.loads(transport.value().decode('utf-8'))
+        self.assertEqual(response['result'], 3)
+        self.assertTrue(transport.value().endswith(b'\n'))
+
+
+    def test_pipelined(self):
+        """
+        Requests are run as they arrive, and responses are written as they
+        finish.
+        """
+        proto, transport = self.connect(JsonRpcLineProtocol)
+        proto.dataReceived(encode(mkRequest('wait', ['a'], id=1)) + b'\n' +
+                           encode(mkRequest('add', [1, 2], id=2)) + b'\n')
+        lines = transport.value().splitlines()
+        self.assertEqual([json.loads(l.decode('utf-8'))['id'] for l in lines],
+                         [2])
+        self.pending['a'].callback('done')
+        lines = transport.value().splitlines()
+        self.assertEqual([json.loads(l.decode('utf-8'))['id'] for l in lines],
+                         [2, 1])
+
+
+    def test_notification(self):
+        """
+        Notifications get no response.
+        """
+        proto, transport = self.connect(JsonRpcLineProtocol)
+        proto.dataReceived(encode(mkNotification('add', [1, 2])) + b'\n')
+        self.assertEqual(transport.value(), b'')
+
+
+    def test_failed(self):
+        """
+        If a request can't be answered, an InternalError response is sent
+        and the failure is logged.
+        """
+        proto, transport = self.connect(JsonRpcLineProtocol)
+        proto.dataReceived(encode(mkRequest('unserializable', id=1)) + b'\n')
+        response = json.loads(transport.value().decode('utf-8'))
+        self.assertEqual(response['error']['code'], InternalError.code)
+        self.assertEqual(response['id'], None)
+        self.assertEqual(len(self.errors), 1)
+
+
+    def test_maxLength(self):
+        """
+        The connection is dropped if a line is too long.
+        """
+        proto, transport = self.connect(JsonRpcLineProtocol, maxLength=10)
+        proto.dataReceived(encode(mkRequest('add', [1, 2], id=1)) + b'\n')
+        self.assertTrue(transport.disconnecting)
+
+
+    def test_maxPipelined(self):
+        """
+        Reading stops while too many requests are running.
+        """
+        proto, transport = self.connect(JsonRpcLineProtocol, maxPipelined=2)
+        proto.dataReceived(encode(mkRequest('wait', ['a'], id=1)) + b'\n')
+        self.assertEqual(transport.producerState, 'producing')
+        proto.dataReceived(encode(mkRequest('wait', ['b'], id=2)) + b'\n')
+        self.assertEqual(transport.producerState, 'paused')
+        self.pending['a'].callback('done')
+        self.assertEqual(transport.producerState, 'producing')
+
+
+
+class LengthPrefixedProtocolTest(_TransportTestMixin, TestCase):
+
+
+    def test_request(self):
+        """
+        Requests and responses are preceded by their length.
+        """
+        proto, transport = self.connect(JsonRpcLengthPrefixedProtocol)
+        request = encode(mkRequest('add', [1, 2], id=1))
+        proto.dataReceived(struct.pack('!I', len(request)) + request)
+        written = transport.value()
+        length, = struct.unpack('!I', written[:4])
+        self.assertEqual(length, len(written) - 4)
+        self.assertEqual(json.loads(written[4:].decode('utf-8'))['result'], 3)
+
+
+
+class JsonRpcResourceTest(_TransportTestMixin, TestCase):
+
+
+    def post(self, body):
+        request = DummyRequest([b''])
+        request.method = b'POST'
+        request.content = BytesIO(body)
+        result = JsonRpcResource(self.interface).render(request)
+        self.assertEqual(result, NOT_DONE_YET)
+        return request
+
+
+    def test_request(self):
+        """
+        POSTed requests are answered in the body of the response.
+        """
+        request = self.post(encode(mkRequest('add', [1, 2], id=1)))
+        self.assertEqual(request.finished, 1)
+        response = json.loads(b''.join(request.written).decode('utf-8'))
+        self.assertEqual(response['result'], 3)
+        self.assertEqual(request.responseHeaders.getRawHeaders(
+                         b'content-type'), [b'application/json'])
+
+
+    def test_failed(self):
+        """
+        If a request can't be answered, the HTTP request is finished with a
+        500 status and an InternalError response.
+        """
+        request = self.post(encode(mkRequest('unserializable', id=1)))
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(request.responseCode, 500)
+        response = json.loads(b''.join(request.written).decode('utf-8'))
+        self.assertEqual(response['error']['code'], InternalError.code)
+        self.assertEqual(len(self.errors), 1)
+
+
+    def test_notification(self):
+        """
+        Notifications get an empty response.
+        """
+        request = self.post(encode(mkNotification('add', [1, 2])))
+        self.assertEqual(request.responseCode, 204)
+        self.assertEqual(request.written, [])
+
+
+    def test_disconnected(self):
+        """
+        Nothing is written if the client goes away before the response is
+        ready.
+        """
+        request = self.post(encode(mkRequest('wait', ['a'], id=1)))
+        request.processingFailed(Exception('gone'))
+        self.pending['a'].callback('done')
+        self.assertEqual(request.written, [])
+
+
+
+class _LineClient(LineOnlyReceiver):
+
+    delimiter = b'\n'
+
+    def connectionMade(self):
+        self.lines = defer.DeferredQueue()
+
+
+    def lineReceived(self, line):
+        self.lines.put(line)
+
+
+
+class ServeTest(_TransportTestMixin, TestCase):
+
+
+    @defer.inlineCallbacks
+    def test_tcp(self):
+        """
+        serve listens on an endpoint.
+        """
+        port = yield serve(self.interface, 'tcp:0:interface=127.0.0.1')
+        self.addCleanup(port.stopListening)
+
+        endpoint = endpoints.TCP4ClientEndpoint(reactor, '127.0.0.1',
+                                                port.getHost().port)
+        client = yield endpoints.connectProtocol(endpoint, _LineClient())
+        self.addCleanup(client.transport.loseConnection)
+        client.sendLine(encode(mkRequest('add', [1, 2], id=1)))
+        line = yield client.lines.get()
+        self.assertEqual(json.loads(line.decode('utf-8'))['result'], 3)
+
+
+    def test_unknownFraming(self):
+        """
+        Unknown framings are rejected.
+        """
+        self.assertRaises(ValueError, serve, self.interface, 'tcp:0',
+                          'carrier-pigeon')
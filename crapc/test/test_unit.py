@@ -1,21 +1,22 @@
 from twisted.trial.unittest import TestCase
-from twisted.internet import defer
+from twisted.internet import defer, task
 
-from zope.interface import implements
+from zope.interface import implementer
 from zope.interface.verify import verifyObject
 
 from mock import create_autospec
 
 from crapc.interface import ISystem
 from crapc._request import Request
-from crapc.error import MethodNotFound
+from crapc.error import MethodNotFound, InvalidParams, Timeout
 from crapc.unit import RPCSystem, RPC
+from crapc.cache import ResultCache
 
 
 
+@implementer(ISystem)
 class _StaticValueSystem(object):
 
-    implements(ISystem)
 
     def __init__(self, value):
         self.value = value
@@ -41,6 +42,19 @@ class RPCSystemTest(TestCase):
         self.assertRaises(MethodNotFound, s.runProcedure, Request('foo'))
 
 
+    def test_runProcedure_expired(self):
+        """
+        Requests whose deadline has passed aren't run.
+        """
+        called = []
+        s = RPCSystem()
+        s.addFunction('foo', lambda: called.append(True))
+        r = Request('foo')
+        r.setDeadline(0, task.Clock().seconds)
+        self.assertRaises(Timeout, s.runProcedure, r)
+        self.assertEqual(called, [])
+
+
     def test_runProcedure_args(self):
         """
         If positional args are given, they should work when calling the
@@ -60,6 +74,29 @@ class RPCSystemTest(TestCase):
         self.assertRaises(MethodNotFound, s.runProcedure, Request('foo.bar'))
 
 
+    def test_runProcedure_InvalidParams(self):
+        """
+        If the params don't fit the function's signature, raise InvalidParams
+        without calling the function.
+        """
+        called = []
+        def func(a, b=2):
+            called.append(a)
+        s = RPCSystem()
+        s.addFunction('foo', func)
+        sub = RPCSystem()
+        sub.addFunction('foo', func)
+        s.addSystem('sub', sub)
+        self.assertRaises(InvalidParams, s.runProcedure, Request('foo'))
+        self.assertRaises(InvalidParams, s.runProcedure,
+                          Request('foo', [1, 2, 3]))
+        self.assertRaises(InvalidParams, s.runProcedure,
+                          Request('foo', {'c': 1}))
+        s.compile()
+        self.assertRaises(InvalidParams, s.runProcedure, Request('sub.foo'))
+        self.assertEqual(called, [])
+
+
     def test_addFunction(self):
         """
         You can add functions and then run them.
@@ -71,6 +108,27 @@ class RPCSystemTest(TestCase):
         self.assertEqual(r, 'xylofoo')
 
 
+    def test_addFunction_cache(self):
+        """
+        You can cache the results of functions.
+        """
+        called = []
+        def func(x):
+            called.append(x)
+            return x + 1
+        s = RPCSystem()
+        s.addFunction('foo', func, cache=ResultCache())
+        root = RPCSystem()
+        root.addSystem('s', s)
+
+        self.assertEqual(root.runProcedure(Request('s.foo', [1])), 2)
+        self.assertEqual(root.runProcedure(Request('s.foo', [1])), 2)
+        self.assertEqual(root.runProcedure(Request('s.foo', {'x': 2})), 3)
+        root.compile()
+        self.assertEqual(root.runProcedure(Request('s.foo', [1])), 2)
+        self.assertEqual(called, [1, 2])
+
+
     def test_addSystem(self):
         """
         You can add subsystems to a system.
@@ -108,6 +166,144 @@ class RPCSystemTest(TestCase):
         self.assertEqual(result, 'turn up the funk')
 
 
+    def test_compile(self):
+        """
+        A compiled system finds procedures in nested systems without
+        walking through the subsystems.
+        """
+        b = RPCSystem()
+        a = RPCSystem()
+        root = RPCSystem()
+
+        root.addSystem('a', a)
+        a.addSystem('b', b)
+        b.addFunction('func', lambda x:x+'funk')
+        root.addFunction('top', lambda: 'top')
+
+        self.assertIdentical(root.compile(), root)
+        b.runProcedure = create_autospec(b.runProcedure)
+        a.runProcedure = create_autospec(a.runProcedure)
+
+        result = root.runProcedure(Request('a.b.func', ['turn up the ']))
+        self.assertEqual(result, 'turn up the funk')
+        self.assertEqual(root.runProcedure(Request('top')), 'top')
+        self.assertEqual(a.runProcedure.call_count, 0, "Should not have "
+                         "walked through the subsystems")
+        self.assertEqual(b.runProcedure.call_count, 0)
+
+
+    def test_compile_MethodNotFound(self):
+        """
+        A compiled system still raises MethodNotFound for missing methods.
+        """
+        root = RPCSystem()
+        root.addSystem('a', RPCSystem())
+        root.compile()
+        self.assertRaises(MethodNotFound, root.runProcedure, Request('foo'))
+        self.assertRaises(MethodNotFound, root.runProcedure,
+                          Request('a.foo'))
+        self.assertRaises(MethodNotFound, root.runProcedure,
+                          Request('b.foo'))
+
+
+    def test_compile_otherSystems(self):
+        """
+        Procedures in subsystems that aren't L{RPCSystem}s are still found.
+        """
+        root = RPCSystem()
+        root.addSystem('static', _StaticValueSystem('value'))
+        root.compile()
+        self.assertEqual(root.runProcedure(Request('static.foo')), 'value')
+
+
+    def test_compile_mutate(self):
+        """
+        The index is rebuilt when functions or systems are added to the
+        compiled system or to any nested system.
+        """
+        a = RPCSystem()
+        root = RPCSystem()
+        root.addSystem('a', a)
+        root.compile()
+
+        root.addFunction('foo', lambda: 'foo')
+        self.assertEqual(root._index['foo'][0](), 'foo')
+
+        a.addFunction('bar', lambda: 'bar')
+        self.assertEqual(root._index['a.bar'][0](), 'bar')
+
+        b = RPCSystem()
+        b.addFunction('baz', lambda: 'baz')
+        a.addSystem('b', b)
+        self.assertEqual(root._index['a.b.baz'][0](), 'baz')
+        self.assertEqual(root.runProcedure(Request('a.b.baz')), 'baz')
+
+
+    def test_addMiddleware(self):
+        """
+        Requests run through the middleware in the order it was added, and
+        synchronous results stay synchronous.
+        """
+        called = []
+        def outer(next, request):
+            called.append(('outer', request.method))
+            return next(request) + '!'
+        def inner(next, request):
+            called.append(('inner', request.method))
+            return next(request)
+
+        rpc = RPCSystem()
+        sub = RPCSystem()
+        rpc.addSystem('sub', sub)
+        sub.addFunction('foo', lambda: 'foo')
+        rpc.addMiddleware(outer)
+        rpc.addMiddleware(inner)
+
+        self.assertEqual(rpc.runProcedure(Request('sub.foo')), 'foo!')
+        self.assertEqual(called, [('outer', 'sub.foo'),
+                                  ('inner', 'sub.foo')])
+
+
+    def test_addMiddleware_refuse(self):
+        """
+        Middleware can refuse a request by raising instead of calling
+        C{next}.
+        """
+        def refuse(next, request):
+            raise MethodNotFound(request.full_method)
+        called = []
+        rpc = RPCSystem()
+        rpc.addFunction('foo', called.append)
+        rpc.addMiddleware(refuse)
+
+        self.assertRaises(MethodNotFound, rpc.runProcedure,
+                          Request('foo', ['x']))
+        self.assertEqual(called, [])
+
+
+    def test_addMiddleware_compiled(self):
+        """
+        The middleware of nested systems is still run when the root system
+        is compiled, including middleware added after compiling.
+        """
+        called = []
+        def record(next, request):
+            called.append(request.method)
+            return next(request)
+
+        a = RPCSystem()
+        root = RPCSystem()
+        root.addSystem('a', a)
+        a.addFunction('foo', lambda: 'foo')
+        root.compile()
+        self.assertIn('a.foo', root._index)
+
+        a.addMiddleware(record)
+        self.assertNotIn('a.foo', root._index)
+        self.assertEqual(root.runProcedure(Request('a.foo')), 'foo')
+        self.assertEqual(called, ['foo'])
+
+
 
 class RPCTest(TestCase):
 
@@ -157,6 +353,34 @@ class RPCTest(TestCase):
         self.assertEqual(self.successResultOf(result), 'ret val')
 
 
+    def test_route_cache(self):
+        """
+        You can cache the results of routes per instance.
+        """
+        called = []
+
+        class Foo(object):
+            rpc = RPC()
+
+            def __init__(self, name):
+                self.name = name
+
+            @rpc.route('foo', cache=ResultCache())
+            def foo(self, request):
+                called.append(request.full_params)
+                return self.name + str(request.args()[0])
+
+        a = Foo('a')
+        b = Foo('b')
+        result = a.rpc.runProcedure(Request('foo', [1]))
+        self.assertEqual(self.successResultOf(result), 'a1')
+        result = a.rpc.runProcedure(Request('foo', [1]))
+        self.assertEqual(self.successResultOf(result), 'a1')
+        result = b.rpc.runProcedure(Request('foo', [1]))
+        self.assertEqual(self.successResultOf(result), 'b1')
+        self.assertEqual(called, [[1], [1]])
+
+
     def test_route_noDot(self):
         """
         routes can handle things without dots.
@@ -303,6 +527,114 @@ class RPCTest(TestCase):
         self.assertEqual(self.successResultOf(result), 'foo or something')
 
 
+    def test_middleware(self):
+        """
+        Middleware methods are run in the order they are declared, with the
+        instance.  Synchronous results don't make extra C{Deferred}s.
+        """
+        called = []
+
+        class Foo(object):
+            rpc = RPC()
+
+            @rpc.middleware
+            def outer(self, next, request):
+                called.append(('outer', self))
+                return next(request) + '!'
+
+            @rpc.middleware
+            def inner(self, next, request):
+                called.append(('inner', self))
+                return next(request)
+
+            @rpc.route('foo')
+            def foo(self, request):
+                return 'foo'
+
+        foo = Foo()
+        self.assertEqual(foo.rpc._runProcedure(Request('foo')), 'foo!')
+        self.assertEqual(called, [('outer', foo), ('inner', foo)])
+        result = foo.rpc.runProcedure(Request('foo'))
+        self.assertEqual(self.successResultOf(result), 'foo!')
+
+
+    def test_middleware_prehook(self):
+        """
+        The prehook runs before all other middleware.
+        """
+        called = []
+
+        class Foo(object):
+            rpc = RPC()
+
+            @rpc.middleware
+            def mw(self, next, request):
+                called.append('middleware')
+                return next(request)
+
+            @rpc.prehook
+            def hook(self, func, request):
+                called.append('prehook')
+                return func(request)
+
+            @rpc.default
+            def default(self, request):
+                return 'hello'
+
+        result = Foo().rpc.runProcedure(Request('foo'))
+        self.assertEqual(self.successResultOf(result), 'hello')
+        self.assertEqual(called, ['prehook', 'middleware'])
+
+
+    def test_middleware_addedLater(self):
+        """
+        Middleware declared after an instance was used still runs for it.
+        """
+        descriptor = RPC()
+        class Foo(object):
+            rpc = descriptor
+
+            @descriptor.route('foo')
+            def foo(self, request):
+                return defer.succeed('foo')
+
+        foo = Foo()
+        self.assertEqual(self.successResultOf(foo.rpc.runProcedure(
+                         Request('foo'))), 'foo')
+
+        def shout(self, next, request):
+            return next(request).addCallback(lambda x: x.upper())
+        descriptor.middleware(shout)
+        self.assertEqual(self.successResultOf(foo.rpc.runProcedure(
+                         Request('foo'))), 'FOO')
+
+
+    def test_nestedRPC(self):
+        """
+        Routes may return other L{RPC} systems, whose middleware runs too.
+        """
+        class Inner(object):
+            rpc = RPC()
+
+            @rpc.middleware
+            def mw(self, next, request):
+                return next(request) + ' inside'
+
+            @rpc.route('bar')
+            def bar(self, request):
+                return 'bar'
+
+        class Outer(object):
+            rpc = RPC()
+
+            @rpc.route('inner')
+            def inner(self, request):
+                return Inner().rpc
+
+        result = Outer().rpc._runProcedure(Request('inner.bar'))
+        self.assertEqual(result, 'bar inside')
+
+
     def test_sub_sub_sub_system(self):
         """
         As many L{ISystem} instances as are returned should be evaluated.
@@ -321,3 +653,33 @@ class RPCTest(TestCase):
 
         result = foo.rpc.runProcedure(req)
         self.assertEqual(self.successResultOf(result), 'foo')
+
+
+
+    def test_expired(self):
+        """
+        Systems returned by routes aren't run once the deadline of the
+        request has passed.
+        """
+        clock = task.Clock()
+
+        class Foo(object):
+            rpc = RPC()
+
+            @rpc.prehook
+            def hook(self, func, request):
+                clock.advance(1)
+                return func(request)
+
+            @rpc.route('foo')
+            def foo(self, request):
+                clock.advance(1)
+                return create_autospec(ISystem)
+
+        req = Request('foo.bar')
+        req.setDeadline(1.5, clock.seconds)
+        self.failureResultOf(Foo().rpc.runProcedure(req), Timeout)
+
+        req = Request('foo.bar')
+        req.setDeadline(0.5, clock.seconds)
+        self.failureResultOf(Foo().rpc.runProcedure(req), Timeout)
@@ -0,0 +1,260 @@
+"""
+Network transports for L{crapc.jsonrpc.JsonInterface}.
+
+Requests can be framed one per line (L{JsonRpcLineProtocol}), with a 4-byte
+length prefix (L{JsonRpcLengthPrefixedProtocol}) or sent over HTTP
+(L{JsonRpcResource}).  Use L{serve} to listen on TCP or a Unix socket.
+"""
+
+__all__ = ['JsonRpcLineProtocol', 'JsonRpcLengthPrefixedProtocol',
+           'JsonRpcFactory', 'JsonRpcResource', 'serve']
+
+
+from twisted.internet import protocol, endpoints
+from twisted.protocols.basic import LineOnlyReceiver, Int32StringReceiver
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+
+from crapc.jsonrpc import InternalError
+
+
+
+def _internalError(failure, interface):
+    """
+    Log C{failure}, from running a request with C{interface}, and make the
+    response to send instead.
+
+    @return: A serialized L{InternalError} response.
+    """
+    interface._log(failure)
+    return interface._serialize(interface._makeError(
+        InternalError.code, InternalError.public_message, None))
+
+
+
+class _Pipeline(object):
+    """
+    Runs each request received on a connection as soon as it arrives, so a
+    client can send several requests without waiting for the responses.
+    Responses are sent in the order they finish; clients match them to their
+    requests by id.
+
+    Reading from the connection is paused while C{maxPipelined} requests are
+    running.
+
+    @ivar interface: The L{crapc.jsonrpc.JsonInterface} to run requests with.
+    """
+
+    interface = None
+    maxPipelined = 100
+    _running = 0
+    _paused = False
+    _closed = False
+
+    def requestReceived(self, data):
+        """
+        Run the serialized request C{data} and send its response.
+        """
+        self._running += 1
+        if self._running >= self.maxPipelined and not self._paused:
+            self._paused = True
+            self.transport.pauseProducing()
+        d = self.interface.run(data)
+        d.addErrback(_internalError, self.interface)
+        d.addCallback(self._respond)
+        d.addErrback(self.interface._log)
+        d.addBoth(self._done)
+
+
+    def _respond(self, response):
+        if response is not None and not self._closed:
+            self.sendResponse(response)
+
+
+    def _done(self, _):
+        self._running -= 1
+        if self._paused and self._running < self.maxPipelined:
+            self._paused = False
+            if not self._closed:
+                self.transport.resumeProducing()
+
+
+    def connectionLost(self, reason):
+        self._closed = True
+
+
+
+class JsonRpcLineProtocol(_Pipeline, LineOnlyReceiver):
+    """
+    JSON-RPC with one request or response per line.
+
+    The serializer must not put newlines in responses, which the default
+    codecs never do.
+
+    @cvar MAX_LENGTH: The longest request allowed, in bytes.  The connection
+        is dropped if a longer one is received.
+    """
+
+    delimiter = b'\n'
+    MAX_LENGTH = 1024 * 1024
+
+    def lineReceived(self, line):
+        if line.strip():
+            self.requestReceived(line)
+
+
+    def sendResponse(self, response):
+        self.sendLine(response)
+
+
+    def connectionLost(self, reason):
+        _Pipeline.connectionLost(self, reason)
+        LineOnlyReceiver.connectionLost(self, reason)
+
+
+
+class JsonRpcLengthPrefixedProtocol(_Pipeline, Int32StringReceiver):
+    """
+    JSON-RPC with each request and response preceded by its length as a
+    4-byte big-endian integer.
+
+    @cvar MAX_LENGTH: The longest request allowed, in bytes.  The connection
+        is dropped if a longer one is announced.
+    """
+
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    def stringReceived(self, data):
+        self.requestReceived(data)
+
+
+    def sendResponse(self, response):
+        self.sendString(response)
+
+
+    def connectionLost(self, reason):
+        _Pipeline.connectionLost(self, reason)
+        Int32StringReceiver.connectionLost(self, reason)
+
+
+
+class JsonRpcFactory(protocol.Factory):
+    """
+    Makes connections which run requests with a
+    L{crapc.jsonrpc.JsonInterface}.
+    """
+
+    protocol = JsonRpcLineProtocol
+
+    def __init__(self, interface, protocol=None, maxLength=None,
+                 maxPipelined=None):
+        """
+        @param interface: The L{crapc.jsonrpc.JsonInterface} to run requests
+            with.
+        @param protocol: L{JsonRpcLineProtocol} (the default) or
+            L{JsonRpcLengthPrefixedProtocol}.
+        @param maxLength: Overrides the C{MAX_LENGTH} of the protocol.
+        @param maxPipelined: Overrides how many requests a single connection
+            may run at once.
+        """
+        self.interface = interface
+        if protocol is not None:
+            self.protocol = protocol
+        self.maxLength = maxLength
+        self.maxPipelined = maxPipelined
+
+
+    def buildProtocol(self, addr):
+        p = protocol.Factory.buildProtocol(self, addr)
+        p.interface = self.interface
+        if self.maxLength is not None:
+            p.MAX_LENGTH = self.maxLength
+        if self.maxPipelined is not None:
+            p.maxPipelined = self.maxPipelined
+        return p
+
+
+
+class JsonRpcResource(Resource):
+    """
+    A C{twisted.web} resource that answers JSON-RPC requests POSTed to it.
+
+    Requests made up only of notifications are answered with
+    C{204 No Content}.  If running a request fails outright (for instance,
+    because its result can't be serialized), it is answered with
+    C{500 Internal Server Error} and an L{InternalError} response.
+
+    The body of the request is given to the interface as a file, so a
+    custom C{deserialize} function must accept files.
+    """
+
+    isLeaf = True
+
+    def __init__(self, interface, contentType=b'application/json'):
+        Resource.__init__(self)
+        self.interface = interface
+        self.contentType = contentType
+
+
+    def render_POST(self, request):
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+
+        d = self.interface.run(request.content)
+
+        def failed(failure):
+            if not finished:
+                request.setResponseCode(500)
+            return _internalError(failure, self.interface)
+
+        def respond(response):
+            if finished:
+                # the client went away
+                return
+            if response is None:
+                request.setResponseCode(204)
+            else:
+                request.setHeader(b'Content-Type', self.contentType)
+                request.setHeader(b'Content-Length',
+                                  str(len(response)).encode('ascii'))
+                request.write(response)
+            request.finish()
+
+        d.addErrback(failed)
+        d.addCallback(respond)
+        d.addErrback(self.interface._log)
+        return NOT_DONE_YET
+
+
+
+_framings = {
+    'line': JsonRpcLineProtocol,
+    'length': JsonRpcLengthPrefixedProtocol,
+}
+
+
+def serve(interface, description, framing='line', reactor=None):
+    """
+    Listen for JSON-RPC requests.
+
+    @param interface: The L{crapc.jsonrpc.JsonInterface} to run requests
+        with.
+    @param description: A server endpoint description, such as
+        C{'tcp:7080'} or C{'unix:/var/run/service.sock'}.
+    @param framing: C{'line'} for one request per line, C{'length'} for
+        length-prefixed requests or C{'http'} for HTTP POSTs (with
+        keep-alive).
+    @param reactor: The reactor to listen with.
+
+    @return: A C{Deferred} which fires with the C{IListeningPort}.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    if framing == 'http':
+        factory = Site(JsonRpcResource(interface))
+    elif framing in _framings:
+        factory = JsonRpcFactory(interface, _framings[framing])
+    else:
+        raise ValueError('Unknown framing: %r' % (framing,))
+    endpoint = endpoints.serverFromString(reactor, description)
+    return endpoint.listen(factory)
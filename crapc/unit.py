@@ -1,4 +1,4 @@
-from zope.interface import implements
+from zope.interface import implementer
 
 from functools import wraps, partial
 from weakref import WeakKeyDictionary
@@ -7,9 +7,13 @@ from twisted.internet import defer
 
 from crapc.error import MethodNotFound
 from crapc.interface import ISystem
+from crapc._signature import signature
+from crapc.cache import requestKey
+from crapc.middleware import chain
 
 
 
+@implementer(ISystem)
 class RPCSystem(object):
     """
     This is a collection of named functions and subsystems.
@@ -20,50 +24,122 @@ class RPCSystem(object):
     
     Then execute procedures by passing L{crapc._request.Request} instances
     to L{runProcedure}.
+
+    Call L{compile} to flatten a tree of nested L{RPCSystem}s into a single
+    index so that procedures are found with one dictionary lookup instead of
+    walking the tree for every request.
+
+    Wrap every request to the system with L{addMiddleware}.
     """
 
-    implements(ISystem)
 
     def __init__(self):
         self._functions = {}
+        self._signatures = {}
+        self._caches = {}
+        self._pools = {}
         self._systems = {}
+        self._index = None
+        self._parents = []
+        self._middleware = []
+        self._chain = None
 
 
     def runProcedure(self, request):
         """
-        Find and run the procedure identified by C{request}.
+        Find and run the procedure identified by C{request}, through any
+        middleware.
 
         @param request: A L{crapc._request.Request} instance.
 
         @raise MethodNotFound: If the method named could not be found.
 
+        @raise Timeout: If the deadline of the request has passed.
+
         @return: Whatever the procedure returns.
         """
+        if request.deadline is not None:
+            request.checkDeadline()
+        if self._chain is not None:
+            return self._chain(request)
+        return self._dispatch(request)
+
+
+    def _dispatch(self, request):
+        """
+        Find and run the procedure identified by C{request}.
+        """
+        if self._index is not None:
+            procedure = self._index.get(request.method)
+            if procedure is not None:
+                return self._call(procedure, request)
+
         # look for a subsystem
-        if '.' in request.method:
-            system_name, rest = request.method.split('.', 1)
+        if not request.isLeaf():
             try:
-                system = self._systems[system_name]
+                system = self._systems[request.segment]
             except KeyError:
                 raise MethodNotFound(request.method)
             return system.runProcedure(request.child())
 
         # look for a function
         try:
-            func = self._functions[request.method]
-            return func(*request.args(), **request.kwargs())
+            procedure = self._procedure(request.segment)
+            return self._call(procedure, request)
         except KeyError:
             raise MethodNotFound(request.method)
 
 
-    def addFunction(self, name, func):
+    def _procedure(self, name):
+        """
+        Get the function called C{name} with its signature, cache and pool.
+        """
+        return (self._functions[name], self._signatures[name],
+                self._caches[name], self._pools[name])
+
+
+    def _call(self, procedure, request):
+        """
+        Call a function with the params of C{request}.
+
+        @param procedure: A tuple of the function, its signature, its
+            L{crapc.cache.ResultCache} and the pool to run it in (either of
+            which may be C{None}).
+
+        @raise InvalidParams: If the params don't match the signature.
+        """
+        func, signature, cache, pool = procedure
+        args = request.args()
+        kwargs = request.kwargs()
+        if signature is not None:
+            signature.check(args, kwargs)
+        if pool is not None:
+            args = (func,) + tuple(args)
+            func = pool.run
+        if cache is not None:
+            return cache.call(requestKey(request), func, *args, **kwargs)
+        return func(*args, **kwargs)
+
+
+    def addFunction(self, name, func, cache=None, pool=None):
         """
         Add a function to this system.
 
         @param name: Name of function.
-        @param func: Function to be called.
+        @param func: Function to be called.  Calls with params that don't
+            fit its signature raise L{crapc.error.InvalidParams} without
+            calling it.
+        @param cache: A L{crapc.cache.ResultCache} to keep the results of
+            C{func} in, keyed on the full method name and params.  Only use
+            this for functions whose results depend on nothing else.
+        @param pool: A pool such as L{crapc.pool.ProcessPool} to run C{func}
+            in instead of the calling thread.
         """
         self._functions[name] = func
+        self._signatures[name] = signature(func)
+        self._caches[name] = cache
+        self._pools[name] = pool
+        self._changed()
 
 
     def addSystem(self, name, system):
@@ -74,22 +150,96 @@ class RPCSystem(object):
         @param system: A L{ISystem}-providing instance.
         """
         self._systems[name] = system
+        self._changed()
+
 
+    def addMiddleware(self, middleware):
+        """
+        Run every request to this system (including requests for procedures
+        of its subsystems) through C{middleware}.  See L{crapc.middleware}.
 
+        Middleware is called in the order it is added, the first added being
+        outermost.
 
-class _BoundRPC(object):
+        @param middleware: A function taking C{(next, request)}.
+        """
+        self._middleware.append(middleware)
+        self._chain = chain(self._middleware, self._dispatch)
+        self._changed()
+
+
+    def compile(self):
+        """
+        Flatten this system and all nested L{RPCSystem}s into a single index
+        mapping full method names to functions, their signatures and
+        caches.
+
+        Once compiled, the index is rebuilt whenever L{addFunction} or
+        L{addSystem} is called on this system or on any nested L{RPCSystem}.
+        Procedures living in subsystems that are not L{RPCSystem}s, or in
+        subsystems with middleware, are still found by walking the tree.
+
+        @return: self
+        """
+        index = {}
+        self._indexInto(index, '')
+        self._index = index
+        return self
+
+
+    def _indexInto(self, index, prefix):
+        """
+        Add the full names of all reachable functions to C{index} and make
+        sure nested systems will tell this system when they change.
+        """
+        for name, system in self._systems.items():
+            if isinstance(system, RPCSystem):
+                if self not in system._parents:
+                    system._parents.append(self)
+                if system._chain is None:
+                    system._indexInto(index, prefix + name + '.')
+        for name, func in self._functions.items():
+            # dotted function names are unreachable by walking, so they
+            # should stay unreachable through the index.
+            if '.' not in name:
+                index[prefix + name] = self._procedure(name)
+
+
+    def _changed(self):
+        """
+        Rebuild the index of this system and of every compiled system that
+        contains it.
+        """
+        if self._index is not None:
+            self.compile()
+        for parent in self._parents:
+            parent._changed()
 
-    implements(ISystem)
+
+
+def _callShared(f, instance, request):
+    """
+    Call a route whose result is shared between requests, without the
+    deadline of the request that happened to be first.
+    """
+    return f(instance, request.withoutDeadline())
+
+
+
+@implementer(ISystem)
+class _BoundRPC(object):
 
 
     def __init__(self, instance, descriptor):
         self.instance = instance
         self.descriptor = descriptor
+        self._chain = None
+        self._generation = None
 
 
     def runProcedure(self, request):
         """
-        Run the requested procedure with pre hooks.
+        Run the requested procedure through the middleware.
 
         @rtype: C{Deferred}
         """
@@ -97,21 +247,44 @@ class _BoundRPC(object):
 
 
     def _runProcedure(self, request):
-        # 1. get a factory function
-        if self.descriptor._prehook:
-            factory = partial(self.descriptor._prehook, self.instance,
-                              self._getAndRunFactory)
-        else:
-            factory = self._getFactory(request)
+        """
+        Like L{runProcedure}, but only return a C{Deferred} if the middleware
+        or the procedure did.
+        """
+        if request.deadline is not None:
+            request.checkDeadline()
+        if self._generation != self.descriptor._generation:
+            self._compile()
+        if self._chain is None:
+            return self._route(request)
+        # middleware may return a system too
+        return self._maybeRunProcedureOnSystem(self._chain(request), request)
+
 
-        # 2. run the factory function to produce either a system or a final
-        # result
-        d_system = defer.maybeDeferred(factory, request)
+    def _compile(self):
+        """
+        Compile the middleware of the descriptor, bound to the instance,
+        into a single function (or C{None} if there is no middleware).
+        """
+        middleware = list(self.descriptor._middleware)
+        if self.descriptor._prehook is not None:
+            middleware.insert(0, self.descriptor._prehook)
+        self._chain = None
+        if middleware:
+            self._chain = chain([partial(func, self.instance)
+                                 for func in middleware], self._route)
+        self._generation = self.descriptor._generation
 
-        # 3. run the system's procedure if it is a system
-        d_system.addCallback(self._maybeRunProcedureOnSystem, request)
 
-        return d_system
+    def _route(self, request):
+        """
+        Run the factory function for C{request} to produce either a system
+        or a final result, and run the system's procedure if it is a system.
+        """
+        if request.deadline is not None:
+            request.checkDeadline()
+        factory = self._getFactory(request)
+        return self._maybeRunProcedureOnSystem(factory(request), request)
 
 
     def _getFactory(self, request):
@@ -123,10 +296,8 @@ class _BoundRPC(object):
         """
         factory = None
 
-        system_name = request.method.split('.')[0]
-
         try:
-            factory = partial(self.descriptor._routes[system_name],
+            factory = partial(self.descriptor._routes[request.segment],
                               self.instance)
         except KeyError:
             pass
@@ -140,18 +311,22 @@ class _BoundRPC(object):
         return factory
 
 
-    def _getAndRunFactory(self, request):
-        d = defer.maybeDeferred(self._getFactory, request)
-        d.addCallback(lambda func: func(request))
-        d.addCallback(self._maybeRunProcedureOnSystem, request)
-        return d
+    def _maybeRunProcedureOnSystem(self, system_or_response, request):
+        if isinstance(system_or_response, defer.Deferred):
+            return system_or_response.addCallback(
+                self._maybeRunProcedureOnSystem, request)
 
+        if isinstance(system_or_response, _BoundRPC):
+            # run it without an extra Deferred
+            return self._maybeRunProcedureOnSystem(
+                system_or_response._runProcedure(request), request)
 
-    def _maybeRunProcedureOnSystem(self, system_or_response, request):
         if ISystem.providedBy(system_or_response):
             # it's a system
-            d = defer.maybeDeferred(system_or_response.runProcedure, request)
-            return d.addCallback(self._maybeRunProcedureOnSystem, request)
+            if request.deadline is not None:
+                request.checkDeadline()
+            return self._maybeRunProcedureOnSystem(
+                system_or_response.runProcedure(request), request)
 
         # it's a response
         return system_or_response
@@ -199,6 +374,8 @@ class RPC(object):
         self._bound_instances = WeakKeyDictionary()
         self._routes = {}
         self._prehook = None
+        self._middleware = []
+        self._generation = 0
         self._default_system = None
 
 
@@ -210,16 +387,25 @@ class RPC(object):
         return bound_rpc
 
 
-    def route(self, system_name):
+    def route(self, system_name, cache=None):
         """
         Route to a function, L{ISystem} or return value for the given
         procedure name.
+
+        @param cache: A L{crapc.cache.ResultCache} to keep the return values
+            of the decorated function in, keyed on the instance, full method
+            name and params.  Only use this for routes that return final
+            results (not L{ISystem}s) which depend on nothing else.
         """
         def deco(f):
-            
+
             @wraps(f)
             def routeWrapper(instance, request):
-                return f(instance, request.child())
+                request = request.child()
+                if cache is not None:
+                    return cache.call(requestKey(request, instance),
+                                      _callShared, f, instance, request)
+                return f(instance, request)
             self._routes[system_name] = routeWrapper
 
             return routeWrapper
@@ -235,6 +421,19 @@ class RPC(object):
         return f
 
 
+    def middleware(self, function):
+        """
+        Run every request through C{function}, a method taking
+        C{(next, request)}.  See L{crapc.middleware}.
+
+        Middleware is called in the order it is declared, the first declared
+        being outermost.  It may be added after instances have been used.
+        """
+        self._middleware.append(function)
+        self._generation += 1
+        return function
+
+
     def prehook(self, function):
         """
         Call C{function} instead of doing the normal routing lookup.
@@ -243,7 +442,10 @@ class RPC(object):
         C{(continue_func, request)}.
         C{continue_func} is a continuation function
         that will do what would have been done if
-        there were no prehook.
+        there were no prehook, and always returns a C{Deferred}.
+
+        A prehook is L{middleware} that runs before all other middleware,
+        and there may only be one.
 
         So C{Foo} and C{Bar} in this example will behave identically::
 
@@ -259,7 +461,11 @@ class RPC(object):
 
                 rpc = RPC()
         """
-        self._prehook = function
+        def prehook(instance, next, request):
+            return function(instance, partial(defer.maybeDeferred, next),
+                            request)
+        self._prehook = prehook
+        self._generation += 1
 
 
 